@@ -0,0 +1,308 @@
+import os
+import csv
+import json
+import time
+import shutil
+import argparse
+import platform
+import hashlib
+import numpy as np
+from PIL import Image
+from decoding import BACKGROUND_INDEX, REFERENCE_SIZE, dot_coordinates, load_dot_region, sample_dots, colors_to_indices, palette_lookup_table, \
+    decode_token_image
+from metadata_store import open_metadata_store, refresh_metadata_store, metadata_rows, metadata_version, find_metadata_row
+from payload import LAYOUT_BITS, bit_matrix_to_payloads, parse_token_fields, pack_bit_string, payload_to_bit_string
+from reference_data import CACHE_DIR, load_reference_data
+import script3
+
+# Stages timed separately, in pipeline order
+STAGES = ('load', 'sampling', 'color_to_bit', 'parse', 'match', 'csv_write')
+
+# Corpus sizes run by default, and the largest corpus accepted
+DEFAULT_SIZES = (1, 10, 100, 1000, 10000, 100000)
+MAX_CORPUS_SIZE = 100000
+
+# Images processed per stage before moving to the next stage, so memory does not grow with the corpus
+BENCHMARK_CHUNK_SIZE = 256
+
+# Where rendered corpora (reused across runs with the same options) and results are kept, outside the tracked tree
+BENCHMARK_DIR = os.path.join(CACHE_DIR, 'benchmark')
+RESULTS_DIR = os.path.join(BENCHMARK_DIR, 'results')
+
+# Function to render the bits of one token into an RGB image, dots drawn as in the real tokens
+#
+# Every dot is a single pixel (or a disc of dot_radius pixels) of the color of
+# its bit on the background color. The image is then scaled to size pixels,
+# gets Gaussian noise of standard deviation noise, and the caller saves it as
+# PNG or JPEG.
+def render_token(bits, reference, size=REFERENCE_SIZE[0], dot_radius=0, noise=0.0, rng=None):
+    palette = np.asarray([color[:3] for color in reference['dot_colors']], dtype=np.uint8)
+    pixels = np.empty((REFERENCE_SIZE[1], REFERENCE_SIZE[0], 3), dtype=np.uint8)
+    pixels[:] = palette[BACKGROUND_INDEX]
+    xs, ys = dot_coordinates(reference['dot_positions'], reference['total_dots'])
+    for dy in range(-dot_radius, dot_radius + 1):
+        for dx in range(-dot_radius, dot_radius + 1):
+            if dx * dx + dy * dy <= dot_radius * dot_radius:
+                pixels[ys + dy, xs + dx] = palette[bits]
+    image = Image.fromarray(pixels)
+    if (size, size) != REFERENCE_SIZE:
+        image = image.resize((size, size), Image.BILINEAR)
+    if noise:
+        rng = rng or np.random.default_rng()
+        noisy = np.asarray(image, dtype=np.float32) + rng.normal(0, noise, (size, size, 3))
+        image = Image.fromarray(np.clip(np.rint(noisy), 0, 255).astype(np.uint8))
+    return image
+
+# Function to get the tokens of metadata.tsv as (tokenID, payload) pairs, skipping rows without a Bit String
+def metadata_tokens(store):
+    tokens = []
+    for row in metadata_rows(store):
+        payload = pack_bit_string(row.get('Bit String', ''))
+        if payload is not None:
+            tokens.append((str(row['tokenID']).strip(), payload))
+    return tokens
+
+# Function to get the folder of the corpus rendered with the given options
+def corpus_dir(options, reference, metadata_key):
+    key = json.dumps([options, reference['version'], metadata_key], sort_keys=True)
+    return os.path.join(BENCHMARK_DIR, hashlib.sha256(key.encode('utf-8')).hexdigest()[:16])
+
+# Function to get the file name of image number index of a corpus
+def corpus_file_name(index, jpeg_quality):
+    return f"token_{index:06d}.{'jpg' if jpeg_quality else 'png'}"
+
+# Function to make sure a corpus folder holds the first count images, rendering only the missing ones
+#
+# Image i encodes tokens[i % len(tokens)]. Each token is rendered once; the
+# images that repeat a token are hard links to its first image, so a corpus
+# of 100k images costs one rendering per metadata row. Returns the paths.
+def build_corpus(folder, tokens, count, reference, options):
+    os.makedirs(folder, exist_ok=True)
+    width = reference['total_dots']
+    paths = []
+    for index in range(count):
+        path = os.path.join(folder, corpus_file_name(index, options['jpeg_quality']))
+        paths.append(path)
+        if os.path.exists(path):
+            continue
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        if index >= len(tokens):
+            source = os.path.join(folder, corpus_file_name(index % len(tokens), options['jpeg_quality']))
+            try:
+                os.link(source, tmp_path)
+            except OSError:
+                shutil.copyfile(source, tmp_path)
+        else:
+            bits = np.array([int(bit) for bit in payload_to_bit_string(tokens[index][1], width)], dtype=np.intp)
+            rng = np.random.default_rng([options['seed'], index])
+            image = render_token(bits, reference, options['size'], options['dot_radius'], options['noise'], rng)
+            if options['jpeg_quality']:
+                image.save(tmp_path, format='JPEG', quality=options['jpeg_quality'])
+            else:
+                image.save(tmp_path, format='PNG')
+        os.replace(tmp_path, path)  # A corpus interrupted while rendering never holds a partial image
+    return paths
+
+# Function to time every stage of decoding, matching and writing a corpus
+#
+# The stages run one after the other on chunks of BENCHMARK_CHUNK_SIZE
+# images, each with the functions the pipeline uses, and their times are
+# summed over the chunks. A corpus that is not lossless at the reference size
+# (exact=False) goes through decoding.decode_token_image as the pipeline
+# does: its whole decode is counted under 'load', and sampling and
+# color_to_bit stay at zero. expected holds the (tokenID, payload) encoded in
+# each image; the comparison with it is not timed.
+def run_benchmark(paths, expected, reference, store, headers, csv_path, exact=True):
+    dot_positions, dot_colors, total_dots = reference['dot_positions'], reference['dot_colors'], reference['total_dots']
+    width = max(total_dots, LAYOUT_BITS)
+    timings = dict.fromkeys(STAGES, 0.0)
+    errors = {'decode': 0, 'fields': 0, 'match': 0}
+    palette_lookup_table(dot_colors)  # Loading the lookup table is setup, not part of a stage
+
+    with open(csv_path, mode='w', newline='', encoding='utf-8') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=headers, extrasaction='ignore')
+        writer.writeheader()
+        for start in range(0, len(paths), BENCHMARK_CHUNK_SIZE):
+            chunk = paths[start:start + BENCHMARK_CHUNK_SIZE]
+            ok = np.ones(len(chunk), dtype=bool)
+
+            started = time.perf_counter()
+            if exact:
+                regions = []
+                for i, path in enumerate(chunk):
+                    try:
+                        regions.append(load_dot_region(path, dot_positions, total_dots))
+                    except Exception:
+                        regions.append(None)
+                        ok[i] = False
+                loaded = time.perf_counter()
+
+                colors = np.zeros((len(chunk), total_dots, 3), dtype=np.uint8)
+                for i, region in enumerate(regions):
+                    if region is not None:
+                        colors[i] = sample_dots(region[0], dot_positions, total_dots, region[1])
+                sampled = time.perf_counter()
+
+                indices = colors_to_indices(colors.reshape(-1, 3), dot_colors).reshape(len(chunk), total_dots)
+                ok &= (indices <= 1).all(axis=1)
+                classified = time.perf_counter()
+                payloads = bit_matrix_to_payloads(np.minimum(indices, 1))
+            else:
+                payloads = []
+                for i, path in enumerate(chunk):
+                    try:
+                        payloads.append(decode_token_image(path, dot_positions, dot_colors, total_dots)[0])
+                    except Exception:
+                        payloads.append(None)
+                        ok[i] = False
+                loaded = sampled = classified = time.perf_counter()
+
+            fields = [parse_token_fields(payload, width) if good else None for payload, good in zip(payloads, ok)]
+            parsed = time.perf_counter()
+
+            merged = []
+            for payload, data in zip(payloads, fields):
+                metadata_row = find_metadata_row(store, data['date_number'], payload) if data else None
+                if metadata_row:
+                    merged_row = {
+                        'Latitude': data['latitude'],
+                        'Longitude': data['longitude'],
+                        'Serial Number': data['date_number'],
+                        'Impact Quantity': data['impact_quantity'],
+                        'Project Type': reference['project_type_map'].get(data['project_value'], 'Unknown Project Type'),
+                        'Impact Unit': reference['impact_unit_map'].get(data['impact_value'], 'Unknown Impact Unit'),
+                        'Binary Code': payload
+                    }
+                    for k, v in metadata_row.items():
+                        if k not in merged_row:
+                            merged_row[k] = v
+                    metadata_row = merged_row
+                merged.append(metadata_row)
+            matched = time.perf_counter()
+
+            for row in merged:
+                if row:
+                    writer.writerow({**row, 'Binary Code': payload_to_bit_string(row['Binary Code'], total_dots)})
+            if start + BENCHMARK_CHUNK_SIZE >= len(paths):
+                csvfile.flush()
+                os.fsync(csvfile.fileno())
+            written = time.perf_counter()
+
+            for stage, elapsed in zip(STAGES, (loaded - started, sampled - loaded, classified - sampled,
+                                               parsed - classified, matched - parsed, written - matched)):
+                timings[stage] += elapsed
+
+            # Correctness: the decoded fields must be those encoded, and the match the encoded token
+            for (token_id, payload), data, row in zip(expected[start:start + len(chunk)], fields, merged):
+                if data is None:
+                    errors['decode'] += 1
+                elif data != parse_token_fields(payload, width):
+                    errors['fields'] += 1
+                elif row is None or str(row.get('tokenID', '')).strip() != token_id:
+                    errors['match'] += 1
+
+    total = sum(timings.values())
+    return {
+        'images': len(paths),
+        'stages': {stage: {'seconds': round(seconds, 6), 'ms_per_image': round(seconds * 1000 / len(paths), 4)}
+                   for stage, seconds in timings.items()},
+        'total_seconds': round(total, 6),
+        'images_per_second': round(len(paths) / total, 1) if total else None,
+        'errors': errors,
+        'correct': not any(errors.values())
+    }
+
+# Function to print the per-image stage times of a result next to those of an earlier result file
+def print_comparison(result, previous_path):
+    with open(previous_path, encoding='utf-8') as f:
+        previous = {run['images']: run for run in json.load(f)['runs']}
+    for run in result['runs']:
+        before = previous.get(run['images'])
+        if before is None:
+            print(f"{run['images']} images: not in {previous_path}")
+            continue
+        print(f"{run['images']} images (ms per image, before -> now):")
+        for stage in STAGES:
+            old, new = before['stages'][stage]['ms_per_image'], run['stages'][stage]['ms_per_image']
+            print(f"  {stage:<13} {old:10.4f} -> {new:10.4f}  ({old / new if new else float('inf'):.2f}x)")
+
+# Function to parse the command line options
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Benchmark the decoding pipeline on a synthetic corpus of token images '
+                                                 'that encode the rows of data/metadata.tsv.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(DEFAULT_SIZES),
+                        help=f"Corpus sizes to run, from 1 to {MAX_CORPUS_SIZE} images (default: {' '.join(map(str, DEFAULT_SIZES))})")
+    parser.add_argument('--size', type=int, default=REFERENCE_SIZE[0],
+                        help=f"Width and height of the rendered images in pixels (default: {REFERENCE_SIZE[0]})")
+    parser.add_argument('--dot-radius', type=int, default=0,
+                        help='Radius of the rendered dots in pixels, 0 for single pixel dots as in the real tokens')
+    parser.add_argument('--noise', type=float, default=0.0,
+                        help='Standard deviation of the Gaussian noise added to every channel (default: none)')
+    parser.add_argument('--jpeg-quality', type=int, default=None,
+                        help='Save the images as JPEG with this quality instead of PNG')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the noise (default: 0)')
+    parser.add_argument('--output', default=None,
+                        help='JSON file to write the results to (default: .cache/benchmark/results/benchmark_<UTC time>.json)')
+    parser.add_argument('--compare', default=None, help='Earlier JSON result to compare the stage times with')
+    args = parser.parse_args()
+    if any(size < 1 or size > MAX_CORPUS_SIZE for size in args.sizes):
+        parser.error(f"--sizes must be between 1 and {MAX_CORPUS_SIZE}")
+    return args
+
+# Main benchmark function: render the corpus if needed, time every size and write the JSON result
+def main(sizes=DEFAULT_SIZES, size=REFERENCE_SIZE[0], dot_radius=0, noise=0.0, jpeg_quality=None, seed=0,
+         output=None, compare=None):
+    reference = load_reference_data()
+    os.makedirs(BENCHMARK_DIR, exist_ok=True)
+
+    # The benchmark keeps its own metadata store, built from the local data/metadata.tsv
+    store = open_metadata_store(os.path.join(BENCHMARK_DIR, 'metadata.sqlite3'))
+    refresh_metadata_store(store, script3.METADATA_TSV_URL, offline=True)
+    tokens = metadata_tokens(store)
+    if not tokens:
+        print("No tokens with a Bit String found in the metadata.")
+        return False
+    headers = script3.merged_headers(store)
+
+    options = {'size': size, 'dot_radius': dot_radius, 'noise': noise, 'jpeg_quality': jpeg_quality, 'seed': seed}
+    folder = corpus_dir(options, reference, metadata_version(store, script3.METADATA_TSV_URL))
+    print(f"Rendering up to {max(sizes)} images in {folder}...")
+    started = time.perf_counter()
+    paths = build_corpus(folder, tokens, max(sizes), reference, options)
+    print(f"Corpus ready in {time.perf_counter() - started:.1f}s.")
+
+    result = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'cpu_count': os.cpu_count(),
+        'corpus': {**options, 'distinct_tokens': min(len(tokens), max(sizes)), 'path': folder},
+        'runs': []
+    }
+    csv_path = os.path.join(BENCHMARK_DIR, 'merged_data_with_metadata.csv')
+    # Lossless images of the reference size take the exact decoding path, any other corpus the resampled one
+    exact = (size, size) == REFERENCE_SIZE and not jpeg_quality
+    for count in sorted(set(sizes)):
+        expected = [tokens[index % len(tokens)] for index in range(count)]
+        run = run_benchmark(paths[:count], expected, reference, store, headers, csv_path, exact)
+        result['runs'].append(run)
+        stages = ', '.join(f"{stage} {run['stages'][stage]['ms_per_image']:.3f}" for stage in STAGES)
+        check = 'correct' if run['correct'] else f"errors {run['errors']}"
+        print(f"{count} images: {run['images_per_second']} images/s ({stages} ms per image), {check}")
+
+    output = output or os.path.join(RESULTS_DIR, f"benchmark_{time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, mode='w', encoding='utf-8') as f:
+        json.dump(result, f, indent=2)
+    print(f"Results saved to {output}")
+
+    if compare:
+        print_comparison(result, compare)
+    return all(run['correct'] for run in result['runs'])
+
+# Run the main function, failing when a decoded token differs from the encoded one
+if __name__ == '__main__':
+    args = parse_arguments()
+    if not main(args.sizes, args.size, args.dot_radius, args.noise, args.jpeg_quality, args.seed, args.output, args.compare):
+        raise SystemExit(1)
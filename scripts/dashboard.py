@@ -1,9 +1,15 @@
 import os
-import time
+import json
+import hashlib
 import pandas as pd
 import streamlit as st
 import requests
 import base64
+from github_batch import replace_directory_in_one_commit
+from jobs import new_job_id, job_input_dir
+from result_wait import LATEST_RESULT_PATH, raw_file_url, wait_for_job_result
+from result_cache import open_result_cache, set_cache_versions, fetch_metadata_version, image_digest, lookup_image_result, store_image, store_result
+from payload import pack_bit_string
 
 # Define GitHub repository details
 GITHUB_REPO = "releafs/decryption"
@@ -13,73 +19,21 @@ GITHUB_TOKEN = st.secrets["GITHUB_TOKEN"]
 # Define the direct URL to the CSV file
 CSV_URL = "https://raw.githubusercontent.com/releafs/decryption/main/process/merged_data_with_metadata.csv"
 
-input_directory_in_github = "decryption/input/"
+# How long a fetched token result is reused before it is revalidated with its ETag
+RESULT_TTL_SECONDS = 60
 
-# Function to create a placeholder file if the directory does not exist
-def create_placeholder_file():
-    file_name = ".gitkeep"  # Placeholder file name
-    content = base64.b64encode(b'').decode('utf-8')  # Empty file content
-    url = f"https://api.github.com/repos/{GITHUB_REPO}/contents/{input_directory_in_github}{file_name}"
-    data = {
-        "message": "Create input directory with placeholder file",
-        "content": content,
-        "branch": GITHUB_BRANCH
-    }
-    response = requests.put(url, json=data, headers={
-        "Authorization": f"token {GITHUB_TOKEN}",
-        "Accept": "application/vnd.github.v3+json"
-    })
-    if response.status_code in [201, 200]:
-        st.write(f"Created {file_name} in {input_directory_in_github}.")
-    else:
-        st.error(f"Failed to create placeholder file. Response: {response.status_code}, {response.text}")
-
-# Function to clear the input directory
-def clear_input_directory():
-    GITHUB_API_URL = f"https://api.github.com/repos/{GITHUB_REPO}/contents/{input_directory_in_github}"
-    response = requests.get(GITHUB_API_URL, headers={
-        "Authorization": f"token {GITHUB_TOKEN}",
-        "Accept": "application/vnd.github.v3+json"
-    })
-    if response.status_code == 200:
-        files = response.json()
-        if len(files) == 0:
-            st.write("Directory is already empty.")
-        else:
-            for file in files:
-                file_name = file['name']
-                sha = file['sha']
-                delete_response = delete_file_in_github(file_name, sha)
-                if delete_response.status_code == 200:
-                    st.write(f"Deleted {file_name} successfully.")
-                else:
-                    st.error(f"Failed to delete {file_name}. Response: {delete_response.status_code}")
-    elif response.status_code == 404:
-        st.warning(f"Directory {input_directory_in_github} not found, creating it...")
-        create_placeholder_file()
-    else:
-        st.error(f"Failed to list files in directory. Response: {response.status_code}")
-
-# Function to delete a file in the GitHub repository
-def delete_file_in_github(file_name, sha):
-    GITHUB_API_URL = f"https://api.github.com/repos/{GITHUB_REPO}/contents/{input_directory_in_github}{file_name}"
-    data = {
-        "message": f"Delete {file_name}",
-        "sha": sha,
-        "branch": GITHUB_BRANCH
-    }
-    response = requests.delete(GITHUB_API_URL, json=data, headers={
-        "Authorization": f"token {GITHUB_TOKEN}",
-        "Accept": "application/vnd.github.v3+json"
-    })
-    return response
+# Metadata the cached results were merged with, a change there invalidates them
+METADATA_TSV_URL = "https://raw.githubusercontent.com/releafs/decryption/main/data/metadata.tsv"
 
-# Function to upload the file to GitHub
-def upload_file_to_github(file_name, file_content):
+# Add the files of an upload in one commit (set GITHUB_BATCHED_UPLOAD=0 for one commit per file)
+BATCHED_UPLOAD = os.getenv("GITHUB_BATCHED_UPLOAD", "1") != "0"
+
+# Function to upload the file to GitHub, into the input folder of its job
+def upload_file_to_github(file_name, file_content, job_id):
     encoded_content = base64.b64encode(file_content).decode("utf-8")  # Base64 encode the file content
-    url = f"https://api.github.com/repos/{GITHUB_REPO}/contents/{input_directory_in_github}{file_name}"
+    url = f"https://api.github.com/repos/{GITHUB_REPO}/contents/{job_input_dir(job_id)}/{file_name}"
     data = {
-        "message": f"Upload {file_name}",
+        "message": f"Upload {file_name} (job {job_id})",
         "content": encoded_content,
         "branch": GITHUB_BRANCH
     }
@@ -89,41 +43,99 @@ def upload_file_to_github(file_name, file_content):
     })
     return response
 
-def display_token_details():
-    CSV_URL = "https://raw.githubusercontent.com/releafs/decryption/main/process/merged_data_with_metadata.csv"
-    
+# Function to open the result cache, dropping its rows if metadata.tsv changed
+def open_checked_result_cache():
+    result_cache = open_result_cache()
+    set_cache_versions(result_cache, metadata_version=fetch_metadata_version(METADATA_TSV_URL))
+    return result_cache
+
+# Function to remember the result row of an uploaded image, so scanning it again is answered locally
+def remember_token_row(image_bytes, row):
+    payload = pack_bit_string(row.get("Binary Code") or "")
+    if payload is None:
+        return
+    result_cache = open_checked_result_cache()
+    store_image(result_cache, image_digest(image_bytes), payload)
+    store_result(result_cache, payload, row)
+
+# Function to get the ETag and row of every token result fetched, so an expired st.cache_data entry costs a 304
+#
+# Streamlit runs this script again on every rerun, so the dict is kept in a
+# cache_resource shared by all sessions instead of a module global.
+@st.cache_resource
+def result_validators():
+    return {}
+
+# Function to fetch the JSON result row of one token, None when the file does not exist
+@st.cache_data(ttl=RESULT_TTL_SECONDS, show_spinner=False)
+def fetch_token_result(url):
+    headers = {}
+    known = result_validators().get(url)
+    if known:
+        headers["If-None-Match"] = known[0]
+    response = requests.get(url, headers=headers, timeout=30)
+    if response.status_code == 304 and known:
+        return known[1]
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    row = response.json()
+    if response.headers.get("ETag"):
+        result_validators()[url] = (response.headers["ETag"], row)
+    return row
+
+# Function to find the result of an uploaded file in the record of its job, None if it is not there
+def job_image_result(job, file_name):
+    for image in job.get("images", []):
+        if image["file_name"] == file_name:
+            return image
+    return None
+
+# Function to display the details of one token row
+def show_token_row(row):
+    parameters = {
+        "Latitude": row["Latitude"],
+        "Longitude": row["Longitude"],
+        "Type of Token": row["Type of Token"],
+        "Description": row["description"],
+        "External URL": row["external_url"],
+        "Starting Project": row["Starting Project"],
+        "Unit": row["Unit"],
+        "Deleverable": row["Deleverable"],
+        "Years Duration": row["Years_Duration"],
+        "Impact Type": row["Impact Type"],
+        "SDGs": row["SDGs"],
+        "Implementer Partner": row["Implementer Partner"],
+        "Internal Verification": row["Internal Verification"],
+        "Local Verification": row["Local Verification"],
+        "Imv Document": row["Imv_Document"]
+    }
+
+    st.write("### Token Information:")
+    st.table(pd.DataFrame.from_dict(parameters, orient='index', columns=['Value']).reset_index().rename(columns={"index": "Parameter"}))
+
+# Function to display the last token of the result CSV, by default the latest one on the branch
+#
+# When image_bytes is given the row is the result of that upload and is kept
+# in the result cache. Returns the row as a dict, None when it failed.
+def display_token_details(csv_url=CSV_URL, image_bytes=None):
     try:
-        # Directly read the CSV data from the URL using Pandas
-        df = pd.read_csv(CSV_URL)
+        # Directly read the CSV data from the URL using Pandas (keeping the leading zeros of the bit string)
+        df = pd.read_csv(csv_url, dtype={"Binary Code": str})
 
         if df.empty:
             st.error("CSV file is empty.")
-            return
-
-        last_row = df.iloc[-1]
-        parameters = {
-            "Latitude": last_row["Latitude"],
-            "Longitude": last_row["Longitude"],
-            "Type of Token": last_row["Type of Token"],
-            "Description": last_row["description"],
-            "External URL": last_row["external_url"],
-            "Starting Project": last_row["Starting Project"],
-            "Unit": last_row["Unit"],
-            "Deleverable": last_row["Deleverable"],
-            "Years Duration": last_row["Years_Duration"],
-            "Impact Type": last_row["Impact Type"],
-            "SDGs": last_row["SDGs"],
-            "Implementer Partner": last_row["Implementer Partner"],
-            "Internal Verification": last_row["Internal Verification"],
-            "Local Verification": last_row["Local Verification"],
-            "Imv Document": last_row["Imv_Document"]
-        }
-
-        st.write("### Token Information:")
-        st.table(pd.DataFrame.from_dict(parameters, orient='index', columns=['Value']).reset_index().rename(columns={"index": "Parameter"}))
-    
+            return None
+
+        last_row = json.loads(df.iloc[-1].to_json())
+        if image_bytes is not None:
+            remember_token_row(image_bytes, last_row)
+        show_token_row(last_row)
+        return last_row
+
     except Exception as e:
         st.error(f"An error occurred: {str(e)}")
+        return None
 
 
 
@@ -146,21 +158,90 @@ with tab1:
 
     if uploaded_file is not None:
         st.write(f"File selected: {uploaded_file.name} ({uploaded_file.size / 1024:.2f} KB)")
-        st.write("Clearing input directory...")
-        clear_input_directory()
         file_name = uploaded_file.name
         file_content = uploaded_file.getvalue()
 
-        response = upload_file_to_github(file_name, file_content)
-
-        if response.status_code in [201, 200]:
-            st.success(f"File {file_name} uploaded/updated successfully!")
+        # Streamlit reruns the page on every interaction, so only a file not uploaded yet is sent
+        upload_key = (file_name, hashlib.sha256(file_content).hexdigest())
+        if st.session_state.get('upload_key') == upload_key:
+            st.write(f"File {file_name} already uploaded.")
         else:
-            st.error(f"Failed to upload {file_name}. Response: {response.status_code}, {response.text}")
+            # A token scanned before is answered from the result cache, without going through GitHub
+            cached_row = lookup_image_result(open_checked_result_cache(), file_content)
+            if cached_row is not None:
+                st.session_state['upload_key'] = upload_key
+                st.session_state['upload_job_id'] = None
+                st.session_state['cached_row'] = cached_row
+                st.success(f"Token {file_name} recognised, its details are ready!")
+            else:
+                # Every upload goes to the input folder of its own job, leaving other users' uploads alone
+                job_id = new_job_id()
+                if BATCHED_UPLOAD:
+                    try:
+                        commit_sha = replace_directory_in_one_commit(GITHUB_REPO, GITHUB_BRANCH, job_input_dir(job_id),
+                                                                     {file_name: file_content},
+                                                                     f"Upload {file_name} (job {job_id})", GITHUB_TOKEN)
+                    except requests.RequestException as e:
+                        commit_sha = None
+                        st.error(f"Failed to upload {file_name}. Error: {e}")
+                else:
+                    response = upload_file_to_github(file_name, file_content, job_id)
+                    commit_sha = response.json()['commit']['sha'] if response.status_code in [201, 200] else None
+                    if commit_sha is None:
+                        st.error(f"Failed to upload {file_name}. Response: {response.status_code}, {response.text}")
+
+                if commit_sha is not None:
+                    st.session_state['upload_key'] = upload_key
+                    st.session_state['upload_job_id'] = job_id
+                    st.session_state['upload_commit_sha'] = commit_sha
+                    st.session_state['upload_file_name'] = file_name
+                    st.session_state['cached_row'] = None
+                    st.success(f"File {file_name} uploaded/updated successfully!")
+            st.session_state['upload_content'] = file_content
 
 # Display Token Details Tab
 with tab2:
     if st.button("Show Token Details"):
-        with st.spinner("Showing Your Token Details..."):
-            time.sleep(60)  # Adjust this based on your processing time
-            display_token_details()
+        cached_row = st.session_state.get('cached_row')
+        job_id = st.session_state.get('upload_job_id')
+        if cached_row is not None:
+            # Repeat scan, or a result already fetched in this session
+            show_token_row(cached_row)
+        elif job_id is None:
+            # Nothing uploaded in this session: show the latest processed token
+            try:
+                latest_row = fetch_token_result(raw_file_url(GITHUB_REPO, GITHUB_BRANCH, LATEST_RESULT_PATH))
+            except (requests.RequestException, ValueError):
+                latest_row = None
+            if latest_row is not None:
+                show_token_row(latest_row)
+            else:
+                display_token_details()
+        else:
+            # Poll for the result record of this upload's job instead of sleeping a fixed time
+            progress_bar = st.progress(0.0, text="Showing Your Token Details...")
+
+            def show_progress(elapsed, timeout):
+                progress_bar.progress(min(elapsed / timeout, 1.0), text=f"Processing your token... ({elapsed:.0f}s)")
+
+            result = wait_for_job_result(GITHUB_REPO, GITHUB_BRANCH, job_id, GITHUB_TOKEN,
+                                         st.session_state.get('upload_commit_sha'), progress=show_progress)
+            progress_bar.empty()
+            if result['state'] == 'ready':
+                image_result = job_image_result(result['job'], st.session_state.get('upload_file_name'))
+                if image_result is not None and image_result['status'] == 'matched':
+                    remember_token_row(st.session_state.get('upload_content'), image_result['row'])
+                    show_token_row(image_result['row'])
+                    st.session_state['cached_row'] = image_result['row']
+                elif image_result is not None and image_result['status'] == 'unmatched':
+                    st.error("Your token was read, but it is not in the token registry.")
+                elif image_result is not None and image_result['status'] == 'no_metadata':
+                    st.error("The token registry could not be loaded, so your token could not be matched. Please try again later.")
+                else:
+                    st.error("Your token could not be read. Please upload a clearer image.")
+            else:
+                if result['state'] == 'failed':
+                    st.error(f"Processing your token failed ({result['conclusion']}). Showing the latest processed token.")
+                else:
+                    st.warning("Processing is taking longer than expected. Showing the latest processed token.")
+                display_token_details()
@@ -0,0 +1,285 @@
+import os
+import json
+import time
+import queue
+import argparse
+import threading
+from io import BytesIO
+from concurrent.futures import Future, ThreadPoolExecutor
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+from decoding import DECODE_OK, DECODE_READ_ERROR, DECODE_OUT_OF_BOUNDS, DECODE_INVALID_DOT, decode_batch, palette_lookup_table
+from metadata_store import open_metadata_store, refresh_metadata_store, metadata_rows
+from payload import LAYOUT_BITS, bit_matrix_to_payloads, parse_bit_matrix, payload_to_bit_string
+from reference_data import load_reference_data
+import script2
+import script3
+
+# Define the directories
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.abspath(os.path.join(SCRIPT_DIR, '..'))
+UPLOAD_FORM_PATH = os.path.join(ROOT_DIR, 'templates', 'upload.html')
+
+# Micro-batching: a batch is decoded once it holds MAX_BATCH_IMAGES images or
+# BATCH_WINDOW_SECONDS after its first image arrived, whichever comes first
+MAX_BATCH_IMAGES = 64
+BATCH_WINDOW_SECONDS = 0.005
+
+# Threads sharing the image decoding of a batch (Pillow releases the GIL while decoding)
+DECODE_THREADS = os.cpu_count() or 1
+
+# How often the metadata store is checked for rows added to metadata.tsv
+METADATA_REFRESH_SECONDS = 300
+
+# Largest request body accepted, in bytes
+MAX_REQUEST_BYTES = 64 * 1024 * 1024
+
+# Names of the decode_batch status codes, as reported in the responses
+STATUS_NAMES = {
+    DECODE_OK: 'ok',
+    DECODE_READ_ERROR: 'read_error',
+    DECODE_OUT_OF_BOUNDS: 'out_of_bounds',
+    DECODE_INVALID_DOT: 'invalid_dot',
+}
+
+# Reference data, value names and metadata index kept warm for the life of the service
+_service_state = {}
+
+# Function to load the reference data and the value -> name maps once, at startup
+def warm_up(offline=False, decode_threads=DECODE_THREADS):
+    reference = load_reference_data(lambda file_name: script2.fetch_reference_source(file_name, offline))
+    if reference is None:
+        raise RuntimeError("Failed to fetch the reference data.")
+    if reference['total_dots'] < LAYOUT_BITS:
+        raise RuntimeError("Bit string is shorter than expected.")
+    palette_lookup_table(reference['dot_colors'])
+    _service_state['reference'] = reference
+    _service_state['offline'] = offline
+    _service_state['decode_pool'] = ThreadPoolExecutor(max_workers=decode_threads, thread_name_prefix='decode')
+    _service_state['decode_threads'] = decode_threads
+    _service_state['value_names'] = script2.load_value_names(script2.CREATION_TSV_URL, offline)
+    refresh_metadata_index()
+
+# Function to bring the metadata store up to date and rebuild the in-memory index when rows were added
+def refresh_metadata_index():
+    metadata_store = open_metadata_store()
+    try:
+        added_rows = refresh_metadata_store(metadata_store, script3.METADATA_TSV_URL, _service_state['offline'])
+        if added_rows or 'metadata_index' not in _service_state:
+            _service_state['metadata_index'] = script3.build_metadata_index(metadata_rows(metadata_store))
+            print(f"Metadata index built, {added_rows} new rows.")
+    except Exception as e:
+        print(f"Failed to refresh metadata, keeping the current index: {e}")
+        _service_state.setdefault('metadata_index', script3.build_metadata_index(metadata_rows(metadata_store)))
+    finally:
+        metadata_store.close()
+
+# Function to decode a batch of encoded images and match them with the metadata in one vectorized pass
+def decode_and_match(images):
+    reference = _service_state['reference']
+    project_type_map, impact_unit_map = _service_state['value_names']
+    metadata_index = _service_state['metadata_index']
+
+    # Split the batch into one contiguous chunk per decode thread, then classify and parse it as a whole
+    chunk_size = -(-len(images) // _service_state['decode_threads'])
+    chunks = [[BytesIO(image) for image in images[i:i + chunk_size]] for i in range(0, len(images), chunk_size)]
+    decoded = list(_service_state['decode_pool'].map(
+        lambda chunk: decode_batch(chunk, reference['dot_positions'], reference['dot_colors'], reference['total_dots']), chunks))
+    bits = np.concatenate([chunk_bits for chunk_bits, _ in decoded])
+    status = np.concatenate([chunk_status for _, chunk_status in decoded])
+    parsed = parse_bit_matrix(bits)
+    payloads = bit_matrix_to_payloads(bits)
+
+    results = []
+    for i, payload in enumerate(payloads):
+        if status[i] != DECODE_OK:
+            results.append({'status': STATUS_NAMES[int(status[i])]})
+            continue
+        fields = {name: parsed[name][i].item() for name in parsed.dtype.names}
+        result = {
+            'status': STATUS_NAMES[DECODE_OK],
+            'Latitude': fields['latitude'],
+            'Longitude': fields['longitude'],
+            'Serial Number': fields['date_number'],
+            'Impact Quantity': fields['impact_quantity'],
+            'Project Type': project_type_map.get(fields['project_value']) or 'Unknown Project Type',
+            'Impact Unit': impact_unit_map.get(fields['impact_value']) or 'Unknown Impact Unit',
+            'Binary Code': payload_to_bit_string(payload, bits.shape[1]),
+        }
+        metadata_row = script3.find_metadata_by_serial(fields['date_number'], payload, metadata_index)
+        result['metadata'] = metadata_row
+        results.append(result)
+    return results
+
+# Collects images submitted by concurrent requests into micro-batches for a single decode thread
+class DecodeBatcher:
+    def __init__(self, decode, max_batch_images=MAX_BATCH_IMAGES, batch_window=BATCH_WINDOW_SECONDS):
+        self.decode = decode
+        self.max_batch_images = max_batch_images
+        self.batch_window = batch_window
+        self.pending = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name='decode-batcher', daemon=True)
+        self.thread.start()
+
+    # Function to queue one encoded image, returning a Future for its result
+    def submit(self, image):
+        future = Future()
+        self.pending.put((image, future))
+        return future
+
+    # Function to wait for the first image, then gather more until the batch is full or the window closes
+    def next_batch(self):
+        batch = [self.pending.get()]
+        deadline = time.monotonic() + self.batch_window
+        while len(batch) < self.max_batch_images:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.pending.get(timeout=timeout))
+            except queue.Empty:
+                break
+        # Take whatever else is already waiting, up to the batch limit, without waiting for it
+        while len(batch) < self.max_batch_images:
+            try:
+                batch.append(self.pending.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            try:
+                results = self.decode([image for image, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+            else:
+                for (_, future), result in zip(batch, results):
+                    future.set_result(result)
+
+# Function to refresh the metadata index on its own thread every interval seconds
+#
+# decode_and_match reads whichever index was built last, so a slow or failing
+# fetch of metadata.tsv never holds up a batch. Returns an Event that stops
+# the thread when set.
+def start_metadata_refresher(interval=METADATA_REFRESH_SECONDS):
+    stop = threading.Event()
+
+    def run():
+        while not stop.wait(interval):
+            try:
+                refresh_metadata_index()
+            except Exception as e:
+                print(f"Failed to refresh the metadata index: {e}")
+
+    threading.Thread(target=run, name='metadata-refresh', daemon=True).start()
+    return stop
+
+# Function to extract the (file name, content) pairs of the 'file' fields of a multipart/form-data body
+def parse_uploaded_files(content_type, body):
+    message = BytesParser(policy=HTTP).parsebytes(
+        f"Content-Type: {content_type}\r\n\r\n".encode('latin-1') + body)
+    files = []
+    for part in message.iter_parts():
+        if part.get_param('name', header='content-disposition') == 'file' and part.get_filename():
+            files.append((part.get_filename(), part.get_payload(decode=True)))
+    return files
+
+# Threaded HTTP server with a listen backlog deep enough for bursts of concurrent scans
+class DecodeServer(ThreadingHTTPServer):
+    request_queue_size = 128
+    daemon_threads = True
+
+# HTTP handler: GET / serves the upload form, POST / decodes its files, POST /decode decodes a raw image body
+class DecodeRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep connections alive between scans
+    disable_nagle_algorithm = True  # Small JSON responses must not wait for a delayed ACK
+    batcher = None
+
+    def do_GET(self):
+        if self.path not in ('/', '/upload'):
+            self.send_error(404)
+            return
+        with open(UPLOAD_FORM_PATH, mode='rb') as f:
+            self.send_body(200, f.read(), 'text/html; charset=utf-8')
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > MAX_REQUEST_BYTES:
+            self.send_error(413)
+            return
+        body = self.rfile.read(length)
+
+        if self.path == '/decode':
+            files = [(None, body)]
+        elif self.path in ('/', '/upload'):
+            content_type = self.headers.get('Content-Type', '')
+            if not content_type.startswith('multipart/form-data'):
+                self.send_error(400, "Expected multipart/form-data")
+                return
+            files = parse_uploaded_files(content_type, body)
+        else:
+            self.send_error(404)
+            return
+
+        # Every image goes through the shared batcher, so concurrent requests are decoded together
+        futures = [self.batcher.submit(content) for _, content in files]
+        results = []
+        for (file_name, _), future in zip(files, futures):
+            result = future.result()
+            if file_name is not None:
+                result = {'file': file_name, **result}
+            results.append(result)
+        payload = results[0] if self.path == '/decode' else results
+        self.send_body(200, json.dumps(payload).encode('utf-8'), 'application/json')
+
+    def send_body(self, status_code, body, content_type):
+        self.send_response(status_code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # One line per request would dominate the cost of a decode
+
+# Function to parse the command line options
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Serve token decoding over HTTP with micro-batched decodes.')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8080, help='Port to listen on (default: 8080)')
+    parser.add_argument('--max-batch', type=int, default=MAX_BATCH_IMAGES,
+                        help=f"Largest number of images decoded in one pass (default: {MAX_BATCH_IMAGES})")
+    parser.add_argument('--batch-window-ms', type=float, default=BATCH_WINDOW_SECONDS * 1000,
+                        help=f"How long a batch waits for more images, in ms (default: {BATCH_WINDOW_SECONDS * 1000:g})")
+    parser.add_argument('--decode-threads', type=int, default=DECODE_THREADS,
+                        help='Threads sharing the image decoding of a batch (default: number of cores)')
+    parser.add_argument('--offline', action='store_true',
+                        help='Read the reference files and metadata from the local data folder instead of GitHub')
+    return parser.parse_args()
+
+# Main function: warm up, start the batcher and serve until interrupted
+def main(host='127.0.0.1', port=8080, max_batch=MAX_BATCH_IMAGES, batch_window=BATCH_WINDOW_SECONDS,
+         decode_threads=DECODE_THREADS, offline=False):
+    warm_up(offline, decode_threads)
+    DecodeRequestHandler.batcher = DecodeBatcher(decode_and_match, max_batch, batch_window)
+    stop_refresher = start_metadata_refresher()
+    server = DecodeServer((host, port), DecodeRequestHandler)
+    print(f"Decode service listening on http://{host}:{server.server_port}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_refresher.set()
+        server.server_close()
+
+# Run the main function
+if __name__ == '__main__':
+    args = parse_arguments()
+    main(host=args.host, port=args.port, max_batch=args.max_batch,
+         batch_window=args.batch_window_ms / 1000, decode_threads=args.decode_threads, offline=args.offline)
@@ -0,0 +1,477 @@
+import os
+import hashlib
+from collections import deque
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from PIL import Image
+from instrumentation import span
+from payload import pack_bit_matrix, packed_to_payload
+from reference_data import CACHE_DIR, load_reference_data
+from registration import apply_homography, layout_pitch, local_scales, register_layout
+
+# Vertical offset applied to every dot position before sampling
+DOT_Y_OFFSET = 7
+
+# (width, height) of the token images the dot positions were measured on
+REFERENCE_SIZE = (978, 978)
+
+# Formats read pixel for pixel; any other format, or another size, goes through decode_resampled
+LOSSLESS_FORMATS = ('PNG', 'TIFF', 'BMP')
+
+# Index of the inventory color the dots are drawn on (it encodes no bit)
+BACKGROUND_INDEX = 2
+
+# Half width of the patch averaged around each dot, in pixels of the reference size
+# (dots are 20 pixels apart, so a patch never reaches the next dot)
+PATCH_RADIUS = 6
+MIN_PATCH_HALF_WIDTH = 1
+
+# Smallest scale decode_scaled accepts: below it neighbouring dots blur into each other
+MIN_SCALE = 0.3
+
+# Dots whose confidence margin is below this are rejected instead of guessed
+MIN_DOT_MARGIN = 0.2
+
+# Images whose aspect ratio differs more than this from the reference are photos, not resized tokens
+MAX_ASPECT_CHANGE = 0.02
+
+# JPEG photos are decoded by the codec at the largest reduction (1/2, 1/4 or 1/8)
+# that keeps both sides at least this size, several times faster than in full
+DRAFT_SIZE = (1024, 1024)
+
+# Per-image status codes reported by decode_batch
+DECODE_OK = 0
+DECODE_READ_ERROR = 1  # The image could not be opened or converted to pixels
+DECODE_OUT_OF_BOUNDS = 2  # A dot position falls outside the image
+DECODE_INVALID_DOT = 3  # A dot matched a palette color that does not encode a bit
+
+# Palette lookup tables already loaded in this process, keyed by palette
+_palette_tables = {}
+
+# Images sent to a pool worker per task, and tasks kept in flight per worker, when streaming
+STREAM_CHUNK_SIZE = 16
+STREAM_CHUNKS_PER_WORKER = 2
+
+# Decoders that fill rows top to bottom and can stop cleanly after a given row
+SEQUENTIAL_CODECS = ('zip', 'raw')
+
+# Function to get the pixel coordinates of the dots that are sampled
+def dot_coordinates(dot_positions, total_dots):
+    positions = np.asarray(dot_positions[:total_dots], dtype=np.intp).reshape(-1, 2)
+    xs = positions[:, 0]
+    ys = positions[:, 1] - DOT_Y_OFFSET  # Adjust for any potential offset
+    return xs, ys
+
+# Function to compute the (left, top, right, bottom) box that holds every sampled dot
+def dot_bounding_box(dot_positions, total_dots):
+    xs, ys = dot_coordinates(dot_positions, total_dots)
+    return int(xs.min()), int(ys.min()), int(xs.max()) + 1, int(ys.max()) + 1
+
+# Function to restrict the decoding of an opened image to the tiles and rows that hold a box
+#
+# This edits the tile list of Pillow's ImageFile, which is not a public API
+# (tested with the Pillow versions allowed by requirements.txt). When the
+# tiles do not have the expected fields the image is left untouched, so it
+# is decoded in full by the crop that follows.
+def restrict_decode_to_box(image, box):
+    left, top, right, bottom = box
+    width, _ = image.size
+    try:
+        tiles = [tile for tile in image.tile
+                 if tile.extents is None or (tile.extents[0] < right and tile.extents[2] > left
+                                             and tile.extents[1] < bottom and tile.extents[3] > top)]
+        sequential = bool(tiles) and hasattr(image, '_size') and not image.info.get('interlace') \
+            and all(tile.codec_name in SEQUENTIAL_CODECS and tile.extents for tile in tiles)
+        if sequential:
+            trimmed = [tile._replace(extents=tuple(tile.extents[:3]) + (min(tile.extents[3], bottom),)) for tile in tiles]
+    except (AttributeError, TypeError, IndexError, ValueError):
+        return
+    if sequential:
+        # Allocate and decode the frame only down to the last dot row
+        image.tile = trimmed
+        image._size = (width, bottom)
+    elif tiles:
+        image.tile = tiles
+
+# Function to decode only the part of an image that holds the dots
+#
+# Returns the region as an RGB(A) array together with the (x, y) origin of
+# the region in the full image. Only the rows down to the last dot are
+# decoded for PNG and uncompressed TIFF, tiles of tiled/stripped TIFFs that
+# miss the dot box are skipped, and only the cropped region is color
+# converted. JPEG and compressed TIFF are decoded in full by their codecs.
+def load_dot_region(image_path, dot_positions, total_dots):
+    left, top, right, bottom = dot_bounding_box(dot_positions, total_dots)
+    image = Image.open(image_path)
+    width, height = image.size
+    if left < 0 or top < 0 or right > width or bottom > height:
+        raise IndexError(f"Dot positions fall outside the {width}x{height} image")
+
+    restrict_decode_to_box(image, (left, top, right, bottom))
+    region = image.crop((left, top, right, bottom))
+    if region.mode not in ('RGB', 'RGBA'):
+        region = region.convert('RGB')
+    return np.asarray(region), (left, top)
+
+# Function to gather the colors of all dots with a single fancy-indexing call
+def sample_dots(pixels, dot_positions, total_dots, origin=(0, 0)):
+    xs, ys = dot_coordinates(dot_positions, total_dots)
+    return pixels[ys - origin[1], xs - origin[0], :3]
+
+# Function to compute the closest palette index for a block of colors
+def nearest_palette_indices(colors, palette):
+    # Squared distances pick the same closest color as np.linalg.norm, ties resolve to the first entry
+    diff = colors[:, np.newaxis, :].astype(np.int32) - palette[np.newaxis, :, :]
+    distances = np.einsum('ijk,ijk->ij', diff, diff)
+    return distances.argmin(axis=1)
+
+# Function to build the full 24-bit RGB -> palette index table, one red plane at a time
+def build_palette_table(palette, table_path):
+    tmp_path = f"{table_path}.{os.getpid()}.tmp"
+    table = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(256 ** 3,))
+    green, blue = np.meshgrid(np.arange(256), np.arange(256), indexing='ij')
+    plane = np.empty((256 * 256, 3), dtype=np.int32)
+    plane[:, 1] = green.ravel()
+    plane[:, 2] = blue.ravel()
+    for red in range(256):
+        plane[:, 0] = red
+        table[red * 65536:(red + 1) * 65536] = nearest_palette_indices(plane, palette)
+    table.flush()
+    del table
+    os.replace(tmp_path, table_path)  # Publish atomically so concurrent runs never see a partial table
+
+# Function to load (building it on first use) the lookup table for a palette
+#
+# The table maps every 24-bit RGB value straight to the index of its closest
+# DOT_COLORS entry. Index 0 and 1 are the bit values. Index 2, the third
+# inventory color (165, 119, 72), is not a bit: decode_payload rejects the
+# token and decode_batch reports DECODE_INVALID_DOT instead of silently
+# reading that dot as a 0 or 1.
+def palette_lookup_table(dot_colors):
+    key = tuple(tuple(dc[:3]) for dc in dot_colors)
+    table = _palette_tables.get(key)
+    if table is None:
+        palette = np.asarray(key, dtype=np.int32).reshape(-1, 3)
+        if len(palette) == 0 or len(palette) > 10:
+            raise ValueError(f"Expected between 1 and 10 DOT_COLORS, got {len(palette)}")
+        # The file name carries the palette hash, so it is rebuilt only when inventory.csv changes the colors
+        digest = hashlib.sha256(repr(key).encode('utf-8')).hexdigest()[:16]
+        table_path = os.path.join(CACHE_DIR, f"palette_lut_{digest}.npy")
+        if not os.path.exists(table_path):
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            build_palette_table(palette, table_path)
+        table = np.load(table_path, mmap_mode='r')
+        _palette_tables[key] = table
+    return table
+
+# Function to get the (x, y) centers of the dots in an image of the given (width, height), in pixels
+def scaled_dot_centers(dot_positions, total_dots, size):
+    xs, ys = dot_coordinates(dot_positions, total_dots)
+    scale_x, scale_y = size[0] / REFERENCE_SIZE[0], size[1] / REFERENCE_SIZE[1]
+    # Scale pixel centers, not pixel corners, so the layout stays aligned at any size
+    return np.rint((xs + 0.5) * scale_x - 0.5).astype(np.intp), np.rint((ys + 0.5) * scale_y - 0.5).astype(np.intp)
+
+# Function to gather a square patch of pixels around every dot center into one (dots, patch pixels, 3) array
+def sample_dot_patches(pixels, centers, half_width):
+    offsets = np.arange(-half_width, half_width + 1)
+    offset_y, offset_x = (grid.ravel() for grid in np.meshgrid(offsets, offsets, indexing='ij'))
+    ys = centers[1][:, np.newaxis] + offset_y
+    xs = centers[0][:, np.newaxis] + offset_x
+    if ys.min() < 0 or xs.min() < 0 or ys.max() >= pixels.shape[0] or xs.max() >= pixels.shape[1]:
+        raise IndexError(f"Dot patches fall outside the {pixels.shape[1]}x{pixels.shape[0]} image")
+    border = np.maximum(np.abs(offset_y), np.abs(offset_x)) == half_width
+    return pixels[ys, xs, :3].astype(np.float32), border
+
+# Function to classify dots from their patches, returning the bits and a confidence margin per dot
+#
+# A dot is a small spot of one bit color on the background color, so when an
+# image is scaled or compressed its color is spread over its neighbours but
+# its mass (the sum of the patch minus the local background, the median of
+# the patch border) is kept. In reference pixels that mass is area * (bit
+# color - background) for a dot of area pixels, the same for every dot of a
+# token, so each dot is placed on the line between the two bit colors (t = 0
+# for bit 1, 1 for bit 0) with the area fitted over the whole token. The
+# margin is |2t - 1| clipped to 1: 0 halfway between the two colors, 1 on
+# either of them. Dots far off the line (t outside [-0.5, 1.5]) get margin 0.
+def classify_dot_patches(patches, border, dot_colors, pixel_area):
+    palette = np.asarray([color[:3] for color in dot_colors], dtype=np.float32)
+    background = np.median(patches[:, border], axis=1)
+    mass = (patches - background[:, np.newaxis]).sum(axis=1) / np.reshape(pixel_area, (-1, 1))
+    one, zero = palette[1] - background, palette[0] - background
+    step = zero - one
+
+    area = 1.0
+    for _ in range(5):
+        t = np.einsum('ij,ij->i', mass - area * one, step) / (area * np.einsum('ij,ij->i', step, step))
+        expected = np.where((t > 0.5)[:, np.newaxis], zero, one)
+        area = max(float(np.einsum('ij,ij->', mass, expected) / np.einsum('ij,ij->', expected, expected)), 1e-6)
+
+    bits = (t <= 0.5).astype(np.uint8)  # Bit 0 is the color at t = 1
+    margins = np.clip(np.abs(2 * t - 1), 0, 1)
+    margins[(t < -0.5) | (t > 1.5)] = 0
+    return bits, margins
+
+# Function to classify dots from their patches by color alone, returning the bits and a confidence margin per dot
+#
+# Filters such as BOX keep the mass of a one-pixel dot but split it between
+# output pixels by its phase, so the dots of one image have different areas
+# and a single fitted area misreads the faint ones. Here each dot's mass is
+# split into amounts a of bit 0 and b of bit 1 (least squares on the two
+# color steps from the local background), and t = a / (a + b) places it
+# between the bit colors whatever its area. Dots far off the line, or with
+# under a tenth of the mass of the strongest dot (dots lost by the resize),
+# get margin 0.
+def classify_dot_colors(patches, border, dot_colors, pixel_area):
+    palette = np.asarray([color[:3] for color in dot_colors], dtype=np.float32)
+    background = np.median(patches[:, border], axis=1)
+    mass = (patches - background[:, np.newaxis]).sum(axis=1) / np.reshape(pixel_area, (-1, 1))
+    steps = np.stack((palette[0] - background, palette[1] - background), axis=2)
+    gram = np.einsum('nki,nkj->nij', steps, steps)
+    amounts = np.linalg.solve(gram, np.einsum('nki,nk->ni', steps, mass)[..., np.newaxis])[..., 0]
+    weight = amounts.sum(axis=1)
+    t = amounts[:, 0] / np.where(weight > 0, weight, 1)
+
+    bits = (t <= 0.5).astype(np.uint8)  # Bit 0 is the color at t = 1
+    margins = np.clip(np.abs(2 * t - 1), 0, 1)
+    margins[(t < -0.5) | (t > 1.5) | (weight < 0.1 * weight.max())] = 0
+    return bits, margins
+
+# Function to decode the dot bits of a token image of any size, with a confidence margin per dot
+#
+# The dot layout is scaled to the image, and every dot is classified from
+# the patch around it, so resized and re-encoded images decode too. Both
+# classifiers run (classify_dot_patches suits smooth filters, whose dots all
+# keep one area, classify_dot_colors suits BOX, whose dot areas vary) and
+# the one whose weakest dot is more confident wins. Raises ValueError when
+# the image is too small.
+def decode_scaled(pixels, dot_positions, dot_colors, total_dots):
+    height, width = pixels.shape[:2]
+    scale = min(width / REFERENCE_SIZE[0], height / REFERENCE_SIZE[1])
+    if scale < MIN_SCALE:
+        raise ValueError(f"The {width}x{height} image is too small, it must be at least {MIN_SCALE:.0%} of "
+                         f"{REFERENCE_SIZE[0]}x{REFERENCE_SIZE[1]}")
+    half_width = max(MIN_PATCH_HALF_WIDTH, int(round(PATCH_RADIUS * scale)))
+    with span('sampling'):
+        centers = scaled_dot_centers(dot_positions, total_dots, (width, height))
+        patches, border = sample_dot_patches(pixels, centers, half_width)
+    with span('color_to_bit'):
+        pixel_area = (width / REFERENCE_SIZE[0]) * (height / REFERENCE_SIZE[1])
+        by_area = classify_dot_patches(patches, border, dot_colors, pixel_area)
+        by_color = classify_dot_colors(patches, border, dot_colors, pixel_area)
+        return by_area if by_area[1].min() >= by_color[1].min() else by_color
+
+# Function to decode the dot bits of a camera-captured token image, with a confidence margin per dot
+#
+# The homography that maps the dot layout onto the photo is estimated first
+# (see registration.register_layout), then every dot is classified from the
+# patch around its warped center, twice as wide as the dots were measured,
+# with the pixel area of the homography at that dot. Each patch is corrected
+# for lighting by mapping its border onto the background color. Raises
+# ValueError when the layout is not found.
+def decode_registered(pixels, dot_positions, dot_colors, total_dots):
+    xs, ys = dot_coordinates(dot_positions, total_dots)
+    layout = np.column_stack((xs, ys)).astype(np.float64)
+    with span('registration'):
+        homography, _, extent = register_layout(pixels, layout)
+    with span('sampling'):
+        centers = np.rint(apply_homography(homography, layout)).astype(np.intp)
+        scales = local_scales(homography, layout)
+        dot_radius = np.sqrt(np.median(extent) / np.pi)
+        # Wide enough for the dot and a ring of background, never reaching the next dot
+        half_width = min(max(MIN_PATCH_HALF_WIDTH, int(round(2 * dot_radius))), int(layout_pitch(layout) * scales.min() / 2))
+        patches, border = sample_dot_patches(pixels, (centers[:, 0], centers[:, 1]), half_width)
+    with span('color_to_bit'):
+        background = np.asarray(dot_colors[BACKGROUND_INDEX][:3], dtype=np.float32)
+        patches *= (background / np.maximum(np.median(patches[:, border], axis=1), 1))[:, np.newaxis]
+        return classify_dot_patches(patches, border, dot_colors, scales ** 2)
+
+# Function to decode the dot bits of a resized, re-encoded or photographed token image
+#
+# An image with the aspect ratio of the reference has the dot layout scaled
+# to it first (decode_scaled). When that fails or leaves a dot below
+# MIN_DOT_MARGIN, and for any other image, the image is taken for a photo and
+# the layout is registered on it (decode_registered). The decode whose
+# weakest dot is the more confident is returned.
+def decode_resampled(pixels, dot_positions, dot_colors, total_dots):
+    height, width = pixels.shape[:2]
+    scaled = None
+    if abs(width * REFERENCE_SIZE[1] / (height * REFERENCE_SIZE[0]) - 1) <= MAX_ASPECT_CHANGE:
+        try:
+            scaled = decode_scaled(pixels, dot_positions, dot_colors, total_dots)
+            if scaled[1].min() >= MIN_DOT_MARGIN:
+                return scaled
+        except (ValueError, IndexError):
+            scaled = None
+    try:
+        registered = decode_registered(pixels, dot_positions, dot_colors, total_dots)
+    except (ValueError, IndexError):
+        if scaled is None:
+            raise
+        return scaled
+    if scaled is not None and scaled[1].min() >= registered[1].min():
+        return scaled
+    return registered
+
+# Function to check whether an opened image can be read pixel for pixel at the fixed dot positions
+def is_reference_image(image):
+    return image.size == REFERENCE_SIZE and image.format in LOSSLESS_FORMATS
+
+# Function to load the pixels of a token image file for decoding
+#
+# Returns (pixels, origin, exact). Lossless images of the reference size are
+# read pixel for pixel, only the dot region (see load_dot_region), and exact
+# is True. Any other image is read whole as RGB, JPEGs larger than DRAFT_SIZE
+# decoded at a reduced scale by the codec.
+def load_token_pixels(image_path, dot_positions, total_dots):
+    with Image.open(image_path) as image:
+        exact = is_reference_image(image)
+        if not exact:
+            image.draft('RGB', DRAFT_SIZE)
+            return np.asarray(image.convert('RGB')), (0, 0), False
+    pixels, origin = load_dot_region(image_path, dot_positions, total_dots)
+    return pixels, origin, True
+
+# Function to decode the payload of a token image file of any size or format
+#
+# Lossless images of the reference size take the exact path (the dot region
+# and the palette lookup table, no margins). Any other image is decoded with
+# decode_resampled. Returns (payload, margins), margins being None on the exact
+# path. Raises ValueError when a dot cannot be read with a margin of at least
+# MIN_DOT_MARGIN, rather than returning a payload that may be wrong.
+def decode_token_image(image_path, dot_positions, dot_colors, total_dots):
+    with span('image_open', file=os.path.basename(image_path)):
+        pixels, origin, exact = load_token_pixels(image_path, dot_positions, total_dots)
+    if exact:
+        return decode_payload(pixels, dot_positions, dot_colors, total_dots, origin), None
+
+    bits, margins = decode_resampled(pixels, dot_positions, dot_colors, total_dots)
+    uncertain = np.flatnonzero(margins < MIN_DOT_MARGIN)
+    if uncertain.size:
+        raise ValueError(f"Dots {uncertain.tolist()} cannot be read with confidence (margins {margins[uncertain].round(2).tolist()})")
+    return packed_to_payload(pack_bit_matrix(bits), len(bits)), margins
+
+# Function to classify every sampled color with a single table gather
+def colors_to_indices(colors, dot_colors):
+    colors = np.asarray(colors, dtype=np.uint32)
+    return palette_lookup_table(dot_colors)[(colors[:, 0] << 16) | (colors[:, 1] << 8) | colors[:, 2]]
+
+# Function to decode the integer payload from an RGB(A) pixel array
+def decode_payload(pixels, dot_positions, dot_colors, total_dots, origin=(0, 0)):
+    with span('sampling'):
+        colors = sample_dots(pixels, dot_positions, total_dots, origin)
+    with span('color_to_bit'):
+        indices = colors_to_indices(colors, dot_colors)
+    invalid = np.flatnonzero(indices > 1)
+    if invalid.size:
+        raise ValueError(f"Dots {invalid.tolist()} match a palette color that does not encode a bit")
+    return packed_to_payload(pack_bit_matrix(indices), len(indices))
+
+# Function to decode a batch of image paths or RGB(A) arrays into one (N, TOTAL_DOTS) matrix
+#
+# Returns the uint8 bit matrix and a uint8 status array with one DECODE_* code
+# per image. Rows whose status is not DECODE_OK must not be used: they are
+# zero for unreadable images and hold the raw palette indices (including 2)
+# for DECODE_INVALID_DOT. Images of another size or in a lossy format are
+# decoded with decode_resampled, and are DECODE_INVALID_DOT when a dot margin is
+# below MIN_DOT_MARGIN. Reference data defaults to the files in data/.
+def decode_batch(paths_or_arrays, dot_positions=None, dot_colors=None, total_dots=None):
+    if dot_positions is None or dot_colors is None or total_dots is None:
+        reference = load_reference_data()
+        dot_positions = reference['dot_positions'] if dot_positions is None else dot_positions
+        dot_colors = reference['dot_colors'] if dot_colors is None else dot_colors
+        total_dots = reference['total_dots'] if total_dots is None else total_dots
+
+    items = list(paths_or_arrays)
+    xs, ys = dot_coordinates(dot_positions, total_dots)
+    colors = np.zeros((len(items), len(xs), 3), dtype=np.uint8)
+    status = np.full(len(items), DECODE_OK, dtype=np.uint8)
+    scaled = {}
+
+    for i, item in enumerate(items):
+        try:
+            if isinstance(item, np.ndarray):
+                pixels, (left, top) = item, (0, 0)
+                exact = pixels.shape[1::-1] == REFERENCE_SIZE
+            else:
+                pixels, (left, top), exact = load_token_pixels(item, dot_positions, total_dots)
+            if pixels.ndim != 3 or pixels.shape[2] < 3:
+                raise ValueError(f"Expected an RGB(A) array, got shape {pixels.shape}")
+            if exact:
+                colors[i] = pixels[ys - top, xs - left, :3]
+            else:
+                scaled[i] = decode_resampled(pixels, dot_positions, dot_colors, total_dots)
+        except IndexError:
+            status[i] = DECODE_OUT_OF_BOUNDS
+        except Exception:
+            status[i] = DECODE_READ_ERROR
+
+    # One table gather classifies every dot of every image
+    indices = colors_to_indices(colors.reshape(-1, 3), dot_colors).reshape(colors.shape[:2])
+    bits = np.ascontiguousarray(indices, dtype=np.uint8)
+    bits[status != DECODE_OK] = 0
+    for i, (scaled_bits, margins) in scaled.items():
+        bits[i] = scaled_bits
+        if (margins < MIN_DOT_MARGIN).any():
+            status[i] = DECODE_INVALID_DOT
+    status[(status == DECODE_OK) & (bits > 1).any(axis=1)] = DECODE_INVALID_DOT
+    return bits, status
+
+# Dot layout and palette held by each pool worker, set once by the initializer
+_worker_state = {}
+
+# Function to load the shared reference data into a pool worker
+def init_decode_worker(decrypt, dot_positions, dot_colors, total_dots):
+    _worker_state['decrypt'] = decrypt
+    _worker_state['dot_positions'] = dot_positions
+    _worker_state['dot_colors'] = dot_colors
+    _worker_state['total_dots'] = total_dots
+    if dot_colors:
+        palette_lookup_table(dot_colors)  # Map the lookup table once per worker
+
+# Function to decrypt one image inside a pool worker
+def decrypt_in_worker(image_path):
+    state = _worker_state
+    return state['decrypt'](image_path, state['dot_positions'], state['dot_colors'], state['total_dots'])
+
+# Function to decrypt a chunk of images inside a pool worker
+def decrypt_chunk_in_worker(image_paths):
+    return [decrypt_in_worker(path) for path in image_paths]
+
+# Function to iterate over the image files of a folder with os.scandir, in directory order
+#
+# Nothing is listed or sorted up front, so a folder of a million images is
+# never held in memory. Use sorted() on the result when the order matters.
+def scan_images(folder, extensions):
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.name.lower().endswith(extensions) and entry.is_file():
+                yield entry.path
+
+# Function to decrypt a stream of images, yielding (path, payload) pairs in input order
+#
+# Paths are consumed lazily: with a process pool only STREAM_CHUNKS_PER_WORKER
+# chunks of STREAM_CHUNK_SIZE images per worker are in flight at any time, so
+# memory does not grow with the number of images.
+def iter_decrypt_images(decrypt, image_paths, dot_positions, dot_colors, total_dots, workers=None):
+    workers = workers or os.cpu_count() or 1
+    image_paths = iter(image_paths)
+    if workers <= 1:
+        for path in image_paths:
+            yield path, decrypt(path, dot_positions, dot_colors, total_dots)
+        return
+
+    if dot_colors:
+        palette_lookup_table(dot_colors)  # Build the table before the workers race to create it
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_decode_worker,
+                             initargs=(decrypt, dot_positions, dot_colors, total_dots)) as pool:
+        pending = deque()
+        while True:
+            chunk = list(islice(image_paths, STREAM_CHUNK_SIZE))
+            if chunk:
+                pending.append((chunk, pool.submit(decrypt_chunk_in_worker, chunk)))
+            if pending and (not chunk or len(pending) >= workers * STREAM_CHUNKS_PER_WORKER):
+                done_chunk, future = pending.popleft()
+                yield from zip(done_chunk, future.result())
+            elif not chunk:
+                break
@@ -0,0 +1,62 @@
+import os
+import time
+from jobs import list_job_inputs
+
+# Micro-batching: new images are processed once MAX_BATCH_IMAGES of them are
+# ready or BATCH_WINDOW_SECONDS after the first one was, whichever comes first
+MAX_BATCH_IMAGES = 64
+BATCH_WINDOW_SECONDS = 0.25
+
+# How often the input folder is scanned for new images
+POLL_INTERVAL_SECONDS = 0.1
+
+# Function to get the (size, mtime) signature of a file, None when it is gone
+def file_signature(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+# Function to list the images of the input folder with their signatures, empty while the folder cannot be read
+def scan_inputs(input_dir, extensions):
+    try:
+        inputs = list_job_inputs(input_dir, extensions)
+    except OSError:
+        return [], {}  # The folder, or a job folder, was removed during the scan
+    return inputs, {path: file_signature(path) for _, _, path in inputs}
+
+# Function to watch the input folder and yield its new or changed images in micro-batches
+#
+# Yields (batch, inputs) pairs: batch lists the (job id, file name, path)
+# tuples of list_job_inputs that arrived or changed, inputs all the images in
+# the folder at that scan. A file is ready once its size and mtime held for a
+# whole scan interval, so a file still being copied is not read half-written.
+# The images already in the folder when the watch starts are the first batches.
+def watch_input_batches(input_dir, extensions, max_batch_images=MAX_BATCH_IMAGES, batch_window=BATCH_WINDOW_SECONDS,
+                        poll_interval=POLL_INTERVAL_SECONDS):
+    processed = {}  # Signature of every file when it was last yielded
+    previous = {}  # Signature of every file at the previous scan
+    ready_since = None
+    while True:
+        inputs, signatures = scan_inputs(input_dir, extensions)
+        ready = [item for item in inputs
+                 if signatures[item[2]] is not None and signatures[item[2]] == previous.get(item[2])
+                 and signatures[item[2]] != processed.get(item[2])]
+        previous = signatures
+        # Forget the files that are gone, so a file copied in again under the same name is processed again
+        processed = {path: signature for path, signature in processed.items() if path in signatures}
+
+        if not ready:
+            ready_since = None
+        elif ready_since is None:
+            ready_since = time.monotonic()
+        if ready and (len(ready) >= max_batch_images or time.monotonic() - ready_since >= batch_window):
+            batch = ready[:max_batch_images]
+            for _, _, path in batch:
+                processed[path] = signatures[path]
+            # A backlog keeps its window open, so the next batch goes out as soon as this one is done
+            ready_since = ready_since if len(ready) > max_batch_images else None
+            yield batch, inputs
+            continue
+        time.sleep(poll_interval)
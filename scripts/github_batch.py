@@ -0,0 +1,83 @@
+import os
+import base64
+import requests
+
+# Base URL of the GitHub REST API, overridable to run against a local stand-in
+GITHUB_API_BASE = os.getenv('GITHUB_API_BASE', 'https://api.github.com').rstrip('/')
+
+# Attempts at moving the branch when another push lands between reading and updating it
+MAX_REF_UPDATE_ATTEMPTS = 3
+
+# Function to build the headers of an authenticated GitHub API request
+def github_headers(token):
+    return {
+        "Authorization": f"token {token}",
+        "Accept": "application/vnd.github.v3+json"
+    }
+
+# Function to list the paths of the files currently in a directory of the branch
+def list_directory_paths(session, repo_url, directory, branch):
+    response = session.get(f"{repo_url}/contents/{directory.strip('/')}", params={"ref": branch})
+    if response.status_code == 404:
+        return []
+    response.raise_for_status()
+    return [entry['path'] for entry in response.json() if entry.get('type') == 'file']
+
+# Function to replace the content of a directory with new files in one commit (Git Data API)
+#
+# files maps file names to their bytes. Every file already in the directory
+# is removed and the new files are added by a single tree and commit, and
+# the branch is moved once, so the whole change costs a constant number of
+# API calls (plus one blob per new file) and triggers one workflow run. The
+# branch update is retried on a concurrent push. Returns the SHA of the new
+# commit; raises requests.HTTPError when GitHub rejects a step.
+def replace_directory_in_one_commit(repo, branch, directory, files, message, token, api_base=None):
+    repo_url = f"{api_base or GITHUB_API_BASE}/repos/{repo}"
+    directory = directory.strip('/')
+    session = requests.Session()
+    session.headers.update(github_headers(token))
+
+    # Blobs do not depend on the branch head, so they are created once
+    new_entries = []
+    for file_name, content in files.items():
+        response = session.post(f"{repo_url}/git/blobs", json={
+            "content": base64.b64encode(content).decode('utf-8'),
+            "encoding": "base64"
+        })
+        response.raise_for_status()
+        new_entries.append({"path": f"{directory}/{file_name}", "mode": "100644", "type": "blob",
+                            "sha": response.json()['sha']})
+    new_paths = {entry['path'] for entry in new_entries}
+
+    for attempt in range(MAX_REF_UPDATE_ATTEMPTS):
+        response = session.get(f"{repo_url}/git/ref/heads/{branch}")
+        response.raise_for_status()
+        head_sha = response.json()['object']['sha']
+        response = session.get(f"{repo_url}/git/commits/{head_sha}")
+        response.raise_for_status()
+        base_tree_sha = response.json()['tree']['sha']
+
+        # A null SHA removes the path from the base tree
+        stale_entries = [{"path": path, "mode": "100644", "type": "blob", "sha": None}
+                         for path in list_directory_paths(session, repo_url, directory, head_sha)
+                         if path not in new_paths]
+        response = session.post(f"{repo_url}/git/trees", json={
+            "base_tree": base_tree_sha,
+            "tree": stale_entries + new_entries
+        })
+        response.raise_for_status()
+        tree_sha = response.json()['sha']
+
+        response = session.post(f"{repo_url}/git/commits", json={
+            "message": message,
+            "tree": tree_sha,
+            "parents": [head_sha]
+        })
+        response.raise_for_status()
+        commit_sha = response.json()['sha']
+
+        response = session.patch(f"{repo_url}/git/refs/heads/{branch}", json={"sha": commit_sha, "force": False})
+        if response.status_code == 422 and attempt + 1 < MAX_REF_UPDATE_ATTEMPTS:
+            continue  # The branch moved since it was read: rebuild the commit on the new head
+        response.raise_for_status()
+        return commit_sha
@@ -0,0 +1,101 @@
+import os
+import json
+import time
+import hashlib
+import requests
+from reference_data import CACHE_DIR, DATA_FOLDER
+
+# Directory holding the on-disk copies of fetched reference files
+HTTP_CACHE_DIR = os.path.join(CACHE_DIR, 'http')
+
+# Reference files already fetched in this process, keyed by URL, with the time they were fetched
+_fetched_contents = {}
+
+# Function to get the body and metadata paths of the cached copy of a URL
+def cached_copy_paths(url):
+    key = hashlib.sha256(url.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(HTTP_CACHE_DIR, f"{key}.body"), os.path.join(HTTP_CACHE_DIR, f"{key}.json")
+
+# Function to map the raw GitHub URL of a data file to the same file in the local data folder
+def local_data_path(url):
+    return os.path.join(DATA_FOLDER, url.rsplit('/', 1)[-1])
+
+# Function to read the cached copy of a URL, None if there is none
+def read_cached_copy(url):
+    body_path, meta_path = cached_copy_paths(url)
+    try:
+        with open(meta_path, mode='r', encoding='utf-8') as f:
+            meta = json.load(f)
+        with open(body_path, mode='rb') as f:
+            return f.read(), meta
+    except (OSError, ValueError):
+        return None, {}
+
+# Function to store the body of a response with its validators
+def write_cached_copy(url, content, response):
+    body_path, meta_path = cached_copy_paths(url)
+    os.makedirs(HTTP_CACHE_DIR, exist_ok=True)
+    meta = {
+        'url': url,
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+    }
+    # Write the body first so the metadata never points at a partial file
+    for path, data, mode in ((body_path, content, 'wb'), (meta_path, json.dumps(meta), 'w')):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, mode) as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+# Function to fetch a reference file at most once per process (or once every max_age seconds)
+#
+# The on-disk copy is revalidated with If-None-Match / If-Modified-Since, so
+# an unchanged file costs one 304 response. When the request fails the
+# cached copy is used if there is one. In offline mode the file is read
+# from the local data folder and the network is not touched. Long-running
+# processes pass max_age to revalidate a file they have already fetched.
+# Returns the raw bytes, or None when the file is not available.
+def fetch_url_cached(url, offline=False, max_age=None):
+    if url in _fetched_contents:
+        content, fetched_at = _fetched_contents[url]
+        if max_age is None or time.monotonic() - fetched_at < max_age:
+            return content
+
+    if offline:
+        try:
+            with open(local_data_path(url), mode='rb') as f:
+                content = f.read()
+        except OSError as e:
+            print(f"Failed to read local copy of {url}: {e}")
+            content = None
+        _fetched_contents[url] = (content, time.monotonic())
+        return content
+
+    cached_content, meta = read_cached_copy(url)
+    headers = {}
+    if cached_content is not None:
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+    try:
+        response = requests.get(url, headers=headers, timeout=30)
+    except requests.RequestException as e:
+        if cached_content is None:
+            print(f"Failed to fetch {url}: {e}")
+        else:
+            print(f"Failed to fetch {url}, using the cached copy: {e}")
+        _fetched_contents[url] = (cached_content, time.monotonic())
+        return cached_content
+
+    if response.status_code == 304 and cached_content is not None:
+        content = cached_content
+    elif response.status_code == 200:
+        content = response.content
+        write_cached_copy(url, content, response)
+    else:
+        print(f"Failed to fetch {url}. Status code: {response.status_code}")
+        content = cached_content
+    _fetched_contents[url] = (content, time.monotonic())
+    return content
@@ -0,0 +1,117 @@
+import os
+import json
+import time
+import pstats
+import cProfile
+from contextlib import contextmanager, nullcontext
+import numpy as np
+
+# Environment variable naming the JSON-lines timing file, so pool workers write their spans to it too
+TIMING_FILE_ENV = 'DECRYPTION_TIMING_FILE'
+
+# Number of functions listed by the --profile report
+PROFILE_TOP_FUNCTIONS = 25
+
+# Open timing file of this process, None while timing is disabled
+_timing = {'file': None, 'path': None}
+
+# Shared do-nothing context returned by span() while timing is disabled
+_NO_SPAN = nullcontext()
+
+# Function to start writing timing records to a JSON-lines file (truncated unless append is set)
+def enable_timing(path, append=False):
+    disable_timing()
+    _timing['file'] = open(path, mode='a' if append else 'w', buffering=1, encoding='utf-8')  # One write per line
+    _timing['path'] = path
+    os.environ[TIMING_FILE_ENV] = path
+
+# Function to stop writing timing records
+def disable_timing():
+    if _timing['file'] is not None:
+        _timing['file'].close()
+    _timing['file'] = _timing['path'] = None
+    os.environ.pop(TIMING_FILE_ENV, None)
+
+@contextmanager
+def _timed_span(name, attrs):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record = {'span': name, 'ms': round((time.perf_counter() - started) * 1000, 4), 'pid': os.getpid(), **attrs}
+        _timing['file'].write(json.dumps(record, default=str) + '\n')
+
+# Function to time a block of code as one record of the stage name
+#
+# Use as "with span('parse'):". Extra keyword arguments (a file name, a row
+# count) are added to the record. While timing is disabled this returns a
+# shared no-op context, so spans can stay in hot loops.
+def span(name, **attrs):
+    if _timing['file'] is None:
+        return _NO_SPAN
+    return _timed_span(name, attrs)
+
+# Function to summarize a timing file: count, total, p50, p95 and max milliseconds per stage
+def timing_summary(path):
+    durations = {}
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            record = json.loads(line)
+            if 'span' in record:
+                durations.setdefault(record['span'], []).append(record['ms'])
+    summary = {}
+    for name, values in durations.items():
+        values = np.asarray(values)
+        summary[name] = {
+            'count': len(values),
+            'total_ms': round(float(values.sum()), 3),
+            'p50_ms': round(float(np.percentile(values, 50)), 4),
+            'p95_ms': round(float(np.percentile(values, 95)), 4),
+            'max_ms': round(float(values.max()), 4)
+        }
+    return summary
+
+# Function to print the summary of a timing file, slowest stage first, and append it to the file
+def print_timing_summary(path):
+    summary = timing_summary(path)
+    print(f"Timing summary ({path}):")
+    print(f"  {'stage':<18} {'count':>7} {'total ms':>11} {'p50 ms':>9} {'p95 ms':>9} {'max ms':>9}")
+    for name, stats in sorted(summary.items(), key=lambda item: -item[1]['total_ms']):
+        print(f"  {name:<18} {stats['count']:>7} {stats['total_ms']:>11.1f} {stats['p50_ms']:>9.3f} "
+              f"{stats['p95_ms']:>9.3f} {stats['max_ms']:>9.3f}")
+    with open(path, mode='a', encoding='utf-8') as f:
+        f.write(json.dumps({'summary': summary}) + '\n')
+    return summary
+
+# Function to add the --timing and --profile options to the parser of a script
+def add_instrumentation_arguments(parser):
+    parser.add_argument('--timing', metavar='FILE', default=os.getenv(TIMING_FILE_ENV),
+                        help='Write one JSON line per timed stage to FILE and print a p50/p95 summary per stage '
+                             f"at the end (also enabled by the {TIMING_FILE_ENV} environment variable)")
+    parser.add_argument('--profile', metavar='FILE',
+                        help='Run under cProfile, save the statistics to FILE and print the slowest functions '
+                             '(decoding runs in worker processes unless --workers 1 is given)')
+    return parser
+
+# Function to run the main function of a script with the instrumentation requested on the command line
+def run_instrumented(args, main, *main_args, **main_kwargs):
+    if args.timing:
+        enable_timing(args.timing)
+    profiler = cProfile.Profile() if args.profile else None
+    try:
+        with span('run'):
+            if profiler:
+                return profiler.runcall(main, *main_args, **main_kwargs)
+            return main(*main_args, **main_kwargs)
+    finally:
+        if profiler:
+            profiler.dump_stats(args.profile)
+            print(f"Profile saved to {args.profile}, slowest functions by cumulative time:")
+            pstats.Stats(profiler).sort_stats('cumulative').print_stats(PROFILE_TOP_FUNCTIONS)
+        if args.timing:
+            disable_timing()
+            print_timing_summary(args.timing)
+
+# Pool workers started by spawn do not inherit the open file, so they reopen it from the environment
+if os.getenv(TIMING_FILE_ENV) and _timing['file'] is None:
+    enable_timing(os.environ[TIMING_FILE_ENV], append=True)
@@ -0,0 +1,70 @@
+import os
+import time
+import secrets
+from datetime import datetime, timezone
+
+# Every upload is a job: its images go to decryption/input/<job id>/ and its
+# result record to process/jobs/<job id>.json, so concurrent uploads never
+# clear or read each other's files. Images directly in decryption/input/
+# (older uploads) are processed as before, without a job.
+INPUT_DIR_IN_REPO = 'decryption/input'
+JOB_RESULTS_DIR = 'process/jobs'
+
+# Extensions of the input images, in the input folder and in job folders
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.tif', '.tiff')
+
+# Job result records older than this are removed by the pipeline
+JOB_RETENTION_SECONDS = 7 * 24 * 3600
+
+# Format of the timestamp that starts every job id
+JOB_TIME_FORMAT = '%Y%m%d%H%M%S'
+
+# Function to create a new job id: UTC creation time, then random hex so ids sort by age and never collide
+def new_job_id():
+    return f"{time.strftime(JOB_TIME_FORMAT, time.gmtime())}-{secrets.token_hex(4)}"
+
+# Function to check that a folder name is a job id (and so safe to use in a path)
+def is_job_id(name):
+    stamp, _, suffix = name.partition('-')
+    return len(stamp) == 14 and stamp.isdigit() and len(suffix) == 8 and all(c in '0123456789abcdef' for c in suffix)
+
+# Function to get the creation time of a job from its id, as a Unix timestamp
+def job_created_at(job_id):
+    return datetime.strptime(job_id.split('-', 1)[0], JOB_TIME_FORMAT).replace(tzinfo=timezone.utc).timestamp()
+
+# Function to get the repository folder of the images of a job
+def job_input_dir(job_id):
+    return f"{INPUT_DIR_IN_REPO}/{job_id}"
+
+# Function to get the repository path of the result record of a job
+def job_result_path(job_id):
+    return f"{JOB_RESULTS_DIR}/{job_id}.json"
+
+# Function to list the pending images of the input folder as sorted (job id, file name, path) tuples
+#
+# The job id is None for images directly in input_dir.
+def list_job_inputs(input_dir, extensions):
+    inputs = []
+    with os.scandir(input_dir) as entries:
+        for entry in entries:
+            if entry.is_file() and entry.name.lower().endswith(extensions):
+                inputs.append((None, entry.name, entry.path))
+            elif entry.is_dir() and is_job_id(entry.name):
+                with os.scandir(entry.path) as job_entries:
+                    inputs.extend((entry.name, job_entry.name, job_entry.path) for job_entry in job_entries
+                                  if job_entry.is_file() and job_entry.name.lower().endswith(extensions))
+    return sorted(inputs, key=lambda item: (item[0] or '', item[1]))
+
+# Function to delete the job result records in results_dir older than max_age seconds
+def prune_job_results(results_dir, max_age=JOB_RETENTION_SECONDS, now=None):
+    if not os.path.isdir(results_dir):
+        return 0
+    cutoff = (now or time.time()) - max_age
+    pruned = 0
+    with os.scandir(results_dir) as entries:
+        for entry in entries:
+            job_id, extension = os.path.splitext(entry.name)
+            if extension == '.json' and is_job_id(job_id) and job_created_at(job_id) < cutoff:
+                os.remove(entry.path)
+                pruned += 1
+    return pruned
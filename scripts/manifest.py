@@ -0,0 +1,274 @@
+import os
+import json
+import hashlib
+from collections import deque
+from metadata_store import payload_key
+from result_cache import image_file_digest
+
+# Manifest of the processed inputs, so a rerun decodes only new or changed
+# images and appends their rows to the outputs instead of rewriting them.
+#
+# process/manifest.jsonl is an append-only JSON-lines file committed with the
+# outputs it describes, where later lines win:
+#   {"input": path, "size": ..., "mtime_ns": ..., "sha256": ...}
+#       the content hash of an input file at that size and mtime
+#   {"image": sha256, "payload": hex or null, "reference": version}
+#       what the image decoded to (null when it could not be decoded)
+#   {"output": path, "size": ..., "fingerprint": ..., "images": [sha256, ...], "version": ..., "rewritten": bool}
+#       the images whose rows were appended to an output (all of its images
+#       when it was rewritten), and the size and fingerprint of the output
+#       after the write (see output_fingerprint)
+# Paths are relative to the repository root.
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.abspath(os.path.join(SCRIPT_DIR, '..'))
+MANIFEST_PATH = os.path.join(ROOT_DIR, 'process', 'manifest.jsonl')
+
+# The manifest is rewritten without superseded lines once it has this many times more lines than entries
+COMPACT_RATIO = 2
+
+# New input hashes are written to the manifest in batches of this many lines
+DIGEST_BATCH_SIZE = 256
+
+# Number of trailing bytes of an output covered by its fingerprint
+TAIL_CHECK_BYTES = 4096
+
+# Function to get the manifest key of a file: its path relative to the repository root
+def manifest_key(path):
+    return os.path.relpath(os.path.abspath(path), ROOT_DIR).replace(os.sep, '/')
+
+# Function to apply one manifest line to the in-memory state
+def _apply(manifest, record):
+    if 'input' in record:
+        manifest['inputs'][record['input']] = record
+    elif 'image' in record:
+        manifest['images'][record['image']] = record
+    elif 'output' in record:
+        known = manifest['outputs'].get(record['output'])
+        images = {} if record.get('rewritten') or known is None else known['images']
+        images.update(dict.fromkeys(record['images']))  # An ordered set of the images in the output
+        manifest['outputs'][record['output']] = {'size': record['size'], 'fingerprint': record.get('fingerprint'),
+                                                 'version': record.get('version'), 'images': images}
+
+# Function to write the current state of the manifest as new lines, dropping superseded ones
+def _compact(manifest):
+    records = list(manifest['inputs'].values()) + list(manifest['images'].values())
+    records.extend({'output': output, 'size': state['size'], 'fingerprint': state['fingerprint'], 'images': list(state['images']),
+                    'version': state['version'], 'rewritten': True} for output, state in manifest['outputs'].items())
+    tmp_path = f"{manifest['path']}.{os.getpid()}.tmp"
+    with open(tmp_path, mode='w', encoding='utf-8') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+    os.replace(tmp_path, manifest['path'])
+    manifest['lines'] = len(records)
+
+# Function to load the manifest (an empty one when the file does not exist yet)
+#
+# Readers that only watch the pipeline pass compact=False, so the file is
+# never rewritten under a running pipeline.
+def load_manifest(path=MANIFEST_PATH, compact=True):
+    manifest = {'path': path, 'inputs': {}, 'images': {}, 'outputs': {}, 'lines': 0}
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # A line cut short by an interrupted run
+                _apply(manifest, record)
+                manifest['lines'] += 1
+        entries = len(manifest['inputs']) + len(manifest['images']) + len(manifest['outputs'])
+        if compact and manifest['lines'] > COMPACT_RATIO * entries + 100:
+            _compact(manifest)
+    return manifest
+
+# Function to append records to the manifest and apply them
+def _append(manifest, records):
+    if not records:
+        return
+    os.makedirs(os.path.dirname(manifest['path']), exist_ok=True)
+    with open(manifest['path'], mode='a', encoding='utf-8') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+    for record in records:
+        _apply(manifest, record)
+    manifest['lines'] += len(records)
+
+# Function to get the content hash of every file, hashing only files whose size or mtime changed
+#
+# Yields (file path, sha256) pairs as the files are read, so file_paths can be
+# a lazy directory scan; files that cannot be read are left out.
+def input_digests(manifest, file_paths):
+    records = []
+    for file_path in file_paths:
+        key = manifest_key(file_path)
+        try:
+            stat = os.stat(file_path)
+            known = manifest['inputs'].get(key)
+            if known and known['size'] == stat.st_size and known['mtime_ns'] == stat.st_mtime_ns:
+                yield file_path, known['sha256']
+                continue
+            digest = image_file_digest(file_path)
+        except OSError as e:
+            print(f"Failed to read {file_path}: {e}")
+            continue
+        records.append({'input': key, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': digest})
+        if len(records) >= DIGEST_BATCH_SIZE:
+            _append(manifest, records)
+            records = []
+        yield file_path, digest
+    _append(manifest, records)
+
+# Function to find the decode of an image made with the given reference data version
+#
+# Returns (found, payload): found is False when the image must be decoded,
+# payload is None for an image that could not be decoded.
+def known_payload(manifest, image_hash, reference_version):
+    record = manifest['images'].get(image_hash)
+    if record is None or record.get('reference') != reference_version:
+        return False, None
+    return True, None if record['payload'] is None else int(record['payload'], 16)
+
+# Function to get the last recorded payload of an image, whatever reference data it was decoded with
+def recorded_payload(manifest, image_hash):
+    record = manifest['images'].get(image_hash)
+    return None if record is None or record['payload'] is None else int(record['payload'], 16)
+
+# Function to record the payloads of decoded images, given as a {sha256: payload or None} dict
+def record_payloads(manifest, payloads, reference_version):
+    _append(manifest, [{'image': image_hash, 'payload': payload_key(payload), 'reference': reference_version}
+                       for image_hash, payload in payloads.items()])
+
+# Function to fingerprint the first size bytes of an output file from that size and their last TAIL_CHECK_BYTES
+#
+# Outputs are only written by the pipeline, which appends to them, so the
+# tail tells a run's own output from one replaced or cut short by hand.
+def output_fingerprint(output_path, size):
+    with open(output_path, mode='rb') as f:
+        f.seek(max(size - TAIL_CHECK_BYTES, 0))
+        digest = hashlib.sha256(f"{size}:".encode('utf-8'))
+        digest.update(f.read(min(size, TAIL_CHECK_BYTES)))
+        return digest.hexdigest()[:16]
+
+# Function to get the images whose rows an output already holds
+#
+# Returns (append, images): append is False when the output must be
+# rewritten, because it is missing, was not written through the manifest
+# (its recorded size and fingerprint no longer match) or was written with
+# another version (of the reference data or metadata its rows depend on). An
+# output longer than recorded holds the rows of an append whose run stopped
+# before recording it: it is cut back to its recorded size so those rows are
+# written again, once.
+def output_images(manifest, output_path, version=None):
+    state = manifest['outputs'].get(manifest_key(output_path))
+    if state is None:
+        return False, []
+    images = list(state['images'])
+    if state['version'] != version or not os.path.exists(output_path):
+        return False, images
+    size = os.path.getsize(output_path)
+    if size < state['size'] or output_fingerprint(output_path, state['size']) != state['fingerprint']:
+        return False, images
+    if size > state['size']:
+        with open(output_path, mode='r+b') as f:
+            f.truncate(state['size'])
+        print(f"Removed the rows of an unfinished run from {output_path}")
+    return True, images
+
+# Function to record the images whose rows were written to an output, after writing them
+def record_output(manifest, output_path, images, version=None, rewritten=False):
+    size = os.path.getsize(output_path)
+    _append(manifest, [{'output': manifest_key(output_path), 'size': size, 'fingerprint': output_fingerprint(output_path, size),
+                        'images': list(images), 'version': version, 'rewritten': rewritten}])
+
+# Function to map every image hash to the name its file was last seen under
+def image_file_names(manifest):
+    return {record['sha256']: os.path.basename(key) for key, record in manifest['inputs'].items()}
+
+# Function to yield the (sha256, file path) pair of every input whose image is not in held yet, once per image
+def _new_rows(digests, held):
+    planned = set(held)
+    for file_path, image_hash in digests:
+        if image_hash not in planned:
+            planned.add(image_hash)
+            yield image_hash, file_path
+
+# Function to plan the rows to write to an output for the given input files
+#
+# digests lists (file path, sha256) pairs, as input_digests yields them.
+# Returns (append, rows): append tells whether the rows go at the end of the
+# output or replace it, rows gives the (sha256, file path) pair of every row
+# to write, in order. Appended rows are planned lazily, as digests is read,
+# so a stream of inputs is never held in memory. A rewrite starts with the
+# images the output held before, with a file path of None when their file is
+# gone, so its rows are planned up front. Identical files give one row.
+def plan_output(manifest, output_path, digests, version=None):
+    append, held = output_images(manifest, output_path, version)
+    if append:
+        return True, _new_rows(digests, held)
+    file_paths = {}
+    for file_path, image_hash in digests:
+        file_paths.setdefault(image_hash, file_path)
+    held_images = set(held)
+    rows = [(image_hash, file_paths.get(image_hash)) for image_hash in held]
+    rows.extend((image_hash, file_path) for image_hash, file_path in file_paths.items() if image_hash not in held_images)
+    return False, rows
+
+# Function to get the payload of every planned row, decoding only the images not decoded before
+#
+# rows can be lazy: decode(file_paths) gets the files to decode as a lazy
+# iterable of paths and must yield (file path, payload) pairs in its order,
+# reading ahead only as far as it decodes, as decoding.iter_decrypt_images
+# does. lookup(sha256), when given, returns the payload of an image decoded
+# elsewhere, or None. Yields (sha256, file name, payload) in the order of
+# rows, where an image may appear more than once. Every decode is recorded as
+# soon as it arrives, so an interrupted run does not decode those images
+# again. Images whose file is gone keep their last recorded payload.
+def planned_payloads(manifest, rows, decode, reference_version, lookup=None):
+    read = deque()  # (sha256, file path, waits for a decode) of the rows decode read ahead of the output
+    pending = set()
+
+    # Function to read the rows, queueing every row and yielding the files to decode
+    def files_to_decode():
+        for image_hash, file_path in rows:
+            waits = file_path is not None and image_hash not in pending and not known_payload(manifest, image_hash, reference_version)[0]
+            if waits and lookup is not None:
+                payload = lookup(image_hash)
+                if payload is not None:
+                    record_payloads(manifest, {image_hash: payload}, reference_version)
+                    waits = False
+            read.append((image_hash, file_path, waits))
+            if waits:
+                pending.add(image_hash)
+                yield file_path
+
+    file_names = None  # Built on the first image whose file is gone
+
+    # Function to get the (sha256, file name, payload) of a row whose image was decoded before
+    def known_row(image_hash, file_path):
+        nonlocal file_names
+        found, payload = known_payload(manifest, image_hash, reference_version)
+        if not found:
+            payload = recorded_payload(manifest, image_hash)
+        if file_path is not None:
+            return image_hash, os.path.basename(file_path), payload
+        if file_names is None:
+            file_names = image_file_names(manifest)
+        return image_hash, file_names.get(image_hash, image_hash), payload
+
+    for _, payload in decode(files_to_decode()):
+        # The rows read before this decode come first, the decoded row last
+        image_hash, file_path, waits = read.popleft()
+        while not waits:
+            yield known_row(image_hash, file_path)
+            image_hash, file_path, waits = read.popleft()
+        record_payloads(manifest, {image_hash: payload}, reference_version)
+        yield image_hash, os.path.basename(file_path), payload
+    # Once decode is done every row was read
+    while read:
+        yield known_row(*read.popleft()[:2])
+
+# Function to pass (sha256, row) pairs through as rows, noting the image of every row in images
+def noting_images(rows, images):
+    for image_hash, row in rows:
+        images.append(image_hash)
+        yield row
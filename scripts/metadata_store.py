@@ -0,0 +1,153 @@
+import os
+import csv
+import json
+import hashlib
+import sqlite3
+from io import StringIO
+import requests
+from payload import pack_bit_string
+from reference_data import CACHE_DIR
+from http_cache import local_data_path
+
+# Default location of the local metadata store
+METADATA_DB_PATH = os.path.join(CACHE_DIR, 'metadata.sqlite3')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS metadata (
+    row_order INTEGER PRIMARY KEY,
+    token_id TEXT NOT NULL,
+    payload TEXT,
+    row_json TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS metadata_token_payload ON metadata (token_id, payload);
+CREATE TABLE IF NOT EXISTS sources (
+    url TEXT PRIMARY KEY,
+    header_json TEXT NOT NULL,
+    ingested_bytes INTEGER NOT NULL,
+    content_sha256 TEXT NOT NULL,
+    etag TEXT
+);
+'''
+
+# Function to open (creating it if needed) the local metadata store
+def open_metadata_store(db_path=METADATA_DB_PATH):
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    conn = sqlite3.connect(db_path)
+    # A store written before the content hash was kept is emptied, so the next refresh rebuilds it
+    columns = [column[1] for column in conn.execute('PRAGMA table_info(sources)')]
+    if columns and 'content_sha256' not in columns:
+        conn.executescript('DROP TABLE sources; DROP TABLE IF EXISTS metadata;')
+    conn.executescript(SCHEMA)
+    return conn
+
+# Function to turn a payload into the canonical key stored in the 'payload' column
+def payload_key(payload):
+    return None if payload is None else format(payload, 'x')
+
+# Function to hash the content of the TSV
+def content_sha256(content):
+    return hashlib.sha256(content).hexdigest()
+
+# Function to get the version of the TSV from its full content: the start of its sha256
+def content_version(content):
+    return content_sha256(content)[:16]
+
+# Function to read the full content of the TSV, from the URL or from the local data folder
+#
+# Returns (content, etag, not_modified); with an etag, an unchanged file is
+# not downloaded again.
+def read_tsv(url, etag=None, offline=False):
+    if offline:
+        with open(local_data_path(url), mode='rb') as f:
+            return f.read(), None, False
+
+    response = requests.get(url, headers={'If-None-Match': etag} if etag else {}, timeout=30)
+    if response.status_code == 304:
+        return b'', etag, True
+    response.raise_for_status()
+    return response.content, response.headers.get('ETag'), False
+
+# Function to insert parsed TSV rows into the store
+def insert_rows(conn, rows):
+    conn.executemany(
+        'INSERT INTO metadata (token_id, payload, row_json) VALUES (?, ?, ?)',
+        ((str(row.get('tokenID', '')).strip(),
+          payload_key(pack_bit_string(row.get('Bit String', ''))),
+          json.dumps(row, ensure_ascii=False)) for row in rows)
+    )
+
+# Function to rebuild the store from the full content of the TSV
+def rebuild_store(conn, url, content, etag):
+    text = content.decode('utf-8')
+    reader = csv.DictReader(StringIO(text), delimiter='\t')
+    rows = list(reader)
+    conn.execute('DELETE FROM metadata')
+    conn.execute('DELETE FROM sources WHERE url = ?', (url,))
+    insert_rows(conn, rows)
+    conn.execute('INSERT INTO sources (url, header_json, ingested_bytes, content_sha256, etag) VALUES (?, ?, ?, ?, ?)',
+                 (url, json.dumps(reader.fieldnames or []), len(content), content_sha256(content), etag))
+    return len(rows)
+
+# Function to bring the store up to date with the TSV, appending only the rows added since the last refresh
+#
+# The store remembers how many bytes of the TSV it has ingested and their
+# sha256. A refresh reads the whole file (nothing when the URL answers that
+# its ETag did not change); when it starts with exactly the ingested bytes,
+# ending on a complete row, only the bytes after them are parsed and
+# appended. Any other change, such as an edit anywhere in the file, triggers
+# a full rebuild, as does full_refresh=True. Returns the number of rows added.
+def refresh_metadata_store(conn, url, offline=False, full_refresh=False):
+    source = None if full_refresh else conn.execute(
+        'SELECT header_json, ingested_bytes, content_sha256, etag FROM sources WHERE url = ?', (url,)).fetchone()
+
+    with conn:
+        if source is None:
+            content, etag, _ = read_tsv(url, offline=offline)
+            return rebuild_store(conn, url, content, etag)
+
+        header_json, ingested_bytes, ingested_sha256, etag = source
+        content, new_etag, not_modified = read_tsv(url, etag, offline)
+        if not_modified:
+            return 0
+
+        ingested, new_bytes = content[:ingested_bytes], content[ingested_bytes:]
+        # New bytes after a last row without its line break would extend that row
+        if (len(ingested) < ingested_bytes or content_sha256(ingested) != ingested_sha256
+                or new_bytes and not ingested.endswith(b'\n')):
+            print(f"{url} changed before the last ingested row, rebuilding the metadata store.")
+            return rebuild_store(conn, url, content, new_etag)
+
+        header = json.loads(header_json)
+        rows = list(csv.DictReader(StringIO(new_bytes.decode('utf-8')), fieldnames=header, delimiter='\t'))
+        insert_rows(conn, rows)
+        conn.execute('UPDATE sources SET ingested_bytes = ?, content_sha256 = ?, etag = ? WHERE url = ?',
+                     (len(content), content_sha256(content), new_etag, url))
+        return len(rows)
+
+# Function to get the version of the TSV held by the store (see content_version), None before the first refresh
+def metadata_version(conn, url):
+    source = conn.execute('SELECT content_sha256 FROM sources WHERE url = ?', (url,)).fetchone()
+    return source[0][:16] if source else None
+
+# Function to get the column names of the TSV, in file order
+def metadata_columns(conn, url):
+    source = conn.execute('SELECT header_json FROM sources WHERE url = ?', (url,)).fetchone()
+    return json.loads(source[0]) if source else []
+
+# Function to find the metadata row of a token by tokenID and packed Bit String
+def find_metadata_row(conn, serial_number, payload):
+    if payload is None:
+        return None
+    found = conn.execute(
+        'SELECT row_json FROM metadata WHERE token_id = ? AND payload = ? ORDER BY row_order LIMIT 1',
+        (str(serial_number).strip(), payload_key(payload))).fetchone()
+    return json.loads(found[0]) if found else None
+
+# Function to count the metadata rows of a tokenID, for diagnostics
+def count_token_rows(conn, serial_number):
+    return conn.execute('SELECT COUNT(*) FROM metadata WHERE token_id = ?', (str(serial_number).strip(),)).fetchone()[0]
+
+# Function to iterate over every metadata row, in file order
+def metadata_rows(conn):
+    for (row_json,) in conn.execute('SELECT row_json FROM metadata ORDER BY row_order'):
+        yield json.loads(row_json)
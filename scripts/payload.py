@@ -0,0 +1,97 @@
+import numpy as np
+
+# Number of bits carried by a token, one per dot (TOTAL_DOTS in data/inventory.csv)
+TOKEN_BITS = 140
+
+# A token payload is a plain Python int holding the dot bits, first dot as
+# the most significant bit. Equality and hashing work directly on the int;
+# the '0'/'1' string form is produced only when writing or reading CSVs.
+
+# Function to pack a bit matrix (N, bits) into its np.packbits buffer (N, ceil(bits / 8))
+def pack_bit_matrix(bits):
+    return np.packbits(np.asarray(bits, dtype=np.uint8), axis=-1)
+
+# Function to turn one packed row back into an integer payload
+def packed_to_payload(packed_row, width=TOKEN_BITS):
+    padding = len(packed_row) * 8 - width  # np.packbits pads the last byte on the right
+    return int.from_bytes(bytes(packed_row), 'big') >> padding
+
+# Function to convert every row of a bit matrix into an integer payload
+def bit_matrix_to_payloads(bits):
+    bits = np.asarray(bits, dtype=np.uint8)
+    width = bits.shape[-1]
+    return [packed_to_payload(row, width) for row in pack_bit_matrix(bits.reshape(-1, width))]
+
+# Function to convert a '0'/'1' bit string into an integer payload
+def bit_string_to_payload(bit_string):
+    return int(bit_string, 2)
+
+# Function to convert an integer payload into its '0'/'1' bit string (CSV edge only)
+def payload_to_bit_string(payload, width=TOKEN_BITS):
+    return format(payload, f'0{width}b')
+
+# Function to clean and compare strings safely, preserving leading zeros
+def clean_string(s):
+    if not isinstance(s, str):
+        s = str(s)  # Convert to string if not already a string
+    return s.strip().replace("\n", "").replace("\r", "").replace("\t", "").replace(" ", "")
+
+# Function to pack a cleaned bit string into a payload, None when it is not a bit string
+def pack_bit_string(bit_string):
+    bit_string = clean_string(bit_string)
+    if not bit_string or set(bit_string) - {'0', '1'}:
+        return None
+    return bit_string_to_payload(bit_string)
+
+# Function to extract the bits [start, stop) of a payload with a shift and a mask
+def extract_field(payload, start, stop, width=TOKEN_BITS):
+    return (payload >> (width - stop)) & ((1 << (stop - start)) - 1)
+
+# Bit layout of a token: field name, first bit, end bit, scale divisor and offset
+# (scaled fields decode as value / scale + offset, the others are plain integers)
+TOKEN_LAYOUT = (
+    ('latitude', 0, 25, 100000, -90),
+    ('longitude', 25, 51, 100000, -180),
+    ('date_number', 51, 68, None, 0),
+    ('impact_quantity', 68, 98, None, 0),
+    ('project_value', 98, 102, None, 0),
+    ('impact_value', 102, 106, None, 0),
+)
+
+# Number of leading bits covered by the layout
+LAYOUT_BITS = max(stop for _, _, stop, _, _ in TOKEN_LAYOUT)
+
+# Function to decode one payload into a dict of fields following the layout
+def parse_token_fields(payload, width=TOKEN_BITS, layout=TOKEN_LAYOUT):
+    fields = {}
+    for name, start, stop, scale, offset in layout:
+        value = extract_field(payload, start, stop, width)
+        fields[name] = (value / scale) + offset if scale else value
+    return fields
+
+# Function to compile a layout into a vectorized parser for (N, bits) bit matrices
+#
+# The parser returns a structured array with one column per field and the
+# scaling already applied, so a whole batch is parsed with one matrix-vector
+# product per field instead of one dict per token.
+def compile_layout(layout=TOKEN_LAYOUT):
+    dtype = np.dtype([(name, np.float64 if scale else np.int64) for name, _, _, scale, _ in layout])
+    # Weights turn each run of bits (most significant first) into its integer value
+    columns = [(name, start, stop, scale, offset, np.left_shift(1, np.arange(stop - start - 1, -1, -1), dtype=np.int64))
+               for name, start, stop, scale, offset in layout]
+    layout_bits = max(stop for _, _, stop, _, _ in layout)
+
+    def parse(bits):
+        bits = np.asarray(bits, dtype=np.uint8)
+        if bits.ndim != 2 or bits.shape[1] < layout_bits:
+            raise ValueError(f"Expected an (N, >= {layout_bits}) bit matrix, got shape {bits.shape}")
+        parsed = np.empty(len(bits), dtype=dtype)
+        for name, start, stop, scale, offset, weights in columns:
+            values = bits[:, start:stop] @ weights
+            parsed[name] = (values / scale) + offset if scale else values
+        return parsed
+
+    return parse
+
+# Vectorized parser for the token layout
+parse_bit_matrix = compile_layout()
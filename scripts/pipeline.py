@@ -0,0 +1,384 @@
+import os
+import json
+import time
+import argparse
+from collections import namedtuple
+from decoding import iter_decrypt_images
+from folder_watch import watch_input_batches
+from instrumentation import add_instrumentation_arguments, run_instrumented, span
+from jobs import JOB_RESULTS_DIR, job_result_path, list_job_inputs, prune_job_results
+from manifest import input_digests, known_payload, load_manifest, plan_output, planned_payloads, record_output
+from metadata_store import open_metadata_store, refresh_metadata_store, metadata_columns, metadata_version
+from payload import LAYOUT_BITS, parse_token_fields, payload_to_bit_string
+from reference_data import load_reference_data
+from result_cache import open_result_cache, set_cache_versions, lookup_image, store_image, store_merged_rows
+from result_wait import LATEST_RESULT_PATH
+import script1
+import script2
+import script3
+
+# Outputs the pipeline can produce, by name, all of them by default
+OUTPUTS = ('decrypted', 'binary', 'merged')
+
+# How often the watch mode checks metadata.tsv for new rows
+METADATA_REFRESH_SECONDS = 300
+
+# One decoded token, carried in memory from the decoder to every output
+#
+# fields holds the parsed layout (see payload.TOKEN_LAYOUT), reference_names
+# the (project type, impact unit) from data/creation.csv as in script1.py,
+# and metadata_names the same pair from metadata.tsv as in script2.py.
+# image_hash is the sha256 of the image bytes
+# and job_id the upload job the image belongs to (None outside a job).
+TokenRecord = namedtuple('TokenRecord', ['file_name', 'image_hash', 'payload', 'fields', 'reference_names', 'metadata_names', 'job_id'])
+
+# Function to decode every image once and parse it into token records
+#
+# planned lists (sha256, file path) pairs, as manifest.plan_output returns:
+# images recorded in the manifest are not decoded again, nor are images found
+# in the result cache, and a file path of None stands for an image whose file
+# is gone, which keeps its recorded payload. job_ids maps file paths to the
+# job they were uploaded with.
+def decode_records(planned, manifest, reference, workers=None, offline=False, with_metadata_names=True, result_cache=None, job_ids=None):
+    DOT_COLORS, TOTAL_DOTS = reference['dot_colors'], reference['total_dots']
+    dot_positions = reference['dot_positions']
+    project_type_map, impact_unit_map = reference['project_type_map'], reference['impact_unit_map']
+    image_hashes = {file_path: image_hash for image_hash, file_path in planned}
+
+    # No more workers than images that may need decoding
+    unknown_count = sum(1 for image_hash, file_path in planned
+                        if file_path is not None and not known_payload(manifest, image_hash, reference['version'])[0])
+    decode_workers = min(workers or os.cpu_count() or 1, max(unknown_count, 1))
+
+    # Decode in order, keeping every payload for later runs in the result cache as soon as it is done
+    def decode(file_paths):
+        for file_path, payload in iter_decrypt_images(script2.decrypt_image, file_paths, dot_positions, DOT_COLORS, TOTAL_DOTS, decode_workers):
+            if payload is not None and result_cache is not None:
+                store_image(result_cache, image_hashes[file_path], payload)
+            yield file_path, payload
+
+    # Images another run left in the result cache are not decoded again
+    lookup = None if result_cache is None else (lambda image_hash: lookup_image(result_cache, image_hash))
+
+    records = []
+    payloads = planned_payloads(manifest, planned, decode, reference['version'], lookup)
+    for (_, file_path), (image_hash, file_name, payload) in zip(planned, payloads):
+        if payload is None:
+            print(f"Failed to decrypt {file_name}")
+            continue
+        # Pad to the layout length with leading zeros if necessary, as script1.py does
+        with span('parse'):
+            data = parse_token_fields(payload, max(TOTAL_DOTS, LAYOUT_BITS))
+        reference_names = (project_type_map.get(data['project_value'], 'Unknown Project Type'),
+                           impact_unit_map.get(data['impact_value'], 'Unknown Impact Unit'))
+        metadata_names = None
+        if with_metadata_names:
+            metadata_names = script2.map_values_to_names(data['project_value'], data['impact_value'], script2.CREATION_TSV_URL, offline)
+        records.append(TokenRecord(file_name, image_hash, payload, data, reference_names, metadata_names,
+                                   (job_ids or {}).get(file_path)))
+        print(f"Decrypted data for {file_name}: {data}")
+    return records
+
+# Function to turn records into the rows of 'decrypted_data.csv' (PNG files only, as script1.py reads)
+def decrypted_rows(records):
+    for record in records:
+        if record.file_name.endswith('.png'):
+            yield {
+                'latitude': record.fields['latitude'],
+                'longitude': record.fields['longitude'],
+                'date_number': record.fields['date_number'],
+                'impact_quantity': record.fields['impact_quantity'],
+                'project_type': record.reference_names[0],
+                'impact_unit': record.reference_names[1]
+            }
+
+# Function to turn records into the rows of 'decrypted_data_with_binary.csv'
+def binary_rows(records):
+    for record in records:
+        yield {
+            'Latitude': record.fields['latitude'],
+            'Longitude': record.fields['longitude'],
+            'Serial Number': record.fields['date_number'],
+            'Impact Quantity': record.fields['impact_quantity'],
+            'Project Type': record.metadata_names[0],
+            'Impact Unit': record.metadata_names[1],
+            'Binary Code': record.payload
+        }
+
+# Function to write a JSON file atomically, so a reader never sees a partial result
+def write_json_file(path, data):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, mode='w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+# Function to write the last merged row to latest.json, the one the dashboard shows when nothing was uploaded
+#
+# Results of single images are read from the job records instead (see
+# save_job_results), so the per-image JSON files earlier versions wrote next
+# to latest.json are removed.
+def save_latest_result(row, width):
+    results_dir = os.path.join(script2.ROOT_DIR, os.path.dirname(LATEST_RESULT_PATH))
+    os.makedirs(results_dir, exist_ok=True)
+    write_json_file(os.path.join(script2.ROOT_DIR, LATEST_RESULT_PATH), {**row, 'Binary Code': payload_to_bit_string(row['Binary Code'], width)})
+    with os.scandir(results_dir) as entries:
+        for entry in entries:
+            if entry.is_file() and entry.name.endswith('.json') and entry.path != os.path.join(script2.ROOT_DIR, LATEST_RESULT_PATH):
+                os.remove(entry.path)
+
+# Function to write the result record of every job in job_inputs
+#
+# job_inputs lists (job id, file name) pairs. Each upload job gets
+# process/jobs/<job id>.json with the status of each of its images: 'matched'
+# (with its merged row), 'unmatched' (decoded but not in the metadata),
+# 'failed' (could not be decoded) or, when merged_by_payload is None because
+# no metadata could be loaded, 'no_metadata', so a client waits for its own
+# record only.
+def save_job_results(job_inputs, records, merged_by_payload, width):
+    records_by_input = {(record.job_id, record.file_name): record for record in records}
+    jobs = {}
+    for job_id, file_name in job_inputs:
+        if job_id is None:
+            continue
+        record = records_by_input.get((job_id, file_name))
+        row = merged_by_payload.get(record.payload) if record and merged_by_payload is not None else None
+        if merged_by_payload is None:
+            status = 'no_metadata'
+        else:
+            status = 'failed' if record is None else 'unmatched' if row is None else 'matched'
+        jobs.setdefault(job_id, []).append({
+            'file_name': file_name,
+            'status': status,
+            'row': None if row is None else {**row, 'Binary Code': payload_to_bit_string(row['Binary Code'], width)}
+        })
+    if not jobs:
+        return
+    os.makedirs(os.path.join(script2.ROOT_DIR, JOB_RESULTS_DIR), exist_ok=True)
+    for job_id, images in jobs.items():
+        write_json_file(os.path.join(script2.ROOT_DIR, job_result_path(job_id)), {'job_id': job_id, 'images': images})
+    print(f"Saved the results of {len(jobs)} upload jobs.")
+
+# Function to pass merged rows through while keeping the first row of every payload
+def collect_merged_rows(rows, merged_by_payload):
+    for row in rows:
+        merged_by_payload.setdefault(row['Binary Code'], row)
+        yield row
+
+# Function to bring the metadata store up to date, dropping the merged output when no metadata can be loaded
+def refresh_metadata(pipeline, offline=False):
+    metadata_store = pipeline['metadata_store']
+    try:
+        with span('metadata_fetch'):
+            added_rows = refresh_metadata_store(metadata_store, script3.METADATA_TSV_URL, offline)
+        print(f"Metadata store refreshed, {added_rows} new rows.")
+    except Exception as e:
+        print(f"Failed to refresh metadata, using the local store: {e}")
+    pipeline['metadata_refreshed_at'] = time.monotonic()
+    pipeline['metadata_failed'] = not metadata_columns(metadata_store, script3.METADATA_TSV_URL)
+    if pipeline['metadata_failed']:
+        print("Failed to load metadata.")
+        pipeline['outputs'].discard('merged')
+    else:
+        set_cache_versions(pipeline['result_cache'], metadata_version=metadata_version(metadata_store, script3.METADATA_TSV_URL))
+
+# Function to load what every run over the input images needs once: reference data, caches, metadata store and manifest
+#
+# Returns a dict holding them and the outputs that can be written, or None
+# when the reference data cannot be fetched.
+def open_pipeline(outputs=OUTPUTS, offline=False):
+    outputs = set(outputs)
+
+    # Fetch parameters, loaded from the compiled reference data unless a source file changed
+    reference = load_reference_data(lambda file_name: script2.fetch_reference_source(file_name, offline))
+    if reference is None:
+        print("Failed to fetch the reference data.")
+        return None
+    if reference['total_dots'] < LAYOUT_BITS and outputs & {'binary', 'merged'}:
+        # script2.py refuses bit strings shorter than the layout, so only script1's output can be written
+        print("Bit string is shorter than expected.")
+        outputs -= {'binary', 'merged'}
+
+    # Payloads and merged rows of earlier runs, dropped when the reference data or metadata.tsv change
+    result_cache = open_result_cache()
+    set_cache_versions(result_cache, reference_version=reference['version'])
+    pipeline = {'outputs': outputs, 'reference': reference, 'result_cache': result_cache, 'metadata_store': None,
+                'metadata_failed': False, 'manifest': load_manifest()}
+
+    # Bring the metadata store up to date before decoding, so a missing metadata file fails fast
+    if 'merged' in outputs:
+        pipeline['metadata_store'] = open_metadata_store()
+        refresh_metadata(pipeline, offline)
+    return pipeline
+
+# Function to decode the given input images once, merge them and write every output
+#
+# input_images lists (job id, file name, path) tuples, as jobs.list_job_inputs returns.
+def process_images(pipeline, input_images, workers=None, offline=False):
+    outputs, reference = pipeline['outputs'], pipeline['reference']
+    result_cache, metadata_store = pipeline['result_cache'], pipeline['metadata_store']
+    if pipeline['metadata_failed']:
+        # Without metadata nothing is merged, but every job still gets its record so its client stops waiting
+        save_job_results([(job_id, file_name) for job_id, file_name, _ in input_images], [], None, reference['total_dots'])
+        prune_job_results(os.path.join(script2.ROOT_DIR, JOB_RESULTS_DIR))
+    if 'binary' not in outputs and 'merged' not in outputs:
+        input_images = [image for image in input_images if image[1].endswith('.png')]
+    if not input_images or not outputs:
+        print("No images found in the input directory." if outputs else "No outputs to write.")
+        return
+
+    # Plan the rows every output is missing: all of them when it has to be rewritten, else those of new images
+    file_paths = [file_path for _, _, file_path in input_images]
+    job_ids = {file_path: job_id for job_id, _, file_path in input_images}
+    manifest = pipeline['manifest']
+    with span('manifest'):
+        digests = dict(input_digests(manifest, file_paths))
+    output_paths = {
+        'decrypted': os.path.join(script1.OUTPUT_FOLDER, 'decrypted_data.csv'),
+        'binary': os.path.join(script2.PROCESS_DIR, 'decrypted_data_with_binary.csv'),
+        'merged': os.path.join(script2.PROCESS_DIR, 'merged_data_with_metadata.csv')
+    }
+    versions = {'decrypted': reference['version'], 'binary': reference['version']}
+    if 'merged' in outputs:
+        # Any edit of metadata.tsv changes its version, so the merged output is rewritten rather than appended to
+        versions['merged'] = f"{reference['version']}:{metadata_version(metadata_store, script3.METADATA_TSV_URL)}"
+    plans = {}
+    for output in outputs:
+        # script1.py reads PNG files only
+        output_digests = [(file_path, image_hash) for file_path, image_hash in digests.items()
+                          if output != 'decrypted' or file_path.endswith('.png')]
+        append, rows = plan_output(manifest, output_paths[output], output_digests, versions[output])
+        plans[output] = (append, list(rows))
+
+    # Decode every image of every pending job at most once, in parallel when more than one worker is requested;
+    # the images of a rewritten output whose file is gone come from the manifest
+    planned = [(digests[file_path], file_path) for file_path in file_paths if file_path in digests]
+    planned_images = set(digests.values())
+    for _, rows in plans.values():
+        for image_hash, file_path in rows:
+            if file_path is None and image_hash not in planned_images:
+                planned_images.add(image_hash)
+                planned.append((image_hash, None))
+    records = decode_records(planned, manifest, reference, workers, offline, bool(outputs & {'binary', 'merged'}), result_cache, job_ids)
+    records_by_hash = {}
+    for record in records:
+        records_by_hash.setdefault(record.image_hash, record)
+
+    # Function to get the records of the rows an output is missing, in order, and whether they are appended
+    def output_records(output):
+        append, rows = plans[output]
+        return append, [records_by_hash[image_hash] for image_hash, _ in rows if image_hash in records_by_hash]
+
+    # Function to record the rows written to an output in the manifest
+    def record_rows(output, written_records, append, row_count):
+        if row_count or append:
+            record_output(manifest, output_paths[output], [record.image_hash for record in written_records],
+                          versions[output], rewritten=not append)
+
+    if 'decrypted' in outputs:
+        append, new_records = output_records('decrypted')
+        if append and not new_records:
+            print(f"Every image is already in {output_paths['decrypted']}.")
+        else:
+            row_count = script1.save_to_local_file(decrypted_rows(new_records), append)
+            record_rows('decrypted', new_records, append, row_count)
+            if not row_count:
+                print("No data decrypted.")
+
+    if 'binary' in outputs:
+        append, new_records = output_records('binary')
+        output_file_path = output_paths['binary']
+        if append and not new_records:
+            print(f"Every image is already in {output_file_path}.")
+        else:
+            row_count = script2.save_to_csv(binary_rows(new_records), output_file_path, reference['total_dots'], append)
+            record_rows('binary', new_records, append, row_count)
+            if row_count:
+                print(f"Decrypted data saved to {output_file_path}")
+            else:
+                print("No data to save.")
+
+    if 'merged' in outputs:
+        # The merge reads the records directly instead of decrypted_data_with_binary.csv
+        append, new_records = output_records('merged')
+        merged_by_payload = {}
+        if append and not new_records:
+            print(f"Every image is already in {output_paths['merged']}.")
+        else:
+            merged_rows = store_merged_rows(result_cache, script3.merged_rows(binary_rows(new_records), metadata_store))
+            matched_count = script3.save_to_csv(collect_merged_rows(merged_rows, merged_by_payload),
+                                                script3.merged_headers(metadata_store), append)
+            # Unmatched images are recorded too, so they are merged again only once the metadata changes
+            record_rows('merged', new_records, append, matched_count)
+            if matched_count > 0:
+                print(f"Successfully matched and merged {matched_count} entries.")
+                latest_payload = next(record.payload for record in reversed(new_records) if record.payload in merged_by_payload)
+                save_latest_result(merged_by_payload[latest_payload], reference['total_dots'])
+            else:
+                print("No successful matches found to save.")
+        # Images already in the merged output still give their row to the jobs they were uploaded with again
+        new_images = {record.image_hash for record in new_records}
+        earlier_records = [record for record in records if record.job_id is not None and record.image_hash not in new_images]
+        for _ in collect_merged_rows(script3.merged_rows(binary_rows(earlier_records), metadata_store), merged_by_payload):
+            pass
+        # Every job gets its record, also when none of its images matched
+        save_job_results([(job_id, file_name) for job_id, file_name, _ in input_images], records,
+                         merged_by_payload, reference['total_dots'])
+        prune_job_results(os.path.join(script2.ROOT_DIR, JOB_RESULTS_DIR))
+
+# Function to process the images of the input directory as they arrive, in micro-batches, until interrupted
+#
+# The reference data, value names and metadata store stay loaded between
+# batches; the metadata store is refreshed every METADATA_REFRESH_SECONDS.
+def watch_input_directory(pipeline, workers=None, offline=False):
+    print(f"Watching {script2.INPUT_DIR} for new images, press Ctrl+C to stop.")
+    try:
+        for batch, inputs in watch_input_batches(script2.INPUT_DIR, script2.IMAGE_EXTENSIONS):
+            if 'merged' in pipeline['outputs'] and time.monotonic() - pipeline['metadata_refreshed_at'] > METADATA_REFRESH_SECONDS:
+                refresh_metadata(pipeline, offline)
+            # The images of a job processed earlier go with the batch, so its result record lists all of them
+            batch_paths = {path for _, _, path in batch}
+            batch_jobs = {job_id for job_id, _, _ in batch if job_id is not None}
+            batch = batch + [image for image in inputs if image[0] in batch_jobs and image[2] not in batch_paths]
+            started = time.monotonic()
+            try:
+                with span('batch', images=len(batch)):
+                    process_images(pipeline, batch, workers, offline)
+            except Exception as e:
+                print(f"Failed to process a batch of {len(batch)} images: {e}")
+                continue
+            print(f"Processed a batch of {len(batch)} images in {time.monotonic() - started:.3f} s.")
+    except KeyboardInterrupt:
+        print("Stopped watching the input directory.")
+
+# Function to parse the command line options
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Decrypt token images once and write the requested CSV outputs.')
+    parser.add_argument('--outputs', nargs='+', choices=OUTPUTS, default=list(OUTPUTS),
+                        help='Outputs to write: decrypted (decrypted_data.csv), binary (decrypted_data_with_binary.csv) '
+                             'and merged (merged_data_with_metadata.csv). Default: all of them')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='Number of worker processes used to decode images (default: number of cores)')
+    parser.add_argument('--offline', action='store_true',
+                        help='Read the reference files and metadata from the local data folder instead of GitHub')
+    parser.add_argument('--watch', action='store_true',
+                        help='Keep running and process the images of the input directory in micro-batches as they arrive')
+    add_instrumentation_arguments(parser)
+    return parser.parse_args()
+
+# Main pipeline function: decode, map names, merge metadata and write the outputs in one process
+def main(outputs=OUTPUTS, workers=None, offline=False, watch=False):
+    pipeline = open_pipeline(outputs, offline)
+    if pipeline is None:
+        return
+    if watch:
+        os.makedirs(script2.INPUT_DIR, exist_ok=True)
+        watch_input_directory(pipeline, workers, offline)
+        return
+
+    # Check if there are images in the input directory, directly or in the folder of an upload job
+    process_images(pipeline, list_job_inputs(script2.INPUT_DIR, script2.IMAGE_EXTENSIONS), workers, offline)
+
+# Run the main function
+if __name__ == '__main__':
+    args = parse_arguments()
+    run_instrumented(args, main, outputs=args.outputs, workers=args.workers, offline=args.offline, watch=args.watch)
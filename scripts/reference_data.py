@@ -0,0 +1,124 @@
+import os
+import csv
+import hashlib
+from io import StringIO
+import numpy as np
+from instrumentation import span
+
+# Define the directories
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.abspath(os.path.join(SCRIPT_DIR, '..'))
+DATA_FOLDER = os.path.join(ROOT_DIR, 'data')
+CACHE_DIR = os.path.join(ROOT_DIR, '.cache')
+
+# Source files compiled into the reference data artifact
+REFERENCE_FILES = ('inventory.csv', 'dot_positions.csv', 'creation.csv')
+
+# Reference data already loaded in this process, keyed by content hash
+_loaded_references = {}
+
+# Function to read a reference file from the local data folder
+def read_local_source(file_name):
+    with open(os.path.join(DATA_FOLDER, file_name), mode='rb') as f:
+        return f.read()
+
+# Function to parse DOT_COLORS and TOTAL_DOTS from the text of 'inventory.csv'
+def parse_parameters(csv_content):
+    dot_colors = []
+    total_dots = None
+    reader = csv.DictReader(StringIO(csv_content))
+    for row in reader:
+        if row['Parameter'] == 'DOT_COLORS':
+            # Handle multiple color tuples
+            colors = row['Value'].split(';')
+            for color_str in colors:
+                color_tuple = tuple(map(int, color_str.strip('() ').split(',')))
+                dot_colors.append(color_tuple)
+        elif row['Parameter'] == 'TOTAL_DOTS':
+            total_dots = int(row['Value'])
+    return dot_colors, total_dots
+
+# Function to parse the dot positions from the text of 'dot_positions.csv'
+def parse_dot_positions(csv_content):
+    dot_positions = []
+    reader = csv.DictReader(StringIO(csv_content))
+    for row in reader:
+        x = int(row['x'])
+        y = int(row['y'])
+        dot_positions.append((x, y))
+    return dot_positions
+
+# Function to parse the project type and impact unit maps from the text of 'creation.csv'
+def parse_mappings(csv_content):
+    project_type_map = {}
+    impact_unit_map = {}
+    reader = csv.DictReader(StringIO(csv_content))
+    for row in reader:
+        if 'Project Value' in row and row['Project Value']:
+            project_value = int(row['Project Value'])
+            project_type = row['PROJECT_TYPE_MAP']
+            project_type_map[project_value] = project_type
+        if 'Impact Value' in row and row['Impact Value']:
+            impact_value = int(row['Impact Value'])
+            impact_unit = row['IMPACT_UNIT_MAP']
+            impact_unit_map[impact_value] = impact_unit
+    return project_type_map, impact_unit_map
+
+# Function to compile the parsed reference files into an .npz artifact
+def compile_reference_data(sources, artifact_path):
+    dot_colors, total_dots = parse_parameters(sources['inventory.csv'].decode('utf-8'))
+    dot_positions = parse_dot_positions(sources['dot_positions.csv'].decode('utf-8'))
+    project_type_map, impact_unit_map = parse_mappings(sources['creation.csv'].decode('utf-8'))
+
+    tmp_path = f"{artifact_path}.{os.getpid()}.tmp.npz"
+    np.savez(
+        tmp_path,
+        dot_positions=np.asarray(dot_positions, dtype=np.int32).reshape(-1, 2),
+        dot_colors=np.asarray(dot_colors, dtype=np.int32).reshape(-1, 3),
+        total_dots=np.int64(-1 if total_dots is None else total_dots),
+        project_values=np.asarray(list(project_type_map.keys()), dtype=np.int64),
+        project_types=np.asarray(list(project_type_map.values()), dtype=str),
+        impact_values=np.asarray(list(impact_unit_map.keys()), dtype=np.int64),
+        impact_units=np.asarray(list(impact_unit_map.values()), dtype=str),
+    )
+    os.replace(tmp_path, artifact_path)  # Publish atomically so concurrent runs never see a partial artifact
+
+# Function to load the compiled reference data, rebuilding it only when a source file changes
+#
+# read_source(file_name) returns the raw bytes of one of REFERENCE_FILES (or
+# None when it cannot be read). The artifact is keyed by the hash of those
+# bytes, so an unchanged set of sources is loaded from .cache/ without any
+# CSV parsing. Returns None when a source is missing.
+def load_reference_data(read_source=read_local_source):
+    sources = {}
+    for file_name in REFERENCE_FILES:
+        with span('reference_fetch', file=file_name):
+            sources[file_name] = read_source(file_name)
+    if any(content is None for content in sources.values()):
+        return None
+
+    digest = hashlib.sha256()
+    for file_name in REFERENCE_FILES:
+        digest.update(f"{file_name}:{len(sources[file_name])}:".encode('utf-8'))
+        digest.update(sources[file_name])
+    key = digest.hexdigest()[:16]
+
+    reference = _loaded_references.get(key)
+    if reference is None:
+        with span('config_load', version=key):
+            artifact_path = os.path.join(CACHE_DIR, f"reference_{key}.npz")
+            if not os.path.exists(artifact_path):
+                os.makedirs(CACHE_DIR, exist_ok=True)
+                compile_reference_data(sources, artifact_path)
+            with np.load(artifact_path) as artifact:
+                total_dots = int(artifact['total_dots'])
+                reference = {
+                    'dot_positions': artifact['dot_positions'],
+                    'dot_colors': [tuple(int(v) for v in color) for color in artifact['dot_colors']],
+                    'total_dots': None if total_dots < 0 else total_dots,
+                    'project_type_map': dict(zip(artifact['project_values'].tolist(), artifact['project_types'].tolist())),
+                    'impact_unit_map': dict(zip(artifact['impact_values'].tolist(), artifact['impact_units'].tolist())),
+                    'version': key,  # Content hash of the source files
+                }
+        _loaded_references[key] = reference
+    return reference
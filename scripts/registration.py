@@ -0,0 +1,407 @@
+import numpy as np
+
+# Registration of camera-captured token scans, in NumPy only.
+#
+# A photo of a token is rotated, skewed and offset, so the dots are not at
+# their reference positions. The homography that maps the reference dot
+# layout onto the photo is estimated from the dots themselves, coarse to
+# fine on a max-pooled pyramid of the photo, and only the dot coordinates
+# are warped (the photo is never resampled).
+
+# Longest side of the coarsest pyramid level, where the dots are first detected
+COARSE_SIZE = 384
+
+# Half width of the window searched for each dot at every pyramid level, in pixels of that level
+SEARCH_RADIUS = 2
+
+# Smallest dot pitch, in pixels of a level, at which the dots are detected on that level
+# and at which the fit is refined on it (the dots are told apart by their windows)
+MIN_DETECTION_PITCH = 3
+MIN_LEVEL_PITCH = 6
+
+# Largest dot pitch, in pixels of a level, worth refining on: finer levels of a
+# high resolution photo only add cost, the dot patches are wider than the error
+MAX_LEVEL_PITCH = 32
+
+# Radius around the layout center, in dot pitches, within which an initial
+# alignment is first fitted to the detected dots; it doubles with every pass
+FIRST_FIT_PITCHES = 3
+
+# Passes that fit an initial alignment to the detected dots, and most shifts
+# by one dot pitch applied to it, then refinement passes on the level the fit
+# starts on and on every finer one
+ALIGNMENT_ITERATIONS = 6
+MAX_PITCH_SHIFTS = 4
+COARSE_ITERATIONS = 4
+FINE_ITERATIONS = 2
+
+# Smallest fraction of the layout that must be found for a fit to be trusted
+MIN_MATCHED_FRACTION = 0.8
+
+# Largest contrast just outside the layout, relative to the dots, for a fit to be
+# accepted: a fit shifted by one dot pitch puts dots on those guard positions
+MAX_GUARD_RATIO = 0.5
+
+# Function to halve a channel with 2x2 max pooling, which keeps small bright dots visible
+def max_pool(channel):
+    height, width = channel.shape[0] // 2 * 2, channel.shape[1] // 2 * 2
+    rows = np.maximum(channel[0:height:2, :width], channel[1:height:2, :width])
+    return np.maximum(rows[:, 0::2], rows[:, 1::2])
+
+# Function to build the max-pooled pyramid of an image, finest level first, down to about COARSE_SIZE
+#
+# The pyramid is built on the green channel only: it carries most of the
+# brightness, the dots are far brighter than the background in it, and one
+# uint8 channel pools several times faster than RGB.
+def image_pyramid(pixels, coarse_size=COARSE_SIZE):
+    levels = [pixels[..., 1]]
+    while max(levels[-1].shape) >= 2 * coarse_size:
+        levels.append(max_pool(levels[-1]))
+    return levels
+
+# Function to sum a map over the (2 * radius + 1) square around every pixel
+#
+# The integral image is int64, so it stays exact for an image of any size.
+def _box_sums(values, radius):
+    integral = np.pad(values, radius + 1, mode='edge').cumsum(axis=0, dtype=np.int64).cumsum(axis=1, dtype=np.int64)
+    size = 2 * radius + 1
+    sums = integral[size:, size:] - integral[:-size, size:] - integral[size:, :-size] + integral[:-size, :-size]
+    return sums[:values.shape[0], :values.shape[1]]
+
+# Function to subtract the local mean of a (2 * radius + 1) square from every pixel of a uint8 channel
+def local_contrast(channel, radius):
+    size = 2 * radius + 1
+    return channel - _box_sums(channel, radius).astype(np.float32) / (size * size)
+
+# Function to find the strongest local maxima of a map as an (n, 2) array of (x, y) positions
+#
+# A plateau of equal values keeps only its first pixel in raster order.
+def strongest_peaks(response, count):
+    inner = response[1:-1, 1:-1]
+    peak = inner > 0
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            if dy or dx:
+                neighbour = response[1 + dy:response.shape[0] - 1 + dy, 1 + dx:response.shape[1] - 1 + dx]
+                peak &= inner > neighbour if (dy, dx) < (0, 0) else inner >= neighbour
+    ys, xs = np.nonzero(peak)
+    if len(ys) > count:
+        keep = np.argpartition(inner[ys, xs], len(ys) - count)[len(ys) - count:]
+        ys, xs = ys[keep], xs[keep]
+    return np.column_stack((xs + 1, ys + 1)).astype(np.float64)
+
+# Function to detect the dots of a pyramid level as the strongest peaks of its local contrast
+#
+# Each peak is moved to the top of the parabola through it and its two
+# neighbours, along x and along y: on a coarse level whole pixels are a good
+# part of the dot pitch, and rounded dots skew the directions between them.
+def detect_dots(level, count):
+    contrast = local_contrast(level, 2 * SEARCH_RADIUS)
+    peaks = strongest_peaks(contrast, count)
+    xs, ys = peaks[:, 0].astype(np.intp), peaks[:, 1].astype(np.intp)
+    for axis, (dx, dy) in enumerate(((1, 0), (0, 1))):
+        before, center, after = contrast[ys - dy, xs - dx], contrast[ys, xs], contrast[ys + dy, xs + dx]
+        curvature = before - 2 * center + after
+        peaks[:, axis] += np.where(curvature < 0, (before - after) / (2 * np.minimum(curvature, -1e-6)), 0)
+    return peaks
+
+# Function to apply a 3x3 homography to an (n, 2) array of points
+def apply_homography(homography, points):
+    mapped = np.column_stack((points, np.ones(len(points)))) @ homography.T
+    return mapped[:, :2] / mapped[:, 2:3]
+
+# Function to get the squared distances between every point of a and every point of b, an (len(a), len(b)) array
+def _squared_distances(a, b):
+    return np.maximum(np.einsum('ij,ij->i', a, a)[:, np.newaxis] + np.einsum('ij,ij->i', b, b) - 2 * a @ b.T, 0)
+
+# Function to fit the affine map (as a homography) that maps src onto dst (both (n, 2), n >= 3) by least squares
+def fit_affine(src, dst):
+    solution = np.linalg.lstsq(np.column_stack((src, np.ones(len(src)))), dst, rcond=None)[0]
+    return np.vstack((solution.T, (0, 0, 1)))
+
+# Function to get the similarity transform that centers and scales points to a mean distance of sqrt(2)
+def _normalizing_transform(points):
+    center = points.mean(axis=0)
+    scale = np.sqrt(2) / max(np.linalg.norm(points - center, axis=1).mean(), 1e-12)
+    return np.array([[scale, 0, -scale * center[0]], [0, scale, -scale * center[1]], [0, 0, 1]])
+
+# Function to fit the homography that maps src onto dst (both (n, 2), n >= 4) with the normalized DLT
+def fit_homography(src, dst, weights=None):
+    src_norm, dst_norm = _normalizing_transform(src), _normalizing_transform(dst)
+    s = apply_homography(src_norm, src)
+    d = apply_homography(dst_norm, dst)
+    zeros, ones = np.zeros(len(s)), np.ones(len(s))
+    rows_x = np.column_stack((s[:, 0], s[:, 1], ones, zeros, zeros, zeros, -d[:, 0] * s[:, 0], -d[:, 0] * s[:, 1], -d[:, 0]))
+    rows_y = np.column_stack((zeros, zeros, zeros, s[:, 0], s[:, 1], ones, -d[:, 1] * s[:, 0], -d[:, 1] * s[:, 1], -d[:, 1]))
+    system = np.vstack((rows_x, rows_y))
+    if weights is not None:
+        system *= np.sqrt(np.concatenate((weights, weights)))[:, np.newaxis]
+    # The solution is the eigenvector of the 9x9 normal matrix with the smallest eigenvalue
+    homography = np.linalg.eigh(system.T @ system)[1][:, 0].reshape(3, 3)
+    homography = np.linalg.inv(dst_norm) @ homography @ src_norm
+    return homography / homography[2, 2]
+
+# Function to get the dot pitch of a layout: the median distance from a dot to its nearest neighbour
+def layout_pitch(layout):
+    differences = layout[:, np.newaxis] - layout[np.newaxis]
+    squared = np.einsum('ijk,ijk->ij', differences, differences)
+    np.fill_diagonal(squared, np.inf)
+    return float(np.sqrt(np.median(squared.min(axis=1))))
+
+# Function to get the vectors between all the neighbouring points of a grid, along a row or a column
+#
+# The distance to the nearest neighbour alone is the least of about four
+# noisy distances, so it comes out short. All the pairs within 0.7 to 1.25
+# times the median of those are taken instead: every neighbour along a row
+# or column, no diagonal one.
+def _neighbour_differences(points):
+    differences = points[np.newaxis] - points[:, np.newaxis]
+    distances = np.sqrt(np.einsum('ijk,ijk->ij', differences, differences))
+    np.fill_diagonal(distances, np.inf)
+    nearest = np.median(distances.min(axis=1))
+    return differences[(distances >= 0.7 * nearest) & (distances <= 1.25 * nearest)]
+
+# Function to get the typical distance between neighbouring points of a grid
+def neighbour_spacing(points):
+    return float(np.linalg.norm(_neighbour_differences(points), axis=1).mean())
+
+# Function to get the steps of a grid of points: the 2x2 matrix of the mean vectors to the next point along a row and a column
+#
+# The vectors between neighbouring points (see _neighbour_differences) run
+# along the rows or the columns, so their angles agree modulo a quarter turn:
+# the row angle is the one of the mean of the unit vectors at four times
+# those angles. Each vector is then counted to the rows or the columns, whichever
+# it is closer to, and turned to point right or down of that angle. The
+# steps of a photographed grid differ in length and are not square, which
+# a single scale and angle would miss.
+def grid_steps(points):
+    vectors = _neighbour_differences(points)
+    angle = np.angle(np.exp(4j * np.arctan2(vectors[:, 1], vectors[:, 0])).sum()) / 4
+    along = vectors @ np.array([np.cos(angle), np.sin(angle)])
+    across = vectors @ np.array([-np.sin(angle), np.cos(angle)])
+    rows = np.abs(along) >= np.abs(across)
+    return np.column_stack(((vectors[rows] * np.sign(along[rows])[:, np.newaxis]).mean(axis=0),
+                            (vectors[~rows] * np.sign(across[~rows])[:, np.newaxis]).mean(axis=0)))
+
+# Function to find the offset that puts the most points of src (already mapped by a linear map) onto dst
+#
+# Every (src, dst) pair votes for the offset dst - src. The votes are counted
+# on a grid of cells of half the tolerance, each cell with its neighbours so a
+# cluster cut by the grid counts whole. Returns the mean of the votes within
+# tolerance of the fullest cell, and their number.
+def vote_offset(src, dst, tolerance):
+    votes = (dst[:, np.newaxis] - src[np.newaxis]).reshape(-1, 2)
+    origin = votes.min(axis=0)
+    cells = np.floor((votes - origin) / (tolerance / 2)).astype(np.intp)
+    width, height = cells.max(axis=0) + 1
+    counts = np.bincount(cells[:, 1] * width + cells[:, 0], minlength=width * height).reshape(height, width)
+    y, x = np.unravel_index(_box_sums(counts, 1).argmax(), counts.shape)
+    near = np.linalg.norm(votes - (origin + (np.array([x, y]) + 0.5) * tolerance / 2), axis=1) < tolerance
+    return votes[near].mean(axis=0), int(near.sum())
+
+# Function to improve an alignment by fitting it to the detected dot nearest to every mapped layout dot
+#
+# An initial alignment is right near the layout center only (its scale and
+# angle are rough), so the pairs closer than tolerance are first fitted
+# within FIRST_FIT_PITCHES dot pitches of the center, and that radius doubles
+# with every pass. The fit is an affine map while fewer than a quarter of
+# the dots pair up (they may not fix a homography), then a homography. It
+# stops when fewer than 8 dots pair up.
+def fit_to_dots(homography, layout, dots, pitch, tolerance):
+    distances = np.linalg.norm(layout - layout.mean(axis=0), axis=1)
+    radius = FIRST_FIT_PITCHES * pitch
+    for _ in range(ALIGNMENT_ITERATIONS):
+        squared = _squared_distances(apply_homography(homography, layout), dots)
+        nearest = squared.argmin(axis=1)
+        paired = (squared[np.arange(len(layout)), nearest] < tolerance ** 2) & (distances <= radius)
+        if paired.sum() < 8:
+            break
+        fit = fit_homography if 4 * paired.sum() >= len(layout) else fit_affine
+        homography = fit(layout[paired], dots[nearest[paired]])
+        radius *= 2
+    return homography
+
+# Function to get the positions one dot pitch outside the layout (next to it, never on it)
+#
+# Returns one array of positions per direction (right, left, down, up), so a
+# fit that is off by one pitch in any direction puts dots on one whole group.
+def guard_positions(layout, pitch):
+    def far_from_layout(points):
+        differences = points[:, np.newaxis] - layout[np.newaxis]
+        return np.einsum('ijk,ijk->ij', differences, differences).min(axis=1) > (pitch / 2) ** 2
+
+    return [candidates[far_from_layout(candidates)]
+            for candidates in (layout + step for step in ((pitch, 0), (-pitch, 0), (0, pitch), (0, -pitch)))]
+
+# Function to score homographies by the layout dots they put within tolerance of a detected dot, less the guard positions
+def placement_scores(homographies, layout, guards, dots, tolerance):
+    points = np.vstack((layout, guards))
+    mapped = np.vstack([apply_homography(homography, points) for homography in homographies])
+    on_dots = (_squared_distances(mapped, dots).min(axis=1) < tolerance ** 2).reshape(len(homographies), -1)
+    return on_dots[:, :len(layout)].sum(axis=1) - on_dots[:, len(layout):].sum(axis=1)
+
+# Function to fit an alignment to the detected dots and correct it when it is off by whole dot pitches
+#
+# Within the layout a fit shifted by one pitch still puts most dots on dots,
+# so the fitted alignment (see fit_to_dots) is scored with placement_scores
+# against the dots found on the guard positions around the layout (see
+# guard_positions). A wrong fit stretches to put more dots on dots than the
+# right shift of it does before it is fitted, so the best of its eight
+# shifts by one pitch is fitted and taken when it then scores higher, until
+# none does (at most MAX_PITCH_SHIFTS times). Returns the homography and its
+# score.
+def snap_to_layout(homography, layout, guards, dots, pitch, tolerance):
+    shifts = [np.array([[1, 0, dx * pitch], [0, 1, dy * pitch], [0, 0, 1]])
+              for dy in (-1, 0, 1) for dx in (-1, 0, 1) if dx or dy]
+    homography = fit_to_dots(homography, layout, dots, pitch, tolerance)
+    score = placement_scores([homography], layout, guards, dots, tolerance)[0]
+    for _ in range(MAX_PITCH_SHIFTS):
+        shifted = [homography @ shift for shift in shifts]
+        best = shifted[placement_scores(shifted, layout, guards, dots, tolerance).argmax()]
+        best = fit_to_dots(best, layout, dots, pitch, tolerance)
+        best_score = placement_scores([best], layout, guards, dots, tolerance)[0]
+        if best_score <= score:
+            break
+        homography, score = best, best_score
+    return homography, score
+
+# Function to get the candidate affine maps (as homographies) that place the layout on the detected dots
+#
+# The steps of the detected grid (see grid_steps) give the map of the layout
+# steps up to which of them is the row and their signs, so the four quarter
+# turns are tried, then the four of the mirrored layout. The offset of each
+# comes from vote_offset, then each is fitted to the dots (see
+# snap_to_layout). Returns the (homography, score) pairs in that order.
+def initial_alignments(layout, dots, pitch):
+    dot_steps, layout_steps = grid_steps(dots), grid_steps(layout)
+    tolerance = neighbour_spacing(dots) / 2
+    center = layout.mean(axis=0)
+    guards = np.concatenate(guard_positions(layout, pitch))
+    alignments = []
+    for mirror in (1, -1):
+        for quarter in range(4):
+            turn = np.linalg.matrix_power(np.array([[0, -1], [1, 0]]), quarter) @ np.diag([mirror, 1])
+            linear = dot_steps @ turn @ np.linalg.inv(layout_steps)
+            offset = vote_offset((layout - center) @ linear.T, dots, tolerance)[0]
+            homography = np.vstack((np.column_stack((linear, offset - linear @ center)), (0, 0, 1)))
+            alignments.append(snap_to_layout(homography, layout, guards, dots, pitch, tolerance))
+    return alignments
+
+# Function to get the half width of the dot search windows of a level, a third of the dot pitch there
+#
+# Windows narrower than half the pitch never reach the next dot, and wider
+# than the dots themselves so their median is the background.
+def search_radius(homography, layout, pitch, level_scale):
+    level_pitch = pitch * np.median(local_scales(homography, layout)) / level_scale
+    return max(SEARCH_RADIUS, int(level_pitch / 3))
+
+# Function to locate the dot in the window around each point of a pyramid level
+#
+# Returns the (n, 2) dot centers, the centroid of the window pixels brighter
+# than halfway between the window median and maximum, the contrast of every
+# dot (maximum minus median) and its extent (the number of those pixels).
+# Points whose window leaves the image get contrast 0.
+def window_peaks(level, points, radius=SEARCH_RADIUS):
+    offsets = np.arange(-radius, radius + 1)
+    offset_y, offset_x = (grid.ravel() for grid in np.meshgrid(offsets, offsets, indexing='ij'))
+    centers = np.rint(points).astype(np.intp)
+    xs = centers[:, 0:1] + offset_x
+    ys = centers[:, 1:2] + offset_y
+    inside = (xs.min(axis=1) >= 0) & (ys.min(axis=1) >= 0) & (xs.max(axis=1) < level.shape[1]) & (ys.max(axis=1) < level.shape[0])
+    windows = level[np.clip(ys, 0, level.shape[0] - 1), np.clip(xs, 0, level.shape[1] - 1)].astype(np.float32)
+    background = np.median(windows, axis=1)
+    contrast = windows.max(axis=1) - background
+    weights = np.clip(windows - (background + contrast / 2)[:, np.newaxis], 0, None)
+    extent = np.count_nonzero(weights, axis=1)
+    weights[extent == 0] = 1  # Flat windows keep their center
+    peaks = centers + np.column_stack((weights @ offset_x, weights @ offset_y)) / weights.sum(axis=1)[:, np.newaxis]
+    return peaks, np.where(inside, contrast, 0), extent
+
+# Function to refine a homography at one pyramid level by matching every dot to the dot found near it
+#
+# Returns the refined homography and the contrast and extent of every dot on
+# that level (see window_peaks).
+def refine_homography(homography, level, layout, pitch, level_scale, iterations):
+    contrast = extent = np.zeros(len(layout))
+    for _ in range(iterations):
+        points = apply_homography(homography, layout) / level_scale
+        peaks, contrast, extent = window_peaks(level, points, search_radius(homography, layout, pitch, level_scale))
+        matched = contrast > 0.25 * max(np.median(contrast), 1e-6)
+        if matched.sum() < max(8, MIN_MATCHED_FRACTION * len(layout)):
+            break
+        # A pooled pixel covers level_scale pixels of the image, its center is the best estimate
+        targets = (peaks[matched] + 0.5) * level_scale - 0.5
+        homography = fit_homography(layout[matched], targets, contrast[matched])
+    return homography, contrast, extent
+
+# Function to estimate the homography that maps the reference dot layout onto a photo
+#
+# layout is the (n, 2) array of reference (x, y) dot centers. The dots are
+# detected on the coarsest pyramid level on which they are at least
+# MIN_DETECTION_PITCH apart (see detect_dots) and every candidate of
+# initial_alignments that puts MIN_MATCHED_FRACTION of the layout on them is
+# refined on the coarsest level on which they are MIN_LEVEL_PITCH apart; the
+# one whose dots have the most contrast is kept, the first one of equals (the
+# layout may look the same mirrored). A mirrored fit (negative determinant)
+# reads every dot from the wrong place, so it is rejected. The fit is then
+# refined level by level down to the full resolution, or to the level on
+# which the dots are MAX_LEVEL_PITCH apart. Returns the homography, the
+# contrast of every dot and its extent in full resolution pixels. Raises
+# ValueError when the layout cannot be found in the image, or only mirrored.
+def register_layout(pixels, layout):
+    layout = np.asarray(layout, dtype=np.float64)
+    pitch = layout_pitch(layout)
+    levels = image_pyramid(pixels)
+    start = len(levels) - 1
+    while True:
+        dots = detect_dots(levels[start], len(layout))
+        if len(dots) < len(layout) * MIN_MATCHED_FRACTION:
+            raise ValueError(f"Found {len(dots)} dot candidates, expected {len(layout)}")
+        dot_pitch = neighbour_spacing(dots)
+        if start == 0 or dot_pitch >= MIN_DETECTION_PITCH:
+            break
+        start -= 1
+    dots = (dots + 0.5) * 2 ** start - 0.5
+    image_pitch = dot_pitch * 2 ** start
+    while start > 0 and image_pitch / 2 ** start < MIN_LEVEL_PITCH:
+        start -= 1
+    end = 0
+    while end < start and image_pitch / 2 ** end > MAX_LEVEL_PITCH:
+        end += 1
+    level_scale = 2 ** start
+
+    best = None
+    for homography, placed in initial_alignments(layout, dots, pitch):
+        if placed < MIN_MATCHED_FRACTION * len(layout):
+            continue
+        refined = refine_homography(homography, levels[start], layout, pitch, level_scale, COARSE_ITERATIONS)
+        score = np.clip(refined[1], 0, None).sum()
+        if best is None or score > best[0]:
+            best = (score, refined)
+    if best is None:
+        raise ValueError("The dot layout could not be registered: no alignment puts it on the dots")
+    homography, contrast, extent = best[1]
+    if np.linalg.det(homography[:2, :2]) < 0:
+        raise ValueError("The dot layout could not be registered: it only fits the image mirrored")
+
+    for level in range(start - 1, end - 1, -1):
+        homography, contrast, extent = refine_homography(homography, levels[level], layout, pitch, 2 ** level, FINE_ITERATIONS)
+
+    matched = contrast > 0.25 * max(np.median(contrast), 1e-6)
+    if matched.mean() < MIN_MATCHED_FRACTION:
+        raise ValueError(f"Only {int(matched.sum())} of {len(layout)} dots were found in the image")
+    dot_contrast = np.median(contrast[matched])
+    radius = search_radius(homography, layout, pitch, 2 ** end)
+    for guards in guard_positions(layout, pitch):
+        guard_contrast = window_peaks(levels[end], apply_homography(homography, guards) / 2 ** end, radius)[1]
+        if len(guards) and np.median(guard_contrast) > MAX_GUARD_RATIO * dot_contrast:
+            raise ValueError("The dot layout could not be registered: dots were found next to it")
+    return homography, contrast, extent * 4 ** end
+
+# Function to get the local scale of a homography at every point: the square root of its area change
+def local_scales(homography, points):
+    mapped = np.column_stack((points, np.ones(len(points)))) @ homography.T
+    w = mapped[:, 2]
+    # Determinant of the Jacobian of the projective map at each point
+    jacobian_det = np.linalg.det(homography) / w ** 3
+    return np.sqrt(np.abs(jacobian_det))
@@ -0,0 +1,140 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+from http_cache import fetch_url_cached
+from metadata_store import content_version, payload_key
+from payload import TOKEN_BITS, payload_to_bit_string
+from reference_data import CACHE_DIR
+
+# Default location of the result cache, shared by the dashboards and the batch scripts
+RESULT_CACHE_PATH = os.path.join(CACHE_DIR, 'results.sqlite3')
+
+# Largest number of entries kept per table, least recently used entries are evicted first
+MAX_CACHE_ENTRIES = 10000
+
+# How long a long-running process trusts its copy of metadata.tsv before revalidating it
+METADATA_CHECK_SECONDS = 300
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS images (
+    image_hash TEXT PRIMARY KEY,
+    payload TEXT NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS images_last_used ON images (last_used);
+CREATE TABLE IF NOT EXISTS results (
+    payload TEXT PRIMARY KEY,
+    row_json TEXT NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used);
+CREATE TABLE IF NOT EXISTS versions (
+    name TEXT PRIMARY KEY,
+    version TEXT NOT NULL
+);
+'''
+
+# Tables emptied when the version of their source changes:
+# decoded payloads depend on the reference data, merged rows on metadata.tsv
+VERSIONED_TABLES = {'reference': 'images', 'metadata': 'results'}
+
+# Function to open (creating it if needed) the result cache
+def open_result_cache(db_path=RESULT_CACHE_PATH):
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.executescript(SCHEMA)
+    return conn
+
+# Function to compute the content key of an uploaded image
+def image_digest(image_bytes):
+    return hashlib.sha256(image_bytes).hexdigest()
+
+# Function to compute the content key of an image file
+def image_file_digest(image_path):
+    with open(image_path, mode='rb') as f:
+        return image_digest(f.read())
+
+# Function to record the current reference data and metadata versions, dropping the entries they invalidate
+#
+# A version left as None is not checked. Returns True when entries were dropped.
+def set_cache_versions(conn, reference_version=None, metadata_version=None):
+    invalidated = False
+    with conn:
+        for name, version in (('reference', reference_version), ('metadata', metadata_version)):
+            if version is None:
+                continue
+            known = conn.execute('SELECT version FROM versions WHERE name = ?', (name,)).fetchone()
+            if known and known[0] == version:
+                continue
+            if known:
+                conn.execute(f"DELETE FROM {VERSIONED_TABLES[name]}")
+                invalidated = True
+            conn.execute('INSERT OR REPLACE INTO versions (name, version) VALUES (?, ?)', (name, version))
+    return invalidated
+
+# Function to get the version of metadata.tsv, revalidating the local copy at most every max_age seconds
+#
+# The version hashes the full content, the same as metadata_store.metadata_version,
+# so any edit of the file invalidates the merged rows.
+def fetch_metadata_version(url, offline=False, max_age=METADATA_CHECK_SECONDS):
+    content = fetch_url_cached(url, offline, max_age)
+    if content is None:
+        return None
+    return content_version(content)
+
+# Function to find the payload decoded from an image, None on a miss
+def lookup_image(conn, image_hash):
+    with conn:
+        found = conn.execute('SELECT payload FROM images WHERE image_hash = ?', (image_hash,)).fetchone()
+        if found is None:
+            return None
+        conn.execute('UPDATE images SET last_used = ? WHERE image_hash = ?', (time.time(), image_hash))
+    return int(found[0], 16)
+
+# Function to find the merged metadata row of a payload, None on a miss
+def lookup_result(conn, payload):
+    key = payload_key(payload)
+    with conn:
+        found = conn.execute('SELECT row_json FROM results WHERE payload = ?', (key,)).fetchone()
+        if found is None:
+            return None
+        conn.execute('UPDATE results SET last_used = ? WHERE payload = ?', (time.time(), key))
+    return json.loads(found[0])
+
+# Function to find the merged metadata row of an uploaded image, None on a miss
+def lookup_image_result(conn, image_bytes):
+    payload = lookup_image(conn, image_digest(image_bytes))
+    return None if payload is None else lookup_result(conn, payload)
+
+# Function to remember the payload decoded from an image
+def store_image(conn, image_hash, payload):
+    with conn:
+        conn.execute('INSERT OR REPLACE INTO images (image_hash, payload, last_used) VALUES (?, ?, ?)',
+                     (image_hash, payload_key(payload), time.time()))
+        evict_least_recently_used(conn, 'images')
+
+# Function to remember the merged metadata row of a payload
+def store_result(conn, payload, row):
+    with conn:
+        conn.execute('INSERT OR REPLACE INTO results (payload, row_json, last_used) VALUES (?, ?, ?)',
+                     (payload_key(payload), json.dumps(row, ensure_ascii=False), time.time()))
+        evict_least_recently_used(conn, 'results')
+
+# Function to keep a table within MAX_CACHE_ENTRIES by dropping its least recently used entries
+def evict_least_recently_used(conn, table, max_entries=MAX_CACHE_ENTRIES):
+    excess = conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] - max_entries
+    if excess > 0:
+        conn.execute(f"DELETE FROM {table} WHERE rowid IN (SELECT rowid FROM {table} ORDER BY last_used LIMIT ?)",
+                     (excess,))
+
+# Function to pass merged rows through while caching each one under its payload
+#
+# Rows are stored as they are written to the CSV, with the bit string form
+# of 'Binary Code', so a cache hit can be shown like a row read from it.
+def store_merged_rows(conn, rows, width=TOKEN_BITS):
+    for row in rows:
+        if row['Binary Code'] is not None:
+            store_result(conn, row['Binary Code'], {**row, 'Binary Code': payload_to_bit_string(row['Binary Code'], width)})
+        yield row
@@ -0,0 +1,130 @@
+import os
+import time
+import requests
+from github_batch import GITHUB_API_BASE, github_headers
+from jobs import IMAGE_EXTENSIONS, job_result_path, list_job_inputs
+from manifest import ROOT_DIR, load_manifest, manifest_key
+
+# Base URL of raw file downloads, overridable to run against a local stand-in
+GITHUB_RAW_BASE = os.getenv('GITHUB_RAW_BASE', 'https://raw.githubusercontent.com').rstrip('/')
+
+# Latest merged row written by the pipeline, shown by the dashboard when nothing was uploaded
+LATEST_RESULT_PATH = 'process/results/latest.json'
+
+# Polling schedule: first check after INITIAL_POLL_SECONDS, then backing off up to MAX_POLL_SECONDS
+INITIAL_POLL_SECONDS = 2
+MAX_POLL_SECONDS = 15
+POLL_BACKOFF = 1.5
+WAIT_TIMEOUT_SECONDS = 300
+
+# Function to poll check() until it returns something other than None, with exponential backoff
+#
+# progress(elapsed, timeout), when given, is called before every wait so a UI
+# can show how long it has been waiting. Returns the first non-None result,
+# or None when timeout seconds pass without one.
+def wait_for(check, timeout=WAIT_TIMEOUT_SECONDS, initial_interval=INITIAL_POLL_SECONDS,
+             max_interval=MAX_POLL_SECONDS, backoff=POLL_BACKOFF, progress=None,
+             sleep=time.sleep, clock=time.monotonic):
+    started = clock()
+    interval = initial_interval
+    while True:
+        result = check()
+        if result is not None:
+            return result
+        elapsed = clock() - started
+        if elapsed >= timeout:
+            return None
+        if progress:
+            progress(elapsed, timeout)
+        sleep(min(interval, timeout - elapsed))
+        interval = min(interval * backoff, max_interval)
+
+# Function to get the raw URL of a repository file at a given commit or branch
+def raw_file_url(repo, ref, path, raw_base=None):
+    return f"{raw_base or GITHUB_RAW_BASE}/{repo}/{ref}/{path}"
+
+# Function to get the state of the workflow runs started by an upload: None while any is pending,
+# otherwise 'success' or the conclusion of the first run that did not succeed
+def upload_run_conclusion(session, repo_url, upload_sha):
+    response = session.get(f"{repo_url}/actions/runs", params={"head_sha": upload_sha})
+    response.raise_for_status()
+    runs = response.json().get('workflow_runs', [])
+    if not runs or any(run['status'] != 'completed' for run in runs):
+        return None
+    for run in runs:
+        if run['conclusion'] != 'success':
+            return run['conclusion']
+    return 'success'
+
+# Function to wait for the result record of an upload job (see pipeline.save_job_results)
+#
+# The record is read through the contents API at the branch head: raw
+# downloads are served from a cache that can lag behind the branch. A
+# workflow run may be cancelled in favour of a later one that processes the
+# job too, so only a failed run of upload_sha (when given) ends the wait
+# early. Returns a dict with 'state' ('ready' with the 'job' record, 'failed'
+# with the run 'conclusion', or 'timeout').
+def wait_for_job_result(repo, branch, job_id, token, upload_sha=None, timeout=WAIT_TIMEOUT_SECONDS, progress=None,
+                        api_base=None):
+    repo_url = f"{api_base or GITHUB_API_BASE}/repos/{repo}"
+    session = requests.Session()
+    session.headers.update(github_headers(token))
+
+    def check():
+        try:
+            response = session.get(f"{repo_url}/contents/{job_result_path(job_id)}", params={"ref": branch},
+                                   headers={"Accept": "application/vnd.github.raw"}, timeout=30)
+            if response.status_code != 404:
+                response.raise_for_status()
+                return {'state': 'ready', 'job': response.json()}
+            conclusion = upload_run_conclusion(session, repo_url, upload_sha) if upload_sha else None
+        except (requests.RequestException, ValueError) as e:
+            print(f"Failed to check the result of job {job_id}, retrying: {e}")
+            return None
+        if conclusion not in (None, 'success', 'cancelled'):
+            return {'state': 'failed', 'conclusion': conclusion}
+        return None
+
+    return wait_for(check, timeout, progress=progress) or {'state': 'timeout'}
+
+# Function to tell whether the pipeline has processed an image of the input folder, from the marks its run leaves
+#
+# The image of an upload job is processed once the job has its result record
+# (see pipeline.save_job_results). Any other image is processed once the
+# manifest holds the hash of its current content (same size and mtime) and
+# either lists that hash in the merged output, which it does for matched,
+# unmatched and earlier merged images alike, or records that it could not be
+# decoded.
+def image_processed(manifest, merged_path, job_id, path):
+    if job_id is not None:
+        return os.path.exists(os.path.join(ROOT_DIR, job_result_path(job_id)))
+    stat = os.stat(path)
+    known = manifest['inputs'].get(manifest_key(path))
+    if known is None or known['size'] != stat.st_size or known['mtime_ns'] != stat.st_mtime_ns:
+        return False
+    merged = manifest['outputs'].get(manifest_key(merged_path))
+    if merged is not None and known['sha256'] in merged['images']:
+        return True
+    image = manifest['images'].get(known['sha256'])
+    return image is not None and image['payload'] is None
+
+# Function to wait until the pipeline has processed every image in input_dir and its job folders
+#
+# This is the local stand-in for wait_for_job_result. Uploads that match
+# nothing, or were merged before, leave merged_path as it is, so the wait is
+# on the marks of each image's run (see image_processed) rather than on the
+# file. Returns merged_path, or None on timeout.
+def wait_for_local_result(merged_path, input_dir, timeout=WAIT_TIMEOUT_SECONDS, progress=None):
+    def check():
+        if not os.path.isdir(input_dir):
+            return merged_path
+        try:
+            manifest = load_manifest(compact=False)
+            inputs = list_job_inputs(input_dir, IMAGE_EXTENSIONS)
+            if all(image_processed(manifest, merged_path, job_id, path) for job_id, _, path in inputs):
+                return merged_path
+        except OSError:
+            pass  # An input was removed during the scan, look again at the next poll
+        return None
+
+    return wait_for(check, timeout, progress=progress)
@@ -2,6 +2,8 @@ import os
 import streamlit as st
 import requests
 import base64
+from github_batch import replace_directory_in_one_commit
+from jobs import new_job_id, job_input_dir
 import time
 
 # Define GitHub repository details
@@ -9,73 +11,15 @@ GITHUB_REPO = "releafs/decryption"
 GITHUB_BRANCH = "main"
 GITHUB_TOKEN = st.secrets["GITHUB_TOKEN"]
 
-input_directory_in_github = "decryption/input/"
+# Add the files of an upload in one commit (set GITHUB_BATCHED_UPLOAD=0 for one commit per file)
+BATCHED_UPLOAD = os.getenv("GITHUB_BATCHED_UPLOAD", "1") != "0"
 
-# Function to create a placeholder file if the directory does not exist
-def create_placeholder_file():
-    file_name = ".gitkeep"  # Placeholder file name
-    content = base64.b64encode(b'').decode('utf-8')  # Empty file content
-    url = f"https://api.github.com/repos/{GITHUB_REPO}/contents/{input_directory_in_github}{file_name}"
-    data = {
-        "message": "Create input directory with placeholder file",
-        "content": content,
-        "branch": GITHUB_BRANCH
-    }
-    response = requests.put(url, json=data, headers={
-        "Authorization": f"token {GITHUB_TOKEN}",
-        "Accept": "application/vnd.github.v3+json"
-    })
-    if response.status_code in [201, 200]:
-        st.write(f"Created {file_name} in {input_directory_in_github}.")
-    else:
-        st.error(f"Failed to create placeholder file. Response: {response.status_code}, {response.text}")
-
-# Function to delete all files in the input directory
-def clear_input_directory():
-    GITHUB_API_URL = f"https://api.github.com/repos/{GITHUB_REPO}/contents/{input_directory_in_github}"
-    response = requests.get(GITHUB_API_URL, headers={
-        "Authorization": f"token {GITHUB_TOKEN}",
-        "Accept": "application/vnd.github.v3+json"
-    })
-    if response.status_code == 200:
-        files = response.json()
-        if len(files) == 0:
-            st.write("Directory is already empty.")
-        else:
-            for file in files:
-                file_name = file['name']
-                sha = file['sha']
-                delete_response = delete_file_in_github(file_name, sha)
-                if delete_response.status_code == 200:
-                    st.write(f"Deleted {file_name} successfully.")
-                else:
-                    st.error(f"Failed to delete {file_name}. Response: {delete_response.status_code}")
-    elif response.status_code == 404:
-        st.warning(f"Directory {input_directory_in_github} not found, creating it...")
-        create_placeholder_file()
-    else:
-        st.error(f"Failed to list files in directory. Response: {response.status_code}")
-
-# Function to delete a file in the GitHub repository
-def delete_file_in_github(file_name, sha):
-    GITHUB_API_URL = f"https://api.github.com/repos/{GITHUB_REPO}/contents/{input_directory_in_github}{file_name}"
-    data = {
-        "message": f"Delete {file_name}",
-        "sha": sha,
-        "branch": GITHUB_BRANCH
-    }
-    response = requests.delete(GITHUB_API_URL, json=data, headers={
-        "Authorization": f"token {GITHUB_TOKEN}",
-        "Accept": "application/vnd.github.v3+json"
-    })
-    return response
-
-# Function to upload the file to GitHub
-def upload_file_to_github(file_name, file_content):
+# Function to upload the file to GitHub, into the input folder of its job
+def upload_file_to_github(file_name, file_content, job_id):
     encoded_content = base64.b64encode(file_content).decode("utf-8")  # Base64 encode the file content
-    url = f"https://api.github.com/repos/{GITHUB_REPO}/contents/{input_directory_in_github}{file_name}"
+    url = f"https://api.github.com/repos/{GITHUB_REPO}/contents/{job_input_dir(job_id)}/{file_name}"
     data = {
-        "message": f"Upload {file_name}",
+        "message": f"Upload {file_name} (job {job_id})",
         "content": encoded_content,
         "branch": GITHUB_BRANCH
     }
@@ -102,17 +46,25 @@ with col2:
 
     if uploaded_file is not None:
         st.write(f"File selected: {uploaded_file.name} ({uploaded_file.size / 1024:.2f} KB)")
-        st.write("Clearing input directory...")
-        clear_input_directory()
         file_name = uploaded_file.name
         file_content = uploaded_file.getvalue()  # Get the content of the file
 
-        response = upload_file_to_github(file_name, file_content)
-
-        if response.status_code in [201, 200]:
-            st.success(f"File {file_name} uploaded/updated successfully!")
+        # Every upload goes to the input folder of its own job, leaving other users' uploads alone
+        job_id = new_job_id()
+        if BATCHED_UPLOAD:
+            try:
+                replace_directory_in_one_commit(GITHUB_REPO, GITHUB_BRANCH, job_input_dir(job_id),
+                                                {file_name: file_content}, f"Upload {file_name} (job {job_id})", GITHUB_TOKEN)
+                st.success(f"File {file_name} uploaded/updated successfully! Job: {job_id}")
+            except requests.RequestException as e:
+                st.error(f"Failed to upload {file_name}. Error: {e}")
         else:
-            st.error(f"Failed to upload {file_name}. Response: {response.status_code}, {response.text}")
+            response = upload_file_to_github(file_name, file_content, job_id)
+
+            if response.status_code in [201, 200]:
+                st.success(f"File {file_name} uploaded/updated successfully! Job: {job_id}")
+            else:
+                st.error(f"Failed to upload {file_name}. Response: {response.status_code}, {response.text}")
 
 # Display the uploaded image on the left column
 if uploaded_file is not None:
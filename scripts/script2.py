@@ -1,24 +1,38 @@
 import os
 import csv
-import requests
+import argparse
 from io import StringIO
-from PIL import Image
-import numpy as np
-
-# Function to fetch CSV content from a URL
-def fetch_csv_from_url(url):
-    response = requests.get(url)
-    if response.status_code == 200:
-        csv_content = response.content.decode('utf-8')
-        return csv_content
-    else:
-        print(f"Failed to fetch CSV from {url}. Status code: {response.status_code}")
+from http_cache import fetch_url_cached
+from decoding import decode_token_image, iter_decrypt_images, scan_images
+from payload import LAYOUT_BITS, TOKEN_BITS, parse_token_fields, payload_to_bit_string
+from reference_data import load_reference_data
+from instrumentation import add_instrumentation_arguments, run_instrumented, span
+from jobs import IMAGE_EXTENSIONS
+from manifest import input_digests, load_manifest, noting_images, plan_output, planned_payloads, record_output
+
+# Function to fetch CSV content from a URL, once per process and revalidated against the on-disk copy
+def fetch_csv_from_url(url, offline=False):
+    with span('reference_fetch', url=url):
+        content = fetch_url_cached(url, offline)
+    if content is None:
         return None
+    return content.decode('utf-8')
 
 # URLs of the CSV files (Replace 'your-username' and 'your-repo' with your actual GitHub username and repository)
 INVENTORY_CSV_URL = 'https://raw.githubusercontent.com/releafs/decryption/main/data/inventory.csv'
 DOT_POSITIONS_CSV_URL = 'https://raw.githubusercontent.com/releafs/decryption/main/data/dot_positions.csv'
 CREATION_TSV_URL = 'https://raw.githubusercontent.com/releafs/decryption/main/data/metadata.tsv'
+CREATION_CSV_URL = 'https://raw.githubusercontent.com/releafs/decryption/main/data/creation.csv'
+
+# Value -> name maps parsed from the creation TSV, kept for the whole run
+_value_names = {}
+
+# Reference data files compiled into the cached artifact, by file name
+REFERENCE_CSV_URLS = {
+    'inventory.csv': INVENTORY_CSV_URL,
+    'dot_positions.csv': DOT_POSITIONS_CSV_URL,
+    'creation.csv': CREATION_CSV_URL,
+}
 
 # Define the directories
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -38,186 +52,174 @@ print(f"PROCESS_DIR: {PROCESS_DIR}")
 os.makedirs(PROCESS_DIR, exist_ok=True)
 os.makedirs(INPUT_DIR, exist_ok=True)  # Ensure input directory exists
 
-# Load DOT_COLORS and TOTAL_DOTS from the 'inventory.csv' file
-def fetch_parameters_from_inventory(inventory_csv_url):
-    dot_colors = []
-    total_dots = None
-    csv_content = fetch_csv_from_url(inventory_csv_url)
-    if csv_content is None:
-        return dot_colors, total_dots
-    csvfile = StringIO(csv_content)
-    reader = csv.DictReader(csvfile)
-    for row in reader:
-        if row['Parameter'] == 'DOT_COLORS':
-            color_tuple = tuple(map(int, row['Value'].strip('()').split(',')))
-            dot_colors.append(color_tuple)
-        elif row['Parameter'] == 'TOTAL_DOTS':
-            total_dots = int(row['Value'])
-    return dot_colors, total_dots
-
-# Load dot positions from 'dot_positions.csv'
-def load_dot_positions(dot_positions_csv_url):
-    dot_positions = []
-    csv_content = fetch_csv_from_url(dot_positions_csv_url)
-    if csv_content is None:
-        return dot_positions
-    csvfile = StringIO(csv_content)
-    reader = csv.DictReader(csvfile)
-    for row in reader:
-        x = int(row['x'])
-        y = int(row['y'])
-        dot_positions.append((x, y))
-    return dot_positions
-
-# Function to map color to bit
-def color_to_bit(color, dot_colors):
-    if color[:3] == dot_colors[0]:
-        return '0'
-    elif color[:3] == dot_colors[1]:
-        return '1'
-    else:
-        # Handle color differences due to image processing
-        distances = [np.linalg.norm(np.array(color[:3]) - np.array(dc[:3])) for dc in dot_colors]
-        closest_color_index = distances.index(min(distances))
-        return str(closest_color_index)
+# Function to fetch one of the reference data files from the repository
+def fetch_reference_source(file_name, offline=False):
+    return fetch_url_cached(REFERENCE_CSV_URLS[file_name], offline)
 
 # Function to decrypt an image
 def decrypt_image(image_path, dot_positions, dot_colors, total_dots):
     try:
-        image = Image.open(image_path).convert('RGBA')
+        # Reference-size lossless images are read pixel for pixel, any other size or format by dot patches
+        payload, margins = decode_token_image(image_path, dot_positions, dot_colors, total_dots)
         print(f"Processing image: {image_path}")
-
-        bit_string = ''
-        for idx, (x, y) in enumerate(dot_positions):
-            if idx >= total_dots:
-                break  # Only read up to total_dots
-            adjusted_y = y - 7  # Adjust y-coordinate if necessary
-            color = image.getpixel((x, adjusted_y))
-            bit = color_to_bit(color, dot_colors)
-            bit_string += bit
-        return bit_string
+        if margins is not None:
+            print(f"Decoded resized, re-encoded or photographed image {image_path}, lowest dot margin {margins.min():.2f}")
+        return payload
     except Exception as e:
         print(f"Error processing image {image_path}: {e}")
         return None
 
-# Function to parse the bit string into original data
-def parse_bit_string(bit_string):
-    if len(bit_string) < 106:
+# Function to parse the token payload into original data
+def parse_payload(payload, width):
+    if width < LAYOUT_BITS:
         print("Bit string is shorter than expected.")
         return None
-    # Extract bits according to their lengths
-    latitude_bits = bit_string[0:25]
-    longitude_bits = bit_string[25:51]
-    date_number_bits = bit_string[51:68]
-    impact_quantity_bits = bit_string[68:98]
-    project_value_bits = bit_string[98:102]
-    impact_value_bits = bit_string[102:106]
-
-    # Convert binary strings to integers
-    latitude = int(latitude_bits, 2)
-    longitude = int(longitude_bits, 2)
-    date_number = int(date_number_bits, 2)
-    impact_quantity = int(impact_quantity_bits, 2)
-    project_value = int(project_value_bits, 2)
-    impact_value = int(impact_value_bits, 2)
-
-    original_latitude = (latitude / 100000) - 90
-    original_longitude = (longitude / 100000) - 180
-
-    return {
-        'latitude': original_latitude,
-        'longitude': original_longitude,
-        'date_number': date_number,
-        'impact_quantity': impact_quantity,
-        'project_value': project_value,
-        'impact_value': impact_value
-    }
+    with span('parse'):
+        return parse_token_fields(payload, width)
 
 # Function to map project and impact values back to their names
-def map_values_to_names(project_value, impact_value, creation_tsv_url):
-    project_type = None
-    impact_unit = None
-    csv_content = fetch_csv_from_url(creation_tsv_url)
-    if csv_content is None:
-        return 'Unknown Project Type', 'Unknown Impact Unit'
-    csvfile = StringIO(csv_content)
-    reader = csv.DictReader(csvfile, delimiter='\t')
-    for row in reader:
-        if 'Project Value' in row and int(row['Project Value']) == project_value:
-            project_type = row.get('Project Type', 'Unknown Project Type')
-        if 'Impact Value' in row and int(row['Impact Value']) == impact_value:
-            impact_unit = row.get('Impact Unit', 'Unknown Impact Unit')
+def map_values_to_names(project_value, impact_value, creation_tsv_url, offline=False):
+    project_type_map, impact_unit_map = load_value_names(creation_tsv_url, offline)
+    project_type = project_type_map.get(project_value)
+    impact_unit = impact_unit_map.get(impact_value)
     return project_type or 'Unknown Project Type', impact_unit or 'Unknown Impact Unit'
 
-# Function to save data to 'decrypted_data_with_binary.csv'
-def save_to_csv(data, output_file_path):
+# Function to parse the value -> name maps from the TSV once per process
+def load_value_names(creation_tsv_url, offline=False):
+    key = (creation_tsv_url, offline)
+    if key not in _value_names:
+        project_type_map = {}
+        impact_unit_map = {}
+        csv_content = fetch_csv_from_url(creation_tsv_url, offline)
+        if csv_content is not None:
+            reader = csv.DictReader(StringIO(csv_content), delimiter='\t')
+            for row in reader:
+                # Later rows win, as when the file was scanned for every lookup
+                if row.get('Project Value'):
+                    project_type_map[int(row['Project Value'])] = row.get('Project Type', 'Unknown Project Type')
+                if row.get('Impact Value'):
+                    impact_unit_map[int(row['Impact Value'])] = row.get('Impact Unit', 'Unknown Impact Unit')
+        _value_names[key] = (project_type_map, impact_unit_map)
+    return _value_names[key]
+
+# Function to save data to 'decrypted_data_with_binary.csv', writing rows as they are produced
+#
+# With append set the rows are added at the end of the existing file, in
+# place, and manifest.output_images cuts off the rows of an append that
+# stopped halfway. A rewrite goes through a temporary file.
+def save_to_csv(data, output_file_path, width=TOKEN_BITS, append=False):
     # Define the headers, including the 'Binary Code' column
     headers = ['Latitude', 'Longitude', 'Serial Number', 'Impact Quantity', 'Project Type', 'Impact Unit', 'Binary Code']
 
-    with open(output_file_path, mode='w', newline='', encoding='utf-8') as csvfile:
+    tmp_file_path = f"{output_file_path}.{os.getpid()}.tmp"
+    row_count = 0
+    with open(output_file_path if append else tmp_file_path, mode='a' if append else 'w', newline='', encoding='utf-8') as csvfile:
         writer = csv.DictWriter(csvfile, fieldnames=headers)
-        writer.writeheader()
+        if not append:
+            writer.writeheader()
         for row in data:
-            writer.writerow({
-                'Latitude': row['Latitude'],
-                'Longitude': row['Longitude'],
-                'Serial Number': row['Serial Number'],
-                'Impact Quantity': row['Impact Quantity'],
-                'Project Type': row['Project Type'],
-                'Impact Unit': row['Impact Unit'],
-                'Binary Code': row['Binary Code']  # Include the binary code (bit string)
-            })
-
-# Main decryption function
-def main():
-    # URLs of the data files
-    inventory_csv_url = INVENTORY_CSV_URL
-    dot_positions_csv_url = DOT_POSITIONS_CSV_URL
-    creation_tsv_url = CREATION_TSV_URL
-    output_file_path = os.path.join(PROCESS_DIR, 'decrypted_data_with_binary.csv')
-
-    # Fetch parameters
-    DOT_COLORS, TOTAL_DOTS = fetch_parameters_from_inventory(inventory_csv_url)
-    dot_positions = load_dot_positions(dot_positions_csv_url)
-
-    # Check if there are images in the input directory
-    input_images = [f for f in os.listdir(INPUT_DIR) if f.lower().endswith(('.png', '.jpg', '.jpeg', '.tif', '.tiff'))]
-    if not input_images:
-        print("No images found in the input directory.")
-        return
-
-    decrypted_data = []
-    # Process each image
-    for file_name in input_images:
-        file_path = os.path.join(INPUT_DIR, file_name)
-        bit_string = decrypt_image(file_path, dot_positions, DOT_COLORS, TOTAL_DOTS)
-        if bit_string:
-            data = parse_bit_string(bit_string)
+            with span('write'):
+                writer.writerow({
+                    'Latitude': row['Latitude'],
+                    'Longitude': row['Longitude'],
+                    'Serial Number': row['Serial Number'],
+                    'Impact Quantity': row['Impact Quantity'],
+                    'Project Type': row['Project Type'],
+                    'Impact Unit': row['Impact Unit'],
+                    'Binary Code': payload_to_bit_string(row['Binary Code'], width)  # Include the binary code (bit string)
+                })
+            row_count += 1
+    # Only replace the previous output when at least one token was decrypted
+    if not append:
+        if row_count:
+            os.replace(tmp_file_path, output_file_path)
+        else:
+            os.remove(tmp_file_path)
+    return row_count
+
+# Function to parse and name the tokens of a stream of (sha256, file name, payload) triples, one row at a time
+#
+# Yields (sha256, row) pairs, as manifest.noting_images expects.
+def decrypted_rows(payloads, reference, creation_tsv_url, offline=False):
+    TOTAL_DOTS = reference['total_dots']
+
+    for image_hash, file_name, payload in payloads:
+        if payload is not None:
+            data = parse_payload(payload, TOTAL_DOTS)
             if data:
-                project_type, impact_unit = map_values_to_names(data['project_value'], data['impact_value'], creation_tsv_url)
-                decrypted_data.append({
+                project_type, impact_unit = map_values_to_names(data['project_value'], data['impact_value'], creation_tsv_url, offline)
+                print(f"Decrypted data for {file_name}: {data}")
+                yield image_hash, {
                     'Latitude': data['latitude'],
                     'Longitude': data['longitude'],
                     'Serial Number': data['date_number'],
                     'Impact Quantity': data['impact_quantity'],
                     'Project Type': project_type,
                     'Impact Unit': impact_unit,
-                    'Binary Code': bit_string  # Add the binary code (bit string)
-                })
-
-                print(f"Decrypted data for {file_name}: {data}")
+                    'Binary Code': payload  # Add the binary code (packed payload)
+                }
             else:
                 print(f"Failed to parse bit string for {file_name}")
         else:
             print(f"Failed to decrypt {file_name}")
 
-    # Save decrypted data to 'decrypted_data_with_binary.csv'
-    if decrypted_data:
-        save_to_csv(decrypted_data, output_file_path)
+# Function to parse the command line options
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Decrypt token images and keep their binary code.')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='Number of worker processes used to decode images (default: number of cores)')
+    parser.add_argument('--offline', action='store_true',
+                        help='Read the reference files from the local data folder instead of GitHub')
+    parser.add_argument('--stream', action='store_true',
+                        help='Process the images in directory order without sorting them, writing rows as they are decoded')
+    add_instrumentation_arguments(parser)
+    return parser.parse_args()
+
+# Main decryption function
+def main(workers=None, offline=False, stream=False):
+    # URLs of the data files
+    creation_tsv_url = CREATION_TSV_URL
+    output_file_path = os.path.join(PROCESS_DIR, 'decrypted_data_with_binary.csv')
+
+    # Fetch parameters, loaded from the compiled reference data unless a source file changed
+    reference = load_reference_data(lambda file_name: fetch_reference_source(file_name, offline))
+    if reference is None:
+        print("Failed to fetch the reference data.")
+        return
+
+    if stream:
+        # Images are read straight from the directory scan and rows are written as they are decoded
+        file_paths = scan_images(INPUT_DIR, IMAGE_EXTENSIONS)
+    else:
+        # Check if there are images in the input directory
+        input_images = sorted(f for f in os.listdir(INPUT_DIR) if f.lower().endswith(IMAGE_EXTENSIONS))
+        if not input_images:
+            print("No images found in the input directory.")
+            return
+        file_paths = [os.path.join(INPUT_DIR, file_name) for file_name in input_images]
+
+    # Decode only the images whose rows are not in the output yet, and not decoded before; rows
+    # appended to the output are planned as the files are read, so a stream is never held in memory
+    manifest = load_manifest()
+    append, planned = plan_output(manifest, output_file_path, input_digests(manifest, file_paths), reference['version'])
+    if not stream:
+        workers = min(workers or os.cpu_count() or 1, len(file_paths))
+    decode = lambda paths: iter_decrypt_images(decrypt_image, paths, reference['dot_positions'], reference['dot_colors'],
+                                               reference['total_dots'], workers)
+    payloads = planned_payloads(manifest, planned, decode, reference['version'])
+
+    # Save decrypted data to 'decrypted_data_with_binary.csv', after the rows already there unless it has to be rewritten
+    images = []
+    rows = noting_images(decrypted_rows(payloads, reference, creation_tsv_url, offline), images)
+    row_count = save_to_csv(rows, output_file_path, reference['total_dots'], append)
+    if row_count or append:
+        record_output(manifest, output_file_path, images, reference['version'], rewritten=not append)
+    if row_count:
         print(f"Decrypted data saved to {output_file_path}")
     else:
         print("No data to save.")
 
 # Run the main function
 if __name__ == '__main__':
-    main()
+    args = parse_arguments()
+    run_instrumented(args, main, workers=args.workers, offline=args.offline, stream=args.stream)
@@ -1,7 +1,10 @@
 import os
 import csv
-import requests
-from io import StringIO
+import argparse
+from metadata_store import open_metadata_store, refresh_metadata_store, metadata_columns, metadata_version, find_metadata_row, count_token_rows
+from payload import TOKEN_BITS, pack_bit_string, payload_to_bit_string
+from result_cache import open_result_cache, set_cache_versions, store_merged_rows
+from instrumentation import add_instrumentation_arguments, run_instrumented, span
 
 # URL of the metadata.tsv file (replace with your actual GitHub raw URL)
 METADATA_TSV_URL = 'https://raw.githubusercontent.com/releafs/decryption/main/data/metadata.tsv'
@@ -14,112 +17,55 @@ PROCESS_DIR = os.path.join(ROOT_DIR, 'process')  # Updated this line
 # Ensure the process directory exists
 os.makedirs(PROCESS_DIR, exist_ok=True)
 
-# Function to fetch TSV content from a URL
-def fetch_tsv_from_url(url):
-    response = requests.get(url)
-    if response.status_code == 200:
-        tsv_content = response.content.decode('utf-8')
-        return tsv_content
-    else:
-        print(f"Failed to fetch TSV from {url}. Status code: {response.status_code}")
-        return None
+# Path of the decrypted data written by script2.py
+DECRYPTED_DATA_FILE_PATH = os.path.join(PROCESS_DIR, 'decrypted_data_with_binary.csv')
 
-# Function to load the Metadata from 'metadata.tsv' via URL
-def load_metadata():
-    tsv_content = fetch_tsv_from_url(METADATA_TSV_URL)
-    if tsv_content is None:
-        return []
-    tsvfile = StringIO(tsv_content)
-    metadata_data = []
-    reader = csv.DictReader(tsvfile, delimiter='\t')
-    for row in reader:
-        metadata_data.append(row)
-    return metadata_data
-
-# Function to load data from 'decrypted_data_with_binary.csv'
-def load_decrypted_data_with_binary():
-    decrypted_data_file_path = os.path.join(PROCESS_DIR, 'decrypted_data_with_binary.csv')
-    decrypted_data = []
-    try:
-        with open(decrypted_data_file_path, mode='r', newline='', encoding='utf-8') as csvfile:
-            reader = csv.DictReader(csvfile)
-            for row in reader:
-                decrypted_data.append(row)
-    except FileNotFoundError:
-        print(f"Decrypted data file not found at {decrypted_data_file_path}")
-        return []
-    return decrypted_data
-
-# Function to clean and compare strings safely, preserving leading zeros
-def clean_string(s):
-    if not isinstance(s, str):
-        s = str(s)  # Convert to string if not already a string
-    return s.strip().replace("\n", "").replace("\r", "").replace("\t", "").replace(" ", "")
-
-# Function to find the matching profile by Serial Number and Bit String
-def find_metadata_by_serial(serial_number, bit_string, metadata_data):
-    bit_string_cleaned = clean_string(bit_string)
-    
-    for row in metadata_data:
-        # Ensure tokenID is treated as a string and stripped of spaces
-        token_id = str(row.get('tokenID', '')).strip()
+# Base columns of 'merged_data_with_metadata.csv', followed by the metadata columns
+MERGED_HEADERS = ['Latitude', 'Longitude', 'Serial Number', 'Impact Quantity', 'Project Type', 'Impact Unit', 'Binary Code']
 
-        # Fetch the Bit String from the 'Bit String' column and ensure it is treated as a string to preserve leading zeros
-        row_bit_string = clean_string(str(row.get('Bit String', '')).zfill(len(bit_string_cleaned)))
-        
-        # Check if both the Serial Number and Bit String match
-        if token_id == str(serial_number).strip() and row_bit_string == bit_string_cleaned:
-            return row
-        
-    # Return None if no match is found
-    return None
+# Function to read the rows of 'decrypted_data_with_binary.csv' one at a time
+def iter_decrypted_data_with_binary(decrypted_data_file_path=DECRYPTED_DATA_FILE_PATH):
+    with open(decrypted_data_file_path, mode='r', newline='', encoding='utf-8') as csvfile:
+        reader = csv.DictReader(csvfile)
+        for row in reader:
+            # Keep the binary code as a packed payload from here on
+            row['Binary Code'] = pack_bit_string(row.get('Binary Code', ''))
+            yield row
 
-# Function to save the merged data to 'merged_data_with_metadata.csv'
-def save_to_csv(data):
-    output_file_path = os.path.join(PROCESS_DIR, 'merged_data_with_metadata.csv')
-    if not data:
-        print("No data to save.")
-        return
+# Function to index the metadata rows by (tokenID, packed Bit String), and by tokenID alone for diagnostics
+def build_metadata_index(metadata_data):
+    by_key = {}
+    by_token_id = {}
+    for row in metadata_data:
+        token_id = str(row.get('tokenID', '')).strip()
+        payload = pack_bit_string(row.get('Bit String', ''))
+        if payload is not None:
+            by_key.setdefault((token_id, payload), row)  # The first row wins, as with a linear scan
+        by_token_id.setdefault(token_id, []).append(row)
+    return {'by_key': by_key, 'by_token_id': by_token_id}
 
-    # Define the headers
-    headers = ['Latitude', 'Longitude', 'Serial Number', 'Impact Quantity', 'Project Type', 'Impact Unit', 'Binary Code']
-    # Add additional headers from the data
-    additional_headers = [k for k in data[0].keys() if k not in headers]
-    headers.extend(additional_headers)
+# Function to find the matching profile by Serial Number and packed Bit String
+def find_metadata_by_serial(serial_number, payload, metadata_index):
+    if payload is None:
+        return None
+    # Leading zeros do not change the packed value, so no zfill is needed
+    return metadata_index['by_key'].get((str(serial_number).strip(), payload))
 
-    try:
-        with open(output_file_path, mode='w', newline='', encoding='utf-8') as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=headers)
-            writer.writeheader()
-            for row in data:
-                writer.writerow(row)
-        print(f"Merged data saved to {output_file_path}")
-    except Exception as e:
-        print(f"Failed to save data to {output_file_path}: {e}")
+# Function to get the fixed header schema of the merged CSV: the base columns, then the metadata columns
+def merged_headers(metadata_store):
+    headers = list(MERGED_HEADERS)
+    headers.extend(k for k in metadata_columns(metadata_store, METADATA_TSV_URL) if k not in headers)
+    return headers
 
-# Main function to load data, match with Metadata, and save the result
-def main():
-    # Load the Metadata
-    metadata_data = load_metadata()
-    if not metadata_data:
-        print("Failed to load metadata.")
-        return
-    
-    # Load the data from 'decrypted_data_with_binary.csv'
-    decrypted_data = load_decrypted_data_with_binary()
-    if not decrypted_data:
-        print("No decrypted data found to process.")
-        return
-
-    merged_data = []
-    matched_count = 0
-    
+# Function to merge a stream of decrypted rows with their metadata, one row at a time
+def merged_rows(decrypted_data, metadata_store):
     for row in decrypted_data:
-        bit_string = row['Binary Code']
+        payload = row['Binary Code']
         serial_number = row['Serial Number']
         
         # Search for matching metadata using Serial Number and Bit String
-        metadata_row = find_metadata_by_serial(serial_number, bit_string, metadata_data)
+        with span('match'):
+            metadata_row = find_metadata_row(metadata_store, serial_number, payload)
         if metadata_row:
             # Merge the row data with the corresponding metadata
             merged_row = {
@@ -129,7 +75,7 @@ def main():
                 'Impact Quantity': row['Impact Quantity'],
                 'Project Type': row.get('Project Type', 'Unknown Project Type'),
                 'Impact Unit': row.get('Impact Unit', 'Unknown Impact Unit'),
-                'Binary Code': bit_string
+                'Binary Code': payload
             }
             
             # Add other metadata fields (excluding duplicates)
@@ -137,18 +83,92 @@ def main():
                 if k not in merged_row:
                     merged_row[k] = v
             
-            merged_data.append(merged_row)
-            matched_count += 1  # Increment the match count
+            yield merged_row
         else:
-            print(f"No matching metadata found for Serial Number: {serial_number} and Bit String: {bit_string}")
+            print(f"No matching metadata found for Serial Number: {serial_number} and Bit String: {'invalid' if payload is None else payload_to_bit_string(payload, TOKEN_BITS)}")
+            candidates = count_token_rows(metadata_store, serial_number)
+            if candidates:
+                print(f"  tokenID {serial_number} exists in the metadata with {candidates} other Bit String(s)")
+
+# Function to save the merged data to 'merged_data_with_metadata.csv', writing rows as they are produced
+#
+# The headers are fixed up front (see merged_headers) instead of being taken
+# from the first row, so nothing has to be buffered. Returns the number of
+# rows written; the previous file is kept when there are none. With append
+# set the rows are added at the end of the existing file in place (see
+# manifest.output_images for an append that stops halfway), else the file is
+# replaced through a temporary one.
+def save_to_csv(data, headers, append=False):
+    output_file_path = os.path.join(PROCESS_DIR, 'merged_data_with_metadata.csv')
+    tmp_file_path = f"{output_file_path}.{os.getpid()}.tmp"
+    row_count = 0
+
+    try:
+        with open(output_file_path if append else tmp_file_path, mode='a' if append else 'w', newline='', encoding='utf-8') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=headers, extrasaction='ignore')
+            if not append:
+                writer.writeheader()
+            for row in data:
+                # Convert the packed payload back to its bit string only at the CSV edge
+                with span('write'):
+                    writer.writerow({**row, 'Binary Code': payload_to_bit_string(row['Binary Code'], TOKEN_BITS)})
+                row_count += 1
+        if row_count:
+            if not append:
+                os.replace(tmp_file_path, output_file_path)
+            print(f"Merged data saved to {output_file_path}")
+        else:
+            if not append:
+                os.remove(tmp_file_path)
+            print("No data to save.")
+    except Exception as e:
+        print(f"Failed to save data to {output_file_path}: {e}")
+        if os.path.exists(tmp_file_path):
+            os.remove(tmp_file_path)
+        if append:
+            # Nothing is recorded, so the rows written so far are cut off by manifest.output_images on the next run
+            raise
+    return row_count
+
+# Function to parse the command line options
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Match the decrypted tokens with metadata.tsv.')
+    parser.add_argument('--offline', action='store_true',
+                        help='Read metadata.tsv from the local data folder instead of GitHub')
+    add_instrumentation_arguments(parser)
+    return parser.parse_args()
+
+# Main function to load data, match with Metadata, and save the result
+def main(offline=False):
+    # Bring the local metadata store up to date, appending only the rows added to metadata.tsv
+    metadata_store = open_metadata_store()
+    try:
+        with span('metadata_fetch'):
+            added_rows = refresh_metadata_store(metadata_store, METADATA_TSV_URL, offline)
+        print(f"Metadata store refreshed, {added_rows} new rows.")
+    except Exception as e:
+        print(f"Failed to refresh metadata, using the local store: {e}")
+    if not metadata_columns(metadata_store, METADATA_TSV_URL):
+        print("Failed to load metadata.")
+        return
     
-    # Save the merged data to 'merged_data_with_metadata.csv'
+    # Stream the rows of 'decrypted_data_with_binary.csv' through the merge and into the output file
+    if not os.path.exists(DECRYPTED_DATA_FILE_PATH):
+        print(f"Decrypted data file not found at {DECRYPTED_DATA_FILE_PATH}")
+        print("No decrypted data found to process.")
+        return
+
+    # Every merged row is also kept in the result cache shared with the dashboards
+    result_cache = open_result_cache()
+    set_cache_versions(result_cache, metadata_version=metadata_version(metadata_store, METADATA_TSV_URL))
+    rows = store_merged_rows(result_cache, merged_rows(iter_decrypted_data_with_binary(), metadata_store))
+    matched_count = save_to_csv(rows, merged_headers(metadata_store))
     if matched_count > 0:
         print(f"Successfully matched and merged {matched_count} entries.")
-        save_to_csv(merged_data)
     else:
         print("No successful matches found to save.")
 
 # Run the main function
 if __name__ == '__main__':
-    main()
+    args = parse_arguments()
+    run_instrumented(args, main, offline=args.offline)
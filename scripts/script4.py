@@ -1,34 +1,42 @@
 import os
 import subprocess
 import shutil
+from jobs import IMAGE_EXTENSIONS, JOB_RESULTS_DIR, is_job_id
 
 def main():
-    # Define the directory where the PNG files are located
+    # Define the directory where the uploaded images are located
     INPUT_DIR = os.path.join(os.getcwd(), 'decryption', 'input')
+    RESULTS_DIR = os.path.join(os.getcwd(), JOB_RESULTS_DIR)
 
     if not os.path.exists(INPUT_DIR):
         print(f"The directory {INPUT_DIR} does not exist.")
         return
 
-    # List all PNG files in the input directory
-    png_files = [f for f in os.listdir(INPUT_DIR) if f.lower().endswith('.png')]
+    # List the images of every accepted format in the input directory
+    image_files = [entry.path for entry in os.scandir(INPUT_DIR) if entry.is_file() and entry.name.lower().endswith(IMAGE_EXTENSIONS)]
 
-    if png_files:
-        # Delete each PNG file
-        for file_name in png_files:
-            file_path = os.path.join(INPUT_DIR, file_name)
+    if image_files:
+        # Delete each image file
+        for file_path in image_files:
             os.remove(file_path)
             print(f"Deleted {file_path}")
     else:
-        print("No PNG files to delete.")
-
-    # Delete the input directory itself
-    try:
-        shutil.rmtree(INPUT_DIR)
-        print(f"Deleted directory: {INPUT_DIR}")
-    except Exception as e:
-        print(f"Failed to delete directory {INPUT_DIR}. Reason: {e}")
-        return
+        print("No image files to delete.")
+
+    # Delete the whole folder of every upload job that has a result, whatever it holds; jobs uploaded since stay for the next run
+    for entry in os.scandir(INPUT_DIR):
+        if entry.is_dir() and is_job_id(entry.name) and os.path.exists(os.path.join(RESULTS_DIR, f"{entry.name}.json")):
+            shutil.rmtree(entry.path)
+            print(f"Deleted job folder: {entry.path}")
+
+    # Delete the input directory itself once nothing is left in it
+    if not os.listdir(INPUT_DIR):
+        try:
+            shutil.rmtree(INPUT_DIR)
+            print(f"Deleted directory: {INPUT_DIR}")
+        except Exception as e:
+            print(f"Failed to delete directory {INPUT_DIR}. Reason: {e}")
+            return
 
     # Configure Git user details
     subprocess.run(['git', 'config', '--global', 'user.email', 'action@github.com'], check=True)
@@ -37,13 +45,16 @@ def main():
     # Stage the deleted files and directory
     subprocess.run(['git', 'add', '-u'], check=True)
 
-    # Commit the changes
-    commit_message = 'Delete uploaded PNG files and input directory'
+    # Commit the changes, if anything was deleted
+    if subprocess.run(['git', 'diff', '--cached', '--quiet']).returncode == 0:
+        print("Nothing to delete from the repository.")
+        return
+    commit_message = 'Delete processed input files'
     subprocess.run(['git', 'commit', '-m', commit_message], check=True)
 
     # Push changes back to the repository
     subprocess.run(['git', 'push'], check=True)
-    print("Deleted PNG files and input directory have been committed and pushed to the repository.")
+    print("Deleted input files have been committed and pushed to the repository.")
 
 if __name__ == '__main__':
     main()
@@ -1,12 +1,35 @@
 import os
 import pandas as pd
 import streamlit as st
-import time
+from jobs import IMAGE_EXTENSIONS, list_job_inputs
+from result_wait import wait_for_local_result
+from result_cache import open_result_cache, set_cache_versions, fetch_metadata_version, lookup_image_result
+
+# Path to the CSV file and the folder of the images it is computed from
+csv_file_path = 'process/merged_data_with_metadata.csv'
+input_folder_path = 'decryption/input'
+
+# Metadata the cached results were merged with (the local copy, as processed by the pipeline)
+METADATA_TSV_URL = 'https://raw.githubusercontent.com/releafs/decryption/main/data/metadata.tsv'
+
+# Function to find the cached result of the newest image in the input folder or its job folders, None on a miss
+def cached_input_result():
+    if not os.path.isdir(input_folder_path):
+        return None
+    try:
+        images = [(os.stat(path).st_mtime, path) for _, _, path in list_job_inputs(input_folder_path, IMAGE_EXTENSIONS)]
+    except OSError:
+        return None  # An input was removed while the folder was scanned
+    if not images:
+        return None
+    _, newest_image = max(images)
+
+    result_cache = open_result_cache()
+    set_cache_versions(result_cache, metadata_version=fetch_metadata_version(METADATA_TSV_URL, offline=True))
+    with open(newest_image, mode='rb') as f:
+        return lookup_image_result(result_cache, f.read())
 
 def display_token_details():
-    # Path to the CSV file
-    csv_file_path = 'process/merged_data_with_metadata.csv'
-    
     # Debug: Print the working directory and the path to the CSV file
     print(f"Working directory: {os.getcwd()}")
     print(f"Full path to the CSV file: {os.path.abspath(csv_file_path)}")
@@ -32,7 +55,10 @@ def display_token_details():
     # Get the last row of the DataFrame
     last_row = df.iloc[-1]
     print(f"Displaying the last row of the CSV file:\n{last_row}")
+    show_token_row(last_row)
 
+# Function to display the details of one token row
+def show_token_row(last_row):
     # Extract the required parameters
     required_parameters = [
         "Latitude", "Longitude", "Type of Token", "description", "external_url",
@@ -58,9 +84,21 @@ st.title("Fetch Latest Releafs Token Details")
 # Add a "Fetch Latest" button
 if st.button("Fetch Latest"):
     st.write("Fetching latest token details...")
-    # Wait for 60 seconds to ensure the latest processing is done
-    with st.spinner('Waiting for the backend process to complete (60 seconds)...'):
-        time.sleep(60)  # You can adjust the sleep time based on your process duration
+    # A token processed before is shown from the result cache straight away
+    cached_row = cached_input_result()
+    if cached_row is not None:
+        print("Displaying the cached result of the newest input image")
+        show_token_row(cached_row)
+    else:
+        # Wait until the result of the images currently in the input folder has been written
+        progress_bar = st.progress(0.0, text='Waiting for the backend process to complete...')
+
+        def show_progress(elapsed, timeout):
+            progress_bar.progress(min(elapsed / timeout, 1.0), text=f'Waiting for the backend process to complete ({elapsed:.0f}s)...')
+
+        if wait_for_local_result(csv_file_path, input_folder_path, progress=show_progress) is None:
+            st.warning("The backend process is taking longer than expected. Showing the latest available result.")
+        progress_bar.empty()
 
-    # Fetch and display the latest token details
-    display_token_details()
+        # Fetch and display the latest token details
+        display_token_details()
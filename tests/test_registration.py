@@ -0,0 +1,88 @@
+import os
+import sys
+import numpy as np
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+from benchmark import render_token
+from decoding import REFERENCE_SIZE, decode_token_image, dot_coordinates
+from payload import bit_matrix_to_payloads
+from reference_data import load_reference_data
+from registration import register_layout
+
+# Background color of the canvas the renders are pasted on, and where they are pasted
+CANVAS_COLOR = (165, 119, 72)
+PASTE_OFFSET = (120, 40)
+
+# Orientations of the pasted render
+ROTATIONS = {'none': None, 'rot90': Image.ROTATE_90, 'rot180': Image.ROTATE_180, 'rot270': Image.ROTATE_270}
+MIRRORS = {'flip_left_right': Image.FLIP_LEFT_RIGHT, 'flip_top_bottom': Image.FLIP_TOP_BOTTOM, 'transpose': Image.TRANSPOSE,
+           'transverse': Image.TRANSVERSE}
+
+
+@pytest.fixture(scope='module')
+def reference():
+    return load_reference_data()
+
+
+@pytest.fixture(scope='module')
+def bits(reference):
+    return np.random.default_rng(0).integers(0, 2, reference['total_dots']).astype(np.uint8)
+
+
+# Function to get the payload of a bit array
+def payload_of(bits):
+    return bit_matrix_to_payloads(bits[np.newaxis])[0]
+
+
+# Function to paste a render at PASTE_OFFSET on a canvas of CANVAS_COLOR
+def pasted(token):
+    canvas = Image.new('RGB', (token.width + 2 * PASTE_OFFSET[0], token.height + 2 * PASTE_OFFSET[1]), CANVAS_COLOR)
+    canvas.paste(token, PASTE_OFFSET)
+    return canvas
+
+
+# Function to decode a render pasted at PASTE_OFFSET on a canvas of CANVAS_COLOR
+def decode_pasted(token, reference, path):
+    pasted(token).save(path)
+    return decode_token_image(str(path), reference['dot_positions'], reference['dot_colors'], reference['total_dots'])[0]
+
+
+@pytest.mark.parametrize('size', [978, 1600])
+@pytest.mark.parametrize('dot_radius', [1, 2, 3])
+@pytest.mark.parametrize('rotation', list(ROTATIONS))
+def test_offset_and_rotated_renders_decode_exactly(reference, bits, tmp_path, size, dot_radius, rotation):
+    token = render_token(bits, reference, size=size, dot_radius=dot_radius)
+    if ROTATIONS[rotation] is not None:
+        token = token.transpose(ROTATIONS[rotation])
+    assert decode_pasted(token, reference, tmp_path / 'token.png') == payload_of(bits)
+
+
+# The layout is the same mirrored left to right, so a mirrored render has the
+# pixels of an unmirrored token and must register unmirrored
+@pytest.mark.parametrize('size', [978, 1600])
+@pytest.mark.parametrize('dot_radius', [1, 2, 3])
+@pytest.mark.parametrize('mirror', list(MIRRORS))
+def test_mirrored_renders_never_register_mirrored(reference, bits, size, dot_radius, mirror):
+    xs, ys = dot_coordinates(reference['dot_positions'], reference['total_dots'])
+    layout = np.column_stack((xs, ys)).astype(np.float64) * size / REFERENCE_SIZE[0]
+    token = render_token(bits, reference, size=size, dot_radius=dot_radius).transpose(MIRRORS[mirror])
+    homography = register_layout(np.asarray(pasted(token)), layout)[0]
+    assert np.linalg.det(homography[:2, :2]) > 0
+
+
+# Without the dots at the right end of the upper rows the layout only fits its mirrored renders mirrored
+@pytest.mark.parametrize('mirror', list(MIRRORS))
+def test_mirrored_renders_of_an_asymmetric_layout_are_rejected(reference, mirror):
+    xs, ys = dot_coordinates(reference['dot_positions'], reference['total_dots'])
+    keep = ~((xs > 640) & (ys < 870))
+    pixels = np.empty((REFERENCE_SIZE[1], REFERENCE_SIZE[0], 3), dtype=np.uint8)
+    pixels[:] = CANVAS_COLOR
+    pixels[ys[keep], xs[keep]] = reference['dot_colors'][0][:3]
+    layout = np.column_stack((xs[keep], ys[keep])).astype(np.float64)
+    assert np.linalg.det(register_layout(np.asarray(pasted(Image.fromarray(pixels))), layout)[0][:2, :2]) > 0
+    token = Image.fromarray(pixels).transpose(MIRRORS[mirror])
+    with pytest.raises(ValueError, match='mirrored'):
+        register_layout(np.asarray(pasted(token)), layout)
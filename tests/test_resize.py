@@ -0,0 +1,48 @@
+import os
+import sys
+import numpy as np
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+from benchmark import render_token
+from decoding import decode_token_image
+from payload import bit_matrix_to_payloads
+from reference_data import load_reference_data
+
+# Smallest size each filter's downscale of a reference token must decode exactly at;
+# NEAREST drops most one-pixel dots, so its downscales must be rejected at every size
+EXACT_FROM = {'BOX': 300, 'BILINEAR': 300, 'BICUBIC': 400, 'LANCZOS': 400, 'HAMMING': 500, 'NEAREST': None}
+SIZES = list(range(300, 1000, 100))
+
+
+@pytest.fixture(scope='module')
+def reference():
+    return load_reference_data()
+
+
+@pytest.fixture(scope='module')
+def bits(reference):
+    return np.random.default_rng(0).integers(0, 2, reference['total_dots']).astype(np.uint8)
+
+
+@pytest.fixture(scope='module')
+def token(reference, bits):
+    # One-pixel dots, as in the real tokens
+    return render_token(bits, reference, dot_radius=0)
+
+
+@pytest.mark.parametrize('size', SIZES)
+@pytest.mark.parametrize('resample', list(EXACT_FROM))
+def test_downscaled_tokens_decode_exactly_or_are_rejected(reference, bits, token, tmp_path, size, resample):
+    path = tmp_path / 'token.png'
+    token.resize((size, size), getattr(Image, resample)).save(path)
+    try:
+        payload = decode_token_image(str(path), reference['dot_positions'], reference['dot_colors'], reference['total_dots'])[0]
+    except ValueError:
+        payload = None
+    if EXACT_FROM[resample] is not None and size >= EXACT_FROM[resample]:
+        assert payload == bit_matrix_to_payloads(bits[np.newaxis])[0]
+    else:
+        assert payload in (None, bit_matrix_to_payloads(bits[np.newaxis])[0])